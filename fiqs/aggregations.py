@@ -62,6 +62,18 @@ class Aggregate(Metric):
         }
         return params
 
+    def metric_params(self):
+        params = {
+            "agg_type": self.__class__.__name__.lower(),
+            "field": self.field.get_storage_field(),
+        }
+        params.update(self.params)
+        return params
+
+    def signature(self):
+        # Two aggregates with the same signature send the same request to ES
+        return repr(sorted(self.metric_params().items()))
+
     def choice_keys(self):
         return None
 
@@ -109,15 +121,18 @@ class Histogram(Aggregate):
             raise MissingParameterException("cannot give max without min")
 
         if "min" in self.params and "max" in self.params:
-            self.min = self.params.pop("min")
-            self.max = self.params.pop("max")
+            # We keep min and max in params, agg_params may be called several times
+            self.min = self.params["min"]
+            self.max = self.params["max"]
 
             params["extended_bounds"] = {
                 "min": self.min,
                 "max": self.max,
             }
 
-        params.update(self.params)
+        params.update(
+            {k: v for k, v in self.params.items() if k not in ("min", "max")}
+        )
 
         if "interval" not in params:
             raise MissingParameterException("missing interval parameter")
@@ -126,6 +141,10 @@ class Histogram(Aggregate):
 
         return params
 
+    def with_bounds(self, min, max):
+        """Copy of the histogram, with other bounds"""
+        return self.__class__(self.field, **dict(self.params, min=min, max=max))
+
 
 TIME_UNIT_CONVERSION = {
     "d": "days",
@@ -272,6 +291,20 @@ class DateHistogram(Histogram):
                     agg_params["calendar_interval"] = agg_params.pop("interval")
         return agg_params
 
+    def round_date(self, d):
+        """Start of the bucket containing d, or d if we cannot compute it"""
+        if not isinstance(d, datetime) or d.tzinfo is not None:
+            return d
+
+        if not is_interval_handled(self.interval) or "time_zone" in self.params:
+            return d
+
+        if "offset" in self.params:
+            offset = get_timedelta_from_timestring(self.params["offset"])
+            return get_rounded_date_from_interval(d - offset, self.interval) + offset
+
+        return get_rounded_date_from_interval(d, self.interval)
+
     def choice_keys(self):
         if not hasattr(self, "min") or not hasattr(self, "max"):
             return None
@@ -361,6 +394,66 @@ class DateHistogram(Histogram):
         return choice_keys
 
 
+class AutoDateHistogram(DateHistogram):
+    """A DateHistogram using the finest interval which gives at most
+    `buckets` buckets between min and max"""
+
+    # From the finest to the coarsest
+    intervals = (
+        "1m",
+        "5m",
+        "15m",
+        "30m",
+        "1h",
+        "3h",
+        "6h",
+        "12h",
+        "1d",
+        "1w",
+        "1M",
+        "1y",
+    )
+
+    def __init__(self, field, buckets=100, **kwargs):
+        if "min" not in kwargs or "max" not in kwargs:
+            raise MissingParameterException("missing min or max parameter")
+
+        # The interval is always computed, for instance when bounds change
+        kwargs.pop("interval", None)
+        super().__init__(field, **kwargs)
+
+        self.buckets = buckets
+        self.params["interval"] = self.pick_interval(kwargs["min"], kwargs["max"])
+
+    def with_bounds(self, min, max):
+        return self.__class__(
+            self.field,
+            buckets=self.buckets,
+            **dict(self.params, min=min, max=max),
+        )
+
+    def pick_interval(self, min, max):
+        for interval in self.intervals:
+            if self.count_buckets(min, max, interval) <= self.buckets:
+                return interval
+        return self.intervals[-1]
+
+    def count_buckets(self, min, max, interval):
+        if is_interval_yearly(interval):
+            return max.year - min.year + 1
+
+        if is_interval_monthly(interval):
+            return (max.year - min.year) * 12 + max.month - min.month + 1
+
+        start = get_rounded_date_from_interval(min, interval)
+        if is_interval_weekly(interval):
+            delta = timedelta(days=7)
+        else:
+            delta = get_timedelta_from_interval(interval)
+
+        return (max - start) // delta + 1
+
+
 class DateRange(Aggregate):
     ref = "date_range"
 
@@ -432,19 +525,12 @@ class ReverseNested(Metric):
     def get_casted_value(self, v):
         return v
 
-    def configure_aggregations(self, agg):
-        reverse_agg_params = self.reverse_agg_params()
-        reverse_nested_bucket = agg.bucket(**reverse_agg_params)
-
-        for key, expression in self._expressions.items():
-            if expression.is_field_agg():
-                op = expression.__class__.__name__.lower()
-                reverse_nested_bucket.metric(
-                    key,
-                    op,
-                    field=expression.field.get_storage_field(),
-                    **expression.params,
-                )
+    def field_expressions(self):
+        return {
+            key: expression
+            for key, expression in self._expressions.items()
+            if expression.is_field_agg()
+        }
 
     @functools.cached_property
     def expressions(self):
@@ -479,6 +565,11 @@ class Operation(Metric):
     def compute(self, results, key=None):
         raise NotImplementedError
 
+    def script_source(self, operands):
+        """Painless source computing the operation from the sources of its
+        operands, where a missing value is NaN"""
+        raise NotImplementedError
+
     def get_casted_value(self, v):
         return v
 
@@ -532,6 +623,10 @@ class Ratio(Operation):
 
         return div_or_none(dividend, divisor, percentage=True)
 
+    def script_source(self, operands):
+        dividend, divisor = operands
+        return f"({divisor} == 0 ? Double.NaN : 100.0 * {dividend} / {divisor})"
+
 
 class Addition(Operation):
     def __init__(self, *args):
@@ -545,6 +640,9 @@ class Addition(Operation):
     def compute_one(self, row):
         return add_or_none([row[key] for key in self._operand_keys])
 
+    def script_source(self, operands):
+        return f"({' + '.join(operands)})"
+
 
 class Subtraction(Operation):
     def __init__(self, minuend, subtraend):
@@ -559,3 +657,7 @@ class Subtraction(Operation):
 
     def compute_one(self, row):
         return sub_or_none(row[self._minuend_key], row[self._subtraend_key])
+
+    def script_source(self, operands):
+        minuend, subtraend = operands
+        return f"({minuend} - {subtraend})"
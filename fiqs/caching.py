@@ -0,0 +1,173 @@
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+_SCHEMA = """
+BEGIN IMMEDIATE;
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    format TEXT NOT NULL,
+    payload BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    expires_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_expires_at ON responses (expires_at);
+CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at);
+-- The total size of the payloads, kept up to date by the triggers
+CREATE TABLE IF NOT EXISTS stats (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    size INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO stats SELECT 0, COALESCE(SUM(size), 0) FROM responses;
+CREATE TRIGGER IF NOT EXISTS responses_insert AFTER INSERT ON responses
+BEGIN
+    UPDATE stats SET size = size + new.size;
+END;
+CREATE TRIGGER IF NOT EXISTS responses_update AFTER UPDATE OF size ON responses
+BEGIN
+    UPDATE stats SET size = size - old.size + new.size;
+END;
+CREATE TRIGGER IF NOT EXISTS responses_delete AFTER DELETE ON responses
+BEGIN
+    UPDATE stats SET size = size - old.size;
+END;
+COMMIT;
+"""
+
+
+class DiskCache:
+    """A cache of Elasticsearch responses, in a sqlite database.
+
+    Several processes (e.g. the workers of a web server) can share the same
+    file, and the cache survives restarts. Payloads are compressed with zlib.
+    Entries expire after `ttl` seconds, and the least recently used ones are
+    evicted when the compressed payloads exceed `max_size` bytes. Reads do
+    not take the write lock: the last access of an entry is only written
+    when the previous one is more than `touch_interval` seconds old."""
+
+    def __init__(
+        self,
+        path,
+        ttl=300,
+        max_size=100 * 2**20,
+        compress_level=6,
+        touch_interval=60,
+    ):
+        self.path = os.fspath(path)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.compress_level = compress_level
+        self.touch_interval = touch_interval
+
+        self._local = threading.local()
+        self._connection().executescript(_SCHEMA)
+
+    def _connection(self):
+        # sqlite connections must not cross threads, nor forks
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            # Readers do not block the writer, nor the writer the readers
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _transaction(self):
+        return _Transaction(self._connection())
+
+    def get(self, key):
+        """Return the (format, payload) stored for the key, None if there is
+        no entry or if it expired"""
+        now = time.time()
+        connection = self._connection()
+        row = connection.execute(
+            "SELECT format, payload, accessed_at FROM responses "
+            "WHERE key = ? AND expires_at > ?",
+            (key, now),
+        ).fetchone()
+        if row is None:
+            return None
+
+        response_format, payload, accessed_at = row
+        if now - accessed_at >= self.touch_interval:
+            connection.execute(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+        return response_format, zlib.decompress(payload)
+
+    def set(self, key, response_format, payload, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        payload = zlib.compress(payload, self.compress_level)
+        if len(payload) > self.max_size:
+            return
+
+        now = time.time()
+        with self._transaction() as connection:
+            connection.execute(
+                "INSERT INTO responses VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET format = excluded.format, "
+                "payload = excluded.payload, size = excluded.size, "
+                "expires_at = excluded.expires_at, accessed_at = excluded.accessed_at",
+                (key, response_format, payload, len(payload), now + ttl, now),
+            )
+            self._evict(connection, now)
+
+    def _evict(self, connection, now):
+        connection.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+
+        size = self._size(connection)
+        if size <= self.max_size:
+            return
+
+        # Only the least recently used entries are read, through the index
+        evicted = []
+        rows = connection.execute(
+            "SELECT key, size FROM responses ORDER BY accessed_at"
+        )
+        for key, entry_size in rows:
+            if size <= self.max_size:
+                break
+            evicted.append((key,))
+            size -= entry_size
+        rows.close()
+        connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def delete(self, key):
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def clear(self):
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM responses")
+
+    def size(self):
+        """Size of the compressed payloads, in bytes"""
+        return self._size(self._connection())
+
+    def _size(self, connection):
+        return connection.execute("SELECT size FROM stats").fetchone()[0]
+
+    def __len__(self):
+        connection = self._connection()
+        return connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE takes the write lock at once: concurrent writers wait
+    for it (up to the connection timeout) instead of failing on upgrade"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, *args):
+        self.connection.execute("ROLLBACK" if exc_type else "COMMIT")
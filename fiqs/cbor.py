@@ -0,0 +1,274 @@
+"""A small CBOR (RFC 8949) encoder and decoder.
+
+Elasticsearch can answer in CBOR instead of JSON. Aggregation responses are
+mostly maps, short strings and numbers, which CBOR encodes with a one byte
+header and no escaping. The decoder only handles what Elasticsearch sends:
+definite and indefinite length strings, arrays and maps, integers, floats,
+simple values and tags (whose content is returned as is, except bignums)."""
+import struct
+
+from elastic_transport import Serializer
+
+CBOR_MIMETYPE = "application/cbor"
+# Sent by the elasticsearch client when it asks for a compatible API version
+CBOR_COMPAT_MIMETYPE = "application/vnd.elasticsearch+cbor"
+
+
+class CBORDecodeError(ValueError):
+    pass
+
+
+_UINT16 = struct.Struct(">H")
+_UINT32 = struct.Struct(">I")
+_UINT64 = struct.Struct(">Q")
+_FLOAT32 = struct.Struct(">f")
+_FLOAT64 = struct.Struct(">d")
+
+_unpack_uint64 = _UINT64.unpack_from
+_unpack_float64 = _FLOAT64.unpack_from
+
+
+def _decode_float16(data, pos):
+    half = _UINT16.unpack_from(data, pos)[0]
+    exponent = (half >> 10) & 0x1F
+    mantissa = half & 0x3FF
+
+    if exponent == 0:
+        value = mantissa * 2.0**-24
+    elif exponent == 0x1F:
+        value = float("nan") if mantissa else float("inf")
+    else:
+        value = (mantissa + 1024) * 2.0 ** (exponent - 25)
+
+    return -value if half & 0x8000 else value
+
+
+def _read_argument(data, pos, info):
+    # Returns the argument of an item header, None for indefinite lengths
+    if info < 24:
+        return info, pos
+    if info == 24:
+        return data[pos], pos + 1
+    if info == 25:
+        return _UINT16.unpack_from(data, pos)[0], pos + 2
+    if info == 26:
+        return _UINT32.unpack_from(data, pos)[0], pos + 4
+    if info == 27:
+        return _UINT64.unpack_from(data, pos)[0], pos + 8
+    if info == 31:
+        return None, pos
+
+    raise CBORDecodeError(f"Invalid additional information {info}")
+
+
+def _decode(data, pos):
+    initial = data[pos]
+    pos += 1
+
+    # Fast paths for the most common items in aggregation responses:
+    # small integers, short strings, doubles and timestamps
+    if initial < 0x18:
+        return initial, pos
+    if 0x60 <= initial < 0x78:
+        end = pos + initial - 0x60
+        return data[pos:end].decode("utf-8"), end
+    if initial == 0xFB:
+        return _unpack_float64(data, pos)[0], pos + 8
+    if initial == 0x1B:
+        return _unpack_uint64(data, pos)[0], pos + 8
+
+    major = initial >> 5
+    info = initial & 0x1F
+
+    if major == 7:
+        return _decode_simple(data, pos, info)
+
+    arg, pos = _read_argument(data, pos, info)
+
+    if major == 0:
+        return arg, pos
+
+    if major == 1:
+        return -1 - arg, pos
+
+    if major == 2 or major == 3:
+        if arg is None:
+            chunks = []
+            while data[pos] != 0xFF:
+                chunk, pos = _decode(data, pos)
+                chunks.append(chunk)
+            value = b"".join(chunks) if major == 2 else "".join(chunks)
+            return value, pos + 1
+
+        end = pos + arg
+        value = bytes(data[pos:end])
+        return (value if major == 2 else value.decode("utf-8")), end
+
+    if major == 4:
+        items = []
+        append = items.append
+        # -1 never reaches 0: indefinite arrays stop on the break byte
+        remaining = -1 if arg is None else arg
+        while remaining:
+            if remaining < 0 and data[pos] == 0xFF:
+                return items, pos + 1
+            item, pos = _decode(data, pos)
+            append(item)
+            remaining -= 1
+        return items, pos
+
+    if major == 5:
+        d = {}
+        remaining = -1 if arg is None else arg
+        while remaining:
+            initial = data[pos]
+            if 0x60 <= initial < 0x78:
+                end = pos + 1 + initial - 0x60
+                key = data[pos + 1 : end].decode("utf-8")
+                pos = end
+            elif initial == 0xFF and remaining < 0:
+                return d, pos + 1
+            else:
+                key, pos = _decode(data, pos)
+
+            initial = data[pos]
+            if initial < 0x18:
+                d[key] = initial
+                pos += 1
+            elif initial == 0xFB:
+                d[key] = _unpack_float64(data, pos + 1)[0]
+                pos += 9
+            else:
+                d[key], pos = _decode(data, pos)
+            remaining -= 1
+        return d, pos
+
+    # major == 6, tagged item
+    value, pos = _decode(data, pos)
+    if arg == 2:
+        return int.from_bytes(value, "big"), pos
+    if arg == 3:
+        return -1 - int.from_bytes(value, "big"), pos
+    return value, pos
+
+
+def _decode_simple(data, pos, info):
+    if info == 20:
+        return False, pos
+    if info == 21:
+        return True, pos
+    if info == 22 or info == 23:
+        return None, pos
+    if info == 25:
+        return _decode_float16(data, pos), pos + 2
+    if info == 26:
+        return _FLOAT32.unpack_from(data, pos)[0], pos + 4
+    if info == 27:
+        return _FLOAT64.unpack_from(data, pos)[0], pos + 8
+    if info == 31:
+        raise CBORDecodeError("Unexpected break")
+    if info < 24:
+        return info, pos
+    if info == 24:
+        return data[pos], pos + 1
+
+    raise CBORDecodeError(f"Invalid simple value {info}")
+
+
+def loads(data):
+    """Decode a CBOR payload (bytes, bytearray or memoryview)"""
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+
+    try:
+        value, pos = _decode(data, 0)
+    except (IndexError, struct.error) as e:
+        raise CBORDecodeError("Truncated CBOR payload") from e
+
+    if pos != len(data):
+        raise CBORDecodeError("Extra data after the CBOR payload")
+
+    return value
+
+
+def _encode_header(major, arg):
+    if arg < 24:
+        return bytes([major << 5 | arg])
+    if arg < 0x100:
+        return bytes([major << 5 | 24, arg])
+    if arg < 0x10000:
+        return bytes([major << 5 | 25]) + _UINT16.pack(arg)
+    if arg < 0x100000000:
+        return bytes([major << 5 | 26]) + _UINT32.pack(arg)
+    return bytes([major << 5 | 27]) + _UINT64.pack(arg)
+
+
+def _encode(value, chunks):
+    if value is None:
+        chunks.append(b"\xf6")
+    elif value is True:
+        chunks.append(b"\xf5")
+    elif value is False:
+        chunks.append(b"\xf4")
+    elif isinstance(value, int):
+        if value >= 0:
+            chunks.append(_encode_header(0, value))
+        else:
+            chunks.append(_encode_header(1, -1 - value))
+    elif isinstance(value, float):
+        chunks.append(b"\xfb" + _FLOAT64.pack(value))
+    elif isinstance(value, str):
+        encoded = value.encode("utf-8")
+        chunks.append(_encode_header(3, len(encoded)))
+        chunks.append(encoded)
+    elif isinstance(value, bytes | bytearray):
+        chunks.append(_encode_header(2, len(value)))
+        chunks.append(bytes(value))
+    elif isinstance(value, list | tuple):
+        chunks.append(_encode_header(4, len(value)))
+        for item in value:
+            _encode(item, chunks)
+    elif isinstance(value, dict):
+        chunks.append(_encode_header(5, len(value)))
+        for key, item in value.items():
+            _encode(key, chunks)
+            _encode(item, chunks)
+    else:
+        raise TypeError(f"Cannot encode {type(value).__name__} to CBOR")
+
+
+def dumps(value):
+    chunks = []
+    _encode(value, chunks)
+    return b"".join(chunks)
+
+
+class CBORSerializer(Serializer):
+    """Lets an Elasticsearch client handle CBOR responses.
+
+    With `decode=False` the raw payload is kept as bytes, and decoded by
+    fiqs when flattening the result::
+
+        Elasticsearch(..., serializers=cbor_serializers(decode=False))
+    """
+
+    mimetype = CBOR_MIMETYPE
+
+    def __init__(self, decode=True):
+        self.decode = decode
+
+    def loads(self, data):
+        if self.decode:
+            return loads(data)
+        return bytes(data)
+
+    def dumps(self, data):
+        if isinstance(data, bytes | bytearray):
+            return bytes(data)
+        return dumps(data)
+
+
+def cbor_serializers(decode=True):
+    """Serializers to give to an Elasticsearch client for CBOR responses"""
+    serializer = CBORSerializer(decode=decode)
+    return {CBOR_MIMETYPE: serializer, CBOR_COMPAT_MIMETYPE: serializer}
@@ -0,0 +1,65 @@
+import threading
+
+from fiqs.exceptions import DeadlineExceededError
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiters = 0
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs a function only once for concurrent calls sharing the same key:
+    the first caller runs it, the next ones wait for its result.
+
+    Every caller gets its own copy of the result, made with `copy`, unless
+    the result was not shared. `coalesced` counts the calls which did not
+    run the function. A waiter gives up after its own `timeout`, in
+    seconds, the function keeps running for the other callers."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def do(self, key, function, copy, timeout=None):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+
+        if not leader:
+            if not call.done.wait(timeout):
+                with self._lock:
+                    call.waiters -= 1
+                raise DeadlineExceededError(
+                    "Deadline exceeded while waiting for a coalesced request"
+                )
+            if call.error is not None:
+                raise call.error
+            return copy(call.result)
+
+        try:
+            call.result = function()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                # Later callers run the function again
+                del self._calls[key]
+                shared = call.waiters > 0
+            call.done.set()
+
+        # The waiters copy the original result, we must not modify it
+        return copy(call.result) if shared else call.result
+
+
+SINGLE_FLIGHT = SingleFlight()
@@ -0,0 +1,93 @@
+"""Named Elasticsearch clients, shared by the whole process.
+
+Clients are registered in the elasticsearch.dsl connections registries, so
+that a Search using an alias, like the ones built by FQuery.from_model, gets
+the pooled, keep-alive, client of this alias."""
+import threading
+
+from elasticsearch import AsyncElasticsearch, Elasticsearch
+from elasticsearch.dsl.async_connections import connections as async_connections
+from elasticsearch.dsl.connections import connections as sync_connections
+
+from fiqs.exceptions import ConfigurationError
+
+DEFAULT_ALIAS = "default"
+# The transport retries these at once, without 429: rejected requests are
+# retried by fiqs.limiting, after a delay
+RETRY_ON_STATUS = (502, 503, 504)
+
+_configs = {}
+_lock = threading.Lock()
+
+
+def configure(
+    alias=DEFAULT_ALIAS,
+    hosts=None,
+    pool_size=10,
+    compression=False,
+    request_timeout=30,
+    retry_on_status=RETRY_ON_STATUS,
+    **kwargs,
+):
+    """Declare a cluster, and return its sync client. `pool_size` is the
+    number of connections kept to each node. Other arguments are given to
+    the clients. The async client is only created by get_async_client, as
+    it needs aiohttp"""
+    config = dict(
+        kwargs,
+        hosts=hosts,
+        connections_per_node=pool_size,
+        http_compress=compression,
+        request_timeout=request_timeout,
+        retry_on_status=retry_on_status,
+    )
+    client = Elasticsearch(**config)
+
+    with _lock:
+        _configs[alias] = config
+        sync_connections.add_connection(alias, client)
+        # Created again from the new configuration when needed
+        _remove_connection(async_connections, alias)
+
+    return client
+
+
+def get_client(alias=DEFAULT_ALIAS):
+    try:
+        return sync_connections.get_connection(alias)
+    except KeyError as e:
+        raise ConfigurationError(_unknown_alias_message(alias)) from e
+
+
+def get_async_client(alias=DEFAULT_ALIAS):
+    with _lock:
+        try:
+            return async_connections.get_connection(alias)
+        except KeyError:
+            pass
+
+        if alias not in _configs:
+            raise ConfigurationError(_unknown_alias_message(alias))
+        client = AsyncElasticsearch(**_configs[alias])
+        async_connections.add_connection(alias, client)
+        return client
+
+
+def remove(alias):
+    """Forget a cluster. Its clients are not closed, requests may still use
+    them"""
+    with _lock:
+        _configs.pop(alias, None)
+        _remove_connection(sync_connections, alias)
+        _remove_connection(async_connections, alias)
+
+
+def _remove_connection(registry, alias):
+    try:
+        registry.remove_connection(alias)
+    except KeyError:
+        pass
+
+
+def _unknown_alias_message(alias):
+    return f"No Elasticsearch connection named {alias}, see fiqs.connections.configure"
@@ -8,3 +8,20 @@ class ConfigurationError(Exception):
 
 class FieldError(Exception):
     pass
+
+
+class TooManyBucketsError(Exception):
+    pass
+
+
+class DeadlineExceededError(Exception):
+    pass
+
+
+class PartialResultsError(Exception):
+    """Elasticsearch timed out, or some shards failed: `result` only holds
+    the documents of the shards which answered in time"""
+
+    def __init__(self, message, result=None):
+        super().__init__(message)
+        self.result = result
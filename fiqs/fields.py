@@ -80,6 +80,9 @@ class Field:
                 size = 2**31 - 1
             d["size"] = size
 
+        if "shard_size" in self.data:
+            d["shard_size"] = self.data["shard_size"]
+
         return d
 
     def is_range(self):
@@ -0,0 +1,165 @@
+import heapq
+import itertools
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class HedgingPolicy:
+    """When to send a duplicate of a slow request, for FQuery's `hedge`
+    option.
+
+    A request is hedged once it has been running for longer than the
+    `percentile` of the latencies of the last `window` requests (and only
+    once `min_samples` latencies were observed). Hedges are at most a
+    `budget` fraction of the requests. Requests are sent by the calling
+    thread, only their hedges and the cancellations by a pool of
+    `max_workers` threads. A policy is meant to be shared by the FQuery
+    objects sending the same kind of requests."""
+
+    def __init__(
+        self,
+        percentile=95,
+        budget=0.05,
+        min_samples=20,
+        window=1000,
+        max_workers=16,
+    ):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.max_workers = max_workers
+
+        self.requests = 0
+        self.hedged = 0  # Requests which were hedged
+        self.hedge_wins = 0  # Hedged requests answered by the hedge first
+
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._timers = []  # Heap of (due time, order, cancelled event, function)
+        self._counter = itertools.count()
+        self._timers_condition = threading.Condition()
+        self._timers_thread = None
+
+    def delay(self):
+        """Seconds to wait before hedging, None if we do not know yet"""
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        rank = math.ceil(self.percentile / 100 * len(latencies))
+        return latencies[max(rank - 1, 0)]
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def within_budget(self):
+        return self.hedged + 1 <= self.budget * self.requests
+
+    def reserve_hedge(self):
+        with self._lock:
+            if not self.within_budget():
+                return False
+            self.hedged += 1
+            return True
+
+    def count_win(self):
+        with self._lock:
+            self.hedge_wins += 1
+
+    def record_latency(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    @property
+    def hedge_rate(self):
+        return self.hedged / self.requests if self.requests else 0.0
+
+    @property
+    def win_rate(self):
+        return self.hedge_wins / self.hedged if self.hedged else 0.0
+
+    def submit(self, function, *args):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="fiqs-hedge"
+                )
+        return self._executor.submit(function, *args)
+
+    def schedule(self, delay, function, *args):
+        """Submit `function` to the hedging pool in `delay` seconds, unless
+        the returned event is set before. The requests themselves do not go
+        through the pool, only their hedges and cancellations"""
+        cancelled = threading.Event()
+        due = time.monotonic() + delay
+        with self._timers_condition:
+            heapq.heappush(
+                self._timers, (due, next(self._counter), cancelled, function, args)
+            )
+            if self._timers_thread is None:
+                self._timers_thread = threading.Thread(
+                    target=self._run_timers, name="fiqs-hedge-timers", daemon=True
+                )
+                self._timers_thread.start()
+            self._timers_condition.notify()
+        return cancelled
+
+    def _run_timers(self):
+        while True:
+            with self._timers_condition:
+                while not self._timers or self._timers[0][0] > time.monotonic():
+                    timeout = None
+                    if self._timers:
+                        timeout = self._timers[0][0] - time.monotonic()
+                    self._timers_condition.wait(timeout)
+                _, _, cancelled, function, args = heapq.heappop(self._timers)
+            if not cancelled.is_set():
+                self.submit(function, *args)
+
+
+class HedgeRace:
+    """The race between a request, sent by the calling thread, and its hedge,
+    sent by the hedging pool. The first response wins"""
+
+    def __init__(self):
+        self.request_done = False
+        self.hedge = None  # None, "running", "won", "lost" or "failed"
+        self.hedge_response = None
+        self._condition = threading.Condition()
+
+    def start_hedge(self):
+        """Whether the hedge should still be sent"""
+        with self._condition:
+            if self.request_done:
+                return False
+            self.hedge = "running"
+            return True
+
+    def finish_hedge(self, response=None, failed=False):
+        """Returns whether the request is still running, and must be
+        cancelled"""
+        with self._condition:
+            if failed:
+                self.hedge = "failed"
+            elif self.hedge == "running":
+                self.hedge = "won"
+                self.hedge_response = response
+            self._condition.notify_all()
+            return self.hedge == "won" and not self.request_done
+
+    def finish_request(self, failed=False):
+        """Returns the state of the hedge once the request answered. If the
+        request failed, waits for the running hedge"""
+        with self._condition:
+            self.request_done = True
+            if failed:
+                while self.hedge == "running":
+                    self._condition.wait()
+            elif self.hedge == "running":
+                self.hedge = "lost"
+            return self.hedge
@@ -0,0 +1,178 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from elasticsearch import ApiError
+
+from fiqs.exceptions import DeadlineExceededError
+from fiqs.metrics import get_registry
+
+# Elasticsearch answers 429 when its search thread pool queue is full
+REJECTED_STATUS = 429
+
+
+def is_rejected(error):
+    return isinstance(error, ApiError) and error.status_code == REJECTED_STATUS
+
+
+class ConcurrencyLimiter:
+    """Bounds the number of Elasticsearch requests running at the same time.
+
+    The limit follows an AIMD policy: it grows by one every `limit`
+    successful requests, and is multiplied by `backoff_ratio` when
+    Elasticsearch rejects a request (429), or when the latency gets more
+    than `latency_tolerance` times its usual value: the average latency of
+    the last `short_window` requests is compared to the one of the last
+    `window` requests (exponential moving averages). Other failures only
+    free their slot. Requests over the limit wait in a queue, highest
+    `priority` first. Rejected requests are retried up to `max_retries`
+    times, after a random delay (full jitter) growing exponentially from
+    `base_delay`."""
+
+    def __init__(
+        self,
+        initial_limit=10,
+        min_limit=1,
+        max_limit=100,
+        backoff_ratio=0.9,
+        latency_tolerance=2.0,
+        window=100,
+        short_window=10,
+        max_retries=3,
+        base_delay=0.1,
+        max_delay=5.0,
+    ):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_ratio = backoff_ratio
+        self.latency_tolerance = latency_tolerance
+        self.short_window = short_window
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.in_flight = 0
+        self.rejected = 0  # Requests rejected by Elasticsearch
+        self.retries = 0
+
+        # Smoothing factors of the moving averages, for their window
+        self._long_alpha = 2 / (window + 1)
+        self._short_alpha = 2 / (short_window + 1)
+        self._long_latency = None
+        self._short_latency = None
+        self._samples = 0
+        self._queue = []  # Heap of (-priority, arrival order)
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+
+    def run(self, function, priority=0, timeout=None):
+        """Call `function` once there is room under the limit, retrying it
+        if Elasticsearch rejects it. `timeout` bounds the whole call, in
+        seconds, queueing and retries included"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        for attempt in itertools.count():
+            self.acquire(priority, deadline)
+            start = time.monotonic()
+            try:
+                result = function()
+            except Exception as e:
+                if not is_rejected(e):
+                    # Says nothing of the load of the cluster
+                    self.release()
+                    raise
+                self.release(rejected=True)
+                if attempt >= self.max_retries:
+                    raise
+                error = e
+            else:
+                self.release(time.monotonic() - start)
+                return result
+
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                raise error
+            with self._condition:
+                self.retries += 1
+            registry = get_registry()
+            if registry is not None:
+                registry.count_retry()
+            time.sleep(delay)
+
+    def acquire(self, priority=0, deadline=None):
+        with self._condition:
+            entry = (-priority, next(self._counter))
+            heapq.heappush(self._queue, entry)
+            try:
+                while self._queue[0] != entry or self.in_flight >= int(self.limit):
+                    timeout = None
+                    if deadline is not None:
+                        timeout = deadline - time.monotonic()
+                        if timeout <= 0:
+                            raise DeadlineExceededError(
+                                "Deadline exceeded while waiting for the "
+                                "concurrency limiter"
+                            )
+                    self._condition.wait(timeout)
+            except BaseException:
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+                self._condition.notify_all()
+                raise
+
+            heapq.heappop(self._queue)
+            self.in_flight += 1
+            # The next request may fit too
+            self._condition.notify_all()
+
+    def release(self, latency=None, rejected=False):
+        """Free a slot, after a request which took `latency` seconds. Without
+        latency nor rejection, the limit is left as is"""
+        with self._condition:
+            self.in_flight -= 1
+
+            if rejected:
+                self.rejected += 1
+                self._decrease()
+            elif latency is not None:
+                if self._record_latency(latency):
+                    self._decrease()
+                else:
+                    self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+
+            self._condition.notify_all()
+
+    def _record_latency(self, latency):
+        """Update the moving averages, and tell whether the recent latency
+        shows congestion"""
+        if self._samples == 0:
+            self._long_latency = self._short_latency = latency
+        else:
+            self._long_latency += self._long_alpha * (latency - self._long_latency)
+            self._short_latency += self._short_alpha * (latency - self._short_latency)
+        self._samples += 1
+
+        return (
+            self._samples >= self.short_window
+            and self._short_latency > self.latency_tolerance * self._long_latency
+        )
+
+    def _decrease(self):
+        self.limit = max(self.limit * self.backoff_ratio, self.min_limit)
+
+
+_limiter = None
+
+
+def set_limiter(limiter):
+    """Set the limiter of every FQuery request of the process, None to
+    remove it"""
+    global _limiter
+    _limiter = limiter
+
+
+def get_limiter():
+    return _limiter
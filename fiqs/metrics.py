@@ -0,0 +1,181 @@
+import math
+import threading
+from bisect import bisect_left
+
+# In seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# In bytes
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8)
+
+EVAL_LABELS = ("shape", "model")
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.values = {}  # Label values tuple => value
+
+    def inc(self, labels=(), value=1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, dict(zip(self.label_names, labels)), value
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = tuple(buckets) + (math.inf,)
+        self.values = {}  # Label values tuple => [bucket counts..., sum]
+
+    def observe(self, labels, value):
+        values = self.values.get(labels)
+        if values is None:
+            values = self.values[labels] = [0] * (len(self.buckets) + 1)
+        # The first bucket whose upper bound is greater or equal to the value
+        values[bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    def samples(self):
+        for labels, values in self.values.items():
+            labels = dict(zip(self.label_names, labels))
+            count = 0
+            for bound, bucket_count in zip(self.buckets, values):
+                count += bucket_count
+                le = "+Inf" if bound == math.inf else repr(float(bound))
+                yield f"{self.name}_bucket", dict(labels, le=le), count
+            yield f"{self.name}_sum", labels, values[-1]
+            yield f"{self.name}_count", labels, count
+
+
+class MetricsRegistry:
+    """Metrics of the FQuery evaluations of the process, labelled by the
+    shape of the query (see FQuery.shape) and its model.
+
+    Export them with `to_prometheus`, or give callbacks to `add_callback`:
+    they are called after each evaluation with a dict describing it."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+        self.evals = Counter("fiqs_evals_total", "FQuery evaluations", EVAL_LABELS)
+        self.eval_seconds = Histogram(
+            "fiqs_eval_seconds", "Wall time of the evaluations", EVAL_LABELS
+        )
+        self.stage_seconds = Histogram(
+            "fiqs_stage_seconds",
+            "Wall time of the stages of the evaluations",
+            EVAL_LABELS + ("stage",),
+        )
+        self.response_bytes = Histogram(
+            "fiqs_response_bytes",
+            "Size of the Elasticsearch responses",
+            EVAL_LABELS,
+            buckets=SIZE_BUCKETS,
+        )
+        self.buckets = Counter(
+            "fiqs_buckets_total", "Buckets visited while flattening", EVAL_LABELS
+        )
+        self.lines = Counter(
+            "fiqs_lines_total", "Lines built from the responses", EVAL_LABELS
+        )
+        self.filled_lines = Counter(
+            "fiqs_filled_lines_total",
+            "Lines added when filling the missing buckets",
+            EVAL_LABELS,
+        )
+        self.cache_hits = Counter(
+            "fiqs_cache_hits_total", "Responses served by the FQuery cache", EVAL_LABELS
+        )
+        self.retries = Counter(
+            "fiqs_request_retries_total",
+            "Requests retried after Elasticsearch rejected them",
+        )
+
+    def metrics(self):
+        return [
+            self.evals,
+            self.eval_seconds,
+            self.stage_seconds,
+            self.response_bytes,
+            self.buckets,
+            self.lines,
+            self.filled_lines,
+            self.cache_hits,
+            self.retries,
+        ]
+
+    def add_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def record_eval(self, shape, model, profile):
+        labels = (shape, model)
+        with self._lock:
+            self.evals.inc(labels)
+            self.eval_seconds.observe(labels, profile.wall_time)
+            for stage, stats in profile.stages.items():
+                self.stage_seconds.observe(labels + (stage,), stats["wall_time"])
+            if profile.response_size is not None:
+                self.response_bytes.observe(labels, profile.response_size)
+            self.buckets.inc(labels, profile.buckets)
+            self.lines.inc(labels, profile.lines)
+            self.filled_lines.inc(labels, profile.filled_lines)
+            if profile.cached:
+                self.cache_hits.inc(labels)
+
+        if self._callbacks:
+            record = dict(profile.to_dict(), shape=shape, model=model)
+            for callback in self._callbacks:
+                callback(record)
+
+    def count_retry(self):
+        with self._lock:
+            self.retries.inc()
+
+    def to_prometheus(self):
+        """The metrics, in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for metric in self.metrics():
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.type}")
+                for name, labels, value in metric.samples():
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    labels = ",".join(
+        f'{key}="{_escape(str(value))}"' for key, value in labels.items()
+    )
+    return f"{{{labels}}}"
+
+
+def _escape(value):
+    return value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+_registry = None
+
+
+def set_registry(registry):
+    """Record the metrics of every FQuery evaluation of the process in this
+    registry, None to stop recording them"""
+    global _registry
+    _registry = registry
+
+
+def get_registry():
+    return _registry
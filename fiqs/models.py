@@ -1,5 +1,6 @@
 from elasticsearch.dsl import Mapping, Nested
 
+from fiqs.connections import DEFAULT_ALIAS
 from fiqs.exceptions import FieldError
 from fiqs.fields import Field, NestedField
 
@@ -48,6 +49,7 @@ class ModelMetaClass(type):
 class Model(metaclass=ModelMetaClass):
     index = None
     doc_type = None
+    connection = None
 
     @classmethod
     def get_index(cls, *args, **kwargs):
@@ -56,6 +58,11 @@ class Model(metaclass=ModelMetaClass):
 
         return cls.index
 
+    @classmethod
+    def get_connection(cls, *args, **kwargs):
+        # The alias of a client registered in fiqs.connections
+        return cls.connection or DEFAULT_ALIAS
+
     @classmethod
     def get_doc_type(cls, *args, **kwargs):
         if not cls.doc_type:
@@ -0,0 +1,200 @@
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# tracemalloc is process-wide: it runs while any profile traces allocations
+_tracing_lock = threading.Lock()
+_tracing_profiles = 0  # Profiles tracing allocations right now
+_tracing_entries = 0  # Profiles which ever started tracing, tells overlaps
+_started_tracing = False  # We started tracemalloc, and must stop it
+
+
+class Profile:
+    """Client side profile of a FQuery evaluation.
+
+    Each stage records its wall time in seconds and, if allocations are
+    traced, the memory allocated (and kept) during the stage and the peak
+    memory used during the stage, in bytes. Allocations are traced for the
+    whole process, other threads included: the peak is None when another
+    profile traced allocations during the stage."""
+
+    def __init__(self, trace_allocations=True):
+        self.trace_allocations = trace_allocations
+        self.stages = {}
+
+        self.took = None  # As reported by Elasticsearch, in milliseconds
+        self.http_time = None  # Time spent waiting for the HTTP response
+        self.response_size = None  # In bytes, if Elasticsearch gave a content length
+        self.buckets = 0  # Buckets visited while flattening the result
+        self.lines = 0  # Lines built from the Elasticsearch result
+        self.filled_lines = 0  # Lines added when filling the missing buckets
+        self.aggregations = None  # Elasticsearch profile, see parse_es_profile
+        self.cached = False  # True if the response came from FQuery's cache
+
+        self._tracing = False
+
+    def __enter__(self):
+        global _tracing_profiles, _tracing_entries, _started_tracing
+        if self.trace_allocations and not self._tracing:
+            with _tracing_lock:
+                if _tracing_profiles == 0 and not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    _started_tracing = True
+                _tracing_profiles += 1
+                _tracing_entries += 1
+            self._tracing = True
+        return self
+
+    def __exit__(self, *args):
+        global _tracing_profiles, _started_tracing
+        if self._tracing:
+            with _tracing_lock:
+                _tracing_profiles -= 1
+                if _tracing_profiles == 0 and _started_tracing:
+                    tracemalloc.stop()
+                    _started_tracing = False
+            self._tracing = False
+
+    @contextmanager
+    def stage(self, name):
+        tracing = self.trace_allocations and tracemalloc.is_tracing()
+        if tracing:
+            with _tracing_lock:
+                # Resetting the peak would break the stages of other profiles
+                entries = _tracing_entries if _tracing_profiles <= 1 else None
+                if entries is not None:
+                    tracemalloc.reset_peak()
+                memory_before, _ = tracemalloc.get_traced_memory()
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stats = {
+                "wall_time": time.perf_counter() - start,
+                "allocated": None,
+                "peak": None,
+            }
+            if tracing:
+                with _tracing_lock:
+                    memory_after, peak = tracemalloc.get_traced_memory()
+                    alone = entries == _tracing_entries and _tracing_profiles <= 1
+                stats["allocated"] = memory_after - memory_before
+                if alone:
+                    stats["peak"] = peak - memory_before
+
+            self.stages[name] = stats
+
+    def count(self, name, value):
+        setattr(self, name, value)
+
+    def record_response(self, response, body=None):
+        """Gather what we can from an elasticsearch ApiResponse. `body` is the
+        decoded body, if the response was not decoded by the client. There is
+        no response when the body came from FQuery's cache"""
+        if response is None:
+            self.cached = True
+            self.took = body.get("took")
+            return
+        if body is None:
+            body = response.body
+        self.took = body.get("took")
+        self.http_time = response.meta.duration
+
+        content_length = response.meta.headers.get("content-length")
+        if content_length is not None:
+            self.response_size = int(content_length)
+
+    @property
+    def decode_time(self):
+        # The client decodes the JSON before handing us the response, raw
+        # CBOR payloads are decoded by fiqs in the decode stage
+        if "request" not in self.stages or self.http_time is None:
+            return None
+        decode_time = max(self.stages["request"]["wall_time"] - self.http_time, 0.0)
+        if "decode" in self.stages:
+            decode_time += self.stages["decode"]["wall_time"]
+        return decode_time
+
+    @property
+    def wall_time(self):
+        return sum(stats["wall_time"] for stats in self.stages.values())
+
+    def to_dict(self):
+        return {
+            "stages": {name: stats.copy() for name, stats in self.stages.items()},
+            "wall_time": self.wall_time,
+            "took": self.took,
+            "http_time": self.http_time,
+            "decode_time": self.decode_time,
+            "response_size": self.response_size,
+            "buckets": self.buckets,
+            "lines": self.lines,
+            "filled_lines": self.filled_lines,
+            "aggregations": self.aggregations,
+            "cached": self.cached,
+        }
+
+
+def parse_es_profile(es_profile, expressions):
+    """Sum the aggregations timings of an Elasticsearch profile across shards.
+
+    Aggregations are identified by their path, like `shop_id>total_sales`.
+    `expressions` maps these paths to the fiqs field or expression which
+    generated the aggregation."""
+    aggregations = {}
+
+    for shard in es_profile.get("shards", []):
+        queue = [(node, node["description"]) for node in shard.get("aggregations", [])]
+        while queue:
+            node, path = queue.pop()
+
+            stats = aggregations.setdefault(
+                path,
+                {
+                    "expression": expressions.get(path),
+                    "type": node["type"],
+                    "shards": 0,
+                    "time_in_nanos": 0,
+                    "collect": 0,
+                    "build_aggregation": 0,
+                    "breakdown": {},
+                },
+            )
+            stats["shards"] += 1
+            stats["time_in_nanos"] += node.get("time_in_nanos", 0)
+
+            breakdown = node.get("breakdown", {})
+            stats["collect"] += breakdown.get("collect", 0)
+            stats["build_aggregation"] += breakdown.get("build_aggregation", 0)
+            for key, value in breakdown.items():
+                stats["breakdown"][key] = stats["breakdown"].get(key, 0) + value
+
+            for child in node.get("children", []):
+                queue.append((child, f"{path}>{child['description']}"))
+
+    return aggregations
+
+
+class NullProfile:
+    """Stands in for a Profile when we are not profiling"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def count(self, name, value):
+        pass
+
+    def record_response(self, response, body=None):
+        pass
+
+
+NULL_PROFILE = NullProfile()
@@ -1,10 +1,114 @@
+import asyncio
+import copy
+import hashlib
+import json
 import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from itertools import product
-
-from fiqs import flatten_result
-from fiqs.aggregations import Aggregate, ReverseNested
-from fiqs.exceptions import ConfigurationError
+from urllib.parse import quote
+from uuid import uuid4
+
+from elasticsearch import ApiError, ConnectionTimeout, TransportError
+from elasticsearch.dsl import Search
+from elasticsearch.dsl.connections import get_connection
+from elasticsearch.dsl.response import Response
+
+from fiqs import cbor
+from fiqs.aggregations import (
+    Aggregate,
+    AutoDateHistogram,
+    DateHistogram,
+    ReverseNested,
+    Sum,
+    is_interval_handled,
+)
+from fiqs.coalescing import SINGLE_FLIGHT
+from fiqs.exceptions import (
+    ConfigurationError,
+    DeadlineExceededError,
+    MissingParameterException,
+    PartialResultsError,
+    TooManyBucketsError,
+)
 from fiqs.fields import Field, GroupedField, NestedField
+from fiqs.hedging import HedgeRace
+from fiqs.limiting import get_limiter
+from fiqs.metrics import get_registry
+from fiqs.profiling import NULL_PROFILE, Profile, parse_es_profile
+from fiqs.subscriptions import RollingWindow, utcnow
+from fiqs.tree import HIDDEN_AGGREGATION_PREFIX, SAMPLE_AGGREGATION, ResultTree
+
+# Used when no size is given to a terms aggregation
+ES_DEFAULT_TERMS_SIZE = 10
+
+# Rough size of the JSON for a bucket and for a metric in a response, in bytes
+BUCKET_RESPONSE_SIZE = 48
+METRIC_RESPONSE_SIZE = 24
+
+# Cardinalities are estimates, and terms are not evenly spread across partitions
+CARDINALITY_MARGIN = 1.25
+# A partition holding more terms than its size is split, up to this many times
+MAX_PARTITION_SPLITS = 8
+# Cardinality probes are cached for this long, in seconds
+CARDINALITY_CACHE_TTL = 300
+# Outer terms aggregations up to this size are collected breadth first
+BREADTH_FIRST_MAX_SIZE = 100
+
+# Added to the key of terms levels in the lines, with doc_count_errors
+DOC_COUNT_ERROR_SUFFIXES = (
+    "__doc_count_error",
+    "__max_doc_count_error",
+    "__sum_other_doc_count",
+)
+
+# Name of the bucket_selector aggregation compiled from the having predicates
+HAVING_AGGREGATION = "fiqs_having"
+HAVING_OPERATORS = {"gt": ">", "gte": ">=", "lt": "<", "lte": "<="}
+
+ORDER_DIRECTIONS = ("asc", "desc")
+# Name of the bucket_sort aggregation compiled from the order of a level
+BUCKET_SORT_AGGREGATION = f"{HIDDEN_AGGREGATION_PREFIX}sort"
+# Aggregations added to the levels by having and order_by, besides metrics
+PIPELINE_AGGREGATIONS = ("bucket_script", "bucket_selector", "bucket_sort")
+
+# Name of the composite aggregation used to page through several levels
+PAGE_AGGREGATION = "page"
+# Size of the composite aggregations walking to the cursor of a page
+COMPOSITE_MAX_SIZE = 10000
+# Parameters of the group_by aggregations a composite source accepts
+COMPOSITE_SOURCE_PARAMS = {
+    "terms": ("field", "script"),
+    "histogram": ("field", "interval", "offset"),
+    "date_histogram": (
+        "field",
+        "calendar_interval",
+        "fixed_interval",
+        "time_zone",
+        "offset",
+        "format",
+    ),
+}
+
+# Share of the time left before the deadline given to Elasticsearch as search
+# timeout, so that it answers before we stop waiting
+SEARCH_TIMEOUT_RATIO = 0.9
+
+RESPONSE_FORMATS = {
+    "json": "application/json",
+    "cbor": cbor.CBOR_MIMETYPE,
+}
+
+
+_cardinality_cache = {}
+_cardinality_cache_lock = threading.Lock()
+
+
+def clear_cardinality_cache():
+    with _cardinality_cache_lock:
+        _cardinality_cache.clear()
 
 
 def calc_group_by_keys(group_by_fields, nested=True):
@@ -22,18 +126,156 @@ def calc_group_by_keys(group_by_fields, nested=True):
     return ret
 
 
+def product_or_none(values):
+    if any(value is None for value in values):
+        return None
+    return math.prod(values)
+
+
+def agg_dict(params):
+    # Same params as the ones given to elasticsearch.dsl bucket and metric calls
+    params = params.copy()
+    params.pop("name", None)
+    agg_type = params.pop("agg_type")
+    return {agg_type: params}
+
+
+def deadline_timeouts(params, options, deadline):
+    """The params and options of a request sent now, with the search timeout
+    and the request timeout left before the deadline"""
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceededError("Deadline exceeded before the request")
+    timeout = max(int(remaining * SEARCH_TIMEOUT_RATIO * 1000), 1)
+    params = dict(params, timeout=f"{timeout}ms")
+    options = dict(options or {}, request_timeout=remaining)
+    return params, options
+
+
+def get_deadline(deadline):
+    # Deadlines are given in seconds (or as a timedelta) from now
+    if deadline is None:
+        return None
+    if isinstance(deadline, timedelta):
+        deadline = deadline.total_seconds()
+    return time.monotonic() + deadline
+
+
+def copy_response(response):
+    # Flattening modifies the result, raw CBOR payloads are decoded by each caller
+    if isinstance(response.body, bytes | bytearray | memoryview):
+        return response
+    return type(response)(body=copy.deepcopy(response.body), meta=response.meta)
+
+
+def new_opaque_id():
+    return f"fiqs-{uuid4().hex}"
+
+
+def canonical_body(value):
+    """Sort the keys of every dict, so that equal bodies are serialized to
+    the same bytes, as the shard request cache expects"""
+    if isinstance(value, dict):
+        return {key: canonical_body(value[key]) for key in sorted(value)}
+    if isinstance(value, list | tuple):
+        return [canonical_body(item) for item in value]
+    return value
+
+
+def fingerprint(index, body):
+    if isinstance(index, str):
+        index = [index]
+    payload = json.dumps(
+        {"index": index, "body": body},
+        sort_keys=True,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def cluster_key(using):
+    """Identifies the cluster of a connection (an alias or a client), the
+    same in every process: the URLs of the nodes of its client, or its
+    alias"""
+    transport = getattr(get_connection(using), "transport", None)
+    if transport is not None:
+        return sorted(node.base_url for node in transport.node_pool.all())
+    return using if isinstance(using, str) else None
+
+
+class ApproximateResult(list):
+    """Lines computed from a sample of the documents. doc_count and Sum
+    values are scaled to the whole set of documents"""
+
+    approximate = True
+
+    def __init__(self, lines, sample, sampled_doc_count=None, scale=None):
+        super().__init__(lines)
+        self.sample = sample
+        self.sampled_doc_count = sampled_doc_count
+        self.scale = scale
+
+
 class FQuery:
-    def __init__(self, search, default_size=None):
+    def __init__(
+        self,
+        search,
+        default_size=None,
+        max_buckets=None,
+        response_format="json",
+        normalize=False,
+        stable_preference=False,
+        plan_sizes=False,
+        probe_cardinality=False,
+        doc_count_errors=False,
+        coalesce=False,
+        cache=None,
+        hedge=None,
+        priority=0,
+    ):
         self.search = search
 
         if default_size == 0:
             default_size = 2**31 - 1
         self.default_size = default_size
+        self.max_buckets = max_buckets
+
+        if response_format not in RESPONSE_FORMATS:
+            raise ConfigurationError(
+                f"Unsupported response format {response_format}, "
+                f"expected one of {', '.join(RESPONSE_FORMATS)}"
+            )
+        self.response_format = response_format
+        self.normalize = normalize
+        self.stable_preference = stable_preference
+        self.plan_sizes = plan_sizes or probe_cardinality
+        self.probe_cardinality = probe_cardinality
+        self.doc_count_errors = doc_count_errors
+        self.coalesce = coalesce
+        self.cache = cache
+        self.hedge = hedge
+        self.priority = priority
 
         self._expressions = {}
         self._group_by = []
         self._order_by = {}
+        self._having = []
+        self._level_orders = {}
+        self._page = None  # Only set on the copies evaluating a page
+        self._page_cursors = {}
         self._computed_order = None
+        self._plan = None
+        self._key_to_field = None  # Only set on prepared queries
+        self._partition = None
+        self._size_plan = None
+
+    @classmethod
+    def from_model(cls, model, **options):
+        """A FQuery on the index of a Model, through its connection, see
+        fiqs.connections"""
+        search = Search(using=model.get_connection(), index=model.get_index())
+        return cls(search, **options)
 
     def values(self, *expressions, **named_expressions):
         # /!\ named_expressions may not be correctly ordered
@@ -45,6 +287,7 @@ class FQuery:
         exps.update(named_expressions)
         self._expressions.update(exps)
         self._computed_order = None  # invalidate cached order when expressions change
+        self._plan = None
 
         self._check_exps_for_computed_are_present()
 
@@ -52,45 +295,291 @@ class FQuery:
 
     def group_by(self, *args):
         self._group_by += args
+        self._size_plan = None
 
         self._check_nested_parents_are_present()
 
         return self
 
-    def order_by(self, order_dict):
-        self._order_by.update(order_dict)
+    def order_by(self, order_dict, level=None, limit=None):
+        """Without level nor limit, order_dict is used as is as the order of
+        the terms aggregations.
+
+        Otherwise, order the buckets of a group_by level (the last one by
+        default) by keys of values, expressions, `_key` or `_count`, each
+        one `asc` or `desc`, and only keep the first `limit` buckets"""
+        if level is None and limit is None and all(
+            isinstance(key, str) and not self._is_computed(key) for key in order_dict
+        ):
+            self._order_by.update(order_dict)
+            return self
+
+        if limit is not None and limit < 1:
+            raise ConfigurationError(f"Limit must be positive, got {limit}")
+
+        self._level_orders[level] = {
+            "order": self._parse_order(order_dict),
+            "limit": limit,
+        }
 
         return self
 
-    def eval(self, flat=True, fill_missing_buckets=True, add_others_line=False):
-        # Raise if computed fields are present, and we are not in flat mode
-        if not flat:
-            for expression in self._expressions.values():
-                if expression.is_computed():
-                    raise ConfigurationError(
-                        "Cannot use computed fields in non-flat mode"
-                    )
+    def having(self, expression, level=None, **lookups):
+        """Only keep the buckets of a group_by level (the last one by default)
+        whose value for the expression (or the key of a value) matches every
+        lookup: gt, gte, lt or lte. Buckets are pruned by Elasticsearch, in a
+        bucket_selector aggregation"""
+        if not lookups or set(lookups) - set(HAVING_OPERATORS):
+            raise ConfigurationError(
+                f"Invalid lookups {', '.join(lookups) or 'none'}, "
+                f"expected some of {', '.join(HAVING_OPERATORS)}"
+            )
+        if isinstance(expression, ReverseNested):
+            raise ConfigurationError(
+                "Cannot filter on a reverse nested aggregation, use the key "
+                "of one of its values"
+            )
 
-        search = self._configure_search()
-        result = search.execute()
+        key = expression if isinstance(expression, str) else str(expression)
+        if not isinstance(expression, str) and key not in self._expressions:
+            if not expression.is_doc_count():
+                self.values(expression)
 
-        if flat:
-            lines = self._flatten_result(
-                result,
+        for lookup, value in lookups.items():
+            self._having.append((level, key, lookup, value))
+
+        return self
+
+    def eval(
+        self,
+        flat=True,
+        fill_missing_buckets=True,
+        add_others_line=False,
+        profile=False,
+        es_profile=False,
+        sample=None,
+        deadline=None,
+        opaque_id=None,
+    ):
+        deadline = get_deadline(deadline)
+        if deadline is not None and opaque_id is None:
+            opaque_id = new_opaque_id()
+        self._check_flat_mode(flat)
+        self._check_partition(flat, add_others_line, es_profile)
+        self._check_sample(flat, sample)
+        profile, profiler = self._get_profile(profile, es_profile)
+
+        with profiler:
+            with profiler.stage("build"):
+                if self.max_buckets is not None:
+                    self._check_bucket_budget()
+
+                if flat:
+                    search = self.search
+                    body = self._build_body()
+                else:
+                    # We need the elasticsearch.dsl aggregations to build the Response
+                    search = self._configure_search()
+                    body = search.to_dict()
+
+            result = self._run(
+                search,
+                search._index,
+                body,
+                profiler,
+                flat=flat,
+                fill_missing_buckets=fill_missing_buckets,
                 add_others_line=add_others_line,
-                remove_nested_aggregations=self._contains_nested_expressions(),
+                es_profile=es_profile,
+                sample=sample,
+                deadline=deadline,
+                opaque_id=opaque_id,
             )
 
-            if fill_missing_buckets:
-                lines = self._add_missing_lines(lines)
+        self._record_metrics(profiler)
+        if profile:
+            return result, profile
+        return result
+
+    async def aeval(self, **kwargs):
+        """eval, in a thread. If the calling task is cancelled, the search is
+        cancelled in Elasticsearch too"""
+        opaque_id = kwargs.pop("opaque_id", None) or new_opaque_id()
+        try:
+            return await asyncio.to_thread(self.eval, opaque_id=opaque_id, **kwargs)
+        except asyncio.CancelledError:
+            await asyncio.to_thread(self._cancel_search, self.search, opaque_id)
+            raise
+
+    def page(self, number, per_page=50, order_by=None, profile=False):
+        """Evaluate a page of the lines, pages being numbered from 1.
+
+        With a single group_by level, the page is cut by a bucket_sort
+        aggregation, and order_by accepts the same keys as the one of
+        FQuery.order_by. With several levels, pages come from a composite
+        aggregation, which can only be ordered by the keys of the group_by:
+        the cursor of each page is kept, in the `cache` of the FQuery too
+        when it has one, so that the next pages do not walk through the
+        previous ones again. Pages of a level limited by order_by stop at the
+        limit. Missing buckets are not filled"""
+        if number < 1 or per_page < 1:
+            raise ConfigurationError(
+                f"Invalid page {number} of {per_page} lines, both must be positive"
+            )
+        if not self._group_by:
+            raise ConfigurationError("Cannot page through a query without group_by")
+        if self._partition is not None:
+            raise ConfigurationError("Cannot page through partitions")
+
+        if len(self._group_by) == 1:
+            # Parsed first, the expressions we order by are added to the values
+            order = self._parse_order(order_by or {})
+            level_order = self._level_orders_by_idx().get(0)
+            limit = level_order["limit"] if level_order else None
+            start = (number - 1) * per_page
+            if limit is not None:
+                if start >= limit:
+                    return self._empty_page(profile)
+                per_page = min(per_page, limit - start)
+
+            fquery = copy.copy(self)
+            fquery._level_orders = dict(self._level_orders)
+            if order_by is not None or not fquery._level_orders:
+                fquery._level_orders = {None: {"order": order, "limit": limit}}
+            fquery._page = {"from": start, "size": per_page}
+            return fquery.eval(fill_missing_buckets=False, profile=profile)
+
+        return self._composite_page(number, per_page, order_by or {}, profile)
+
+    def _empty_page(self, profile):
+        profile, profiler = self._get_profile(profile, False)
+        with profiler:
+            pass
+        self._record_metrics(profiler)
+        if profile:
+            return [], profile
+        return []
+
+    async def subscribe(self, window, every, filters=None, clock=utcnow):
+        """Asynchronous iterator over the lines of a rolling window (a
+        timedelta) of the first DateHistogram of the group_by, refreshed
+        every `every` seconds (or timedelta).
+
+        Only the buckets still open at the previous refresh are queried
+        again, closed buckets are kept, and buckets leaving the window are
+        dropped. Requests run in a thread, not to block the event loop"""
+        histogram = self._subscription_histogram()
+        template = self.prepare(time_field=histogram.field)
+        rolling_window = RollingWindow(histogram, window)
+        if isinstance(every, timedelta):
+            every = every.total_seconds()
 
-            return lines
-        else:
-            return result
+        while True:
+            now = clock()
+            since = rolling_window.since(now)
+            lines = await asyncio.to_thread(
+                template.eval,
+                filters=list(filters or ()),
+                min=since,
+                max=now,
+            )
+            rolling_window.update(lines, since, now)
+
+            yield rolling_window.lines()
+            await asyncio.sleep(every)
+
+    def fingerprint(self):
+        """Identifies the request sent to Elasticsearch: two FQuery objects
+        with the same fingerprint send the same request"""
+        body = self._build_body()
+        if self.normalize:
+            body = canonical_body(body)
+        return fingerprint(self.search._index, body)
+
+    def shape(self):
+        """Identifies the shape of the query, its values and group_by,
+        whatever its filters, indices and bounds"""
+        shape = {
+            "values": sorted(self._expressions),
+            "group_by": [str(field_or_exp) for field_or_exp in self._group_by],
+        }
+        payload = json.dumps(shape, separators=(",", ":"))
+        return hashlib.sha1(payload.encode()).hexdigest()[:12]
+
+    def partition(
+        self, field, num_partitions=None, partition_size=10000, max_workers=4
+    ):
+        """Split the terms aggregation of a group_by field into partitions,
+        evaluated concurrently. By default, the number of partitions is
+        computed from a cardinality estimate of the field, so that each
+        partition holds about partition_size terms"""
+        if (
+            not isinstance(field, Field)
+            or isinstance(field, GroupedField | NestedField)
+            or field.is_range()
+            or field.get_parent_field()
+        ):
+            raise ConfigurationError(
+                f"Cannot partition {field!r}, only non nested terms aggregations can be"
+            )
+
+        self._partition = {
+            "field": field,
+            "num_partitions": num_partitions,
+            "partition_size": partition_size,
+            "max_workers": max_workers,
+        }
+
+        return self
+
+    def prepare(self, time_field=None):
+        """Freeze the query, to evaluate it many times with different
+        filters, time bounds or indices. See PreparedFQuery"""
+        return PreparedFQuery(self, time_field=time_field)
+
+    def explain(self, fill_missing_buckets=True):
+        """Describe the request without sending it: its body, an upper bound of
+        the number of buckets per group_by level, and the size of the result"""
+        body = self._build_body()
+        levels = self._estimate_buckets()
+
+        return {
+            "body": body,
+            "levels": levels,
+            "total_buckets": self._estimate_total_buckets(levels),
+            "lines": self._estimate_lines(levels, fill_missing_buckets),
+            "response_size": self._estimate_response_size(levels),
+        }
 
     ################
     # Internal API #
     ################
+    def _subscription_histogram(self):
+        histogram = next(
+            (
+                field_or_exp
+                for field_or_exp in self._group_by
+                if isinstance(field_or_exp, DateHistogram)
+            ),
+            None,
+        )
+        if histogram is None:
+            raise ConfigurationError("Cannot subscribe without a DateHistogram")
+
+        histogram.agg_params()  # Sets the interval
+        if (
+            isinstance(histogram, AutoDateHistogram)
+            or not is_interval_handled(histogram.interval)
+            or "time_zone" in histogram.params
+        ):
+            # We must know the buckets, to tell closed buckets from open ones
+            raise ConfigurationError(
+                f"Cannot subscribe to a DateHistogram with interval "
+                f"{histogram.interval}, whose buckets fiqs cannot compute"
+            )
+
+        return histogram
+
     def _check_exps_for_computed_are_present(self):
         queue = [exp for exp in self._expressions.values() if exp.is_computed()]
         while queue:
@@ -135,62 +624,1551 @@ class FQuery:
             for idx in indices:
                 self._group_by.insert(idx, nested_fields_to_add[idx])
 
+    def _build_body(self):
+        """Build the request body as plain dicts, straight from the plan.
+        It is the same as _configure_search().to_dict(), only faster"""
+        body = self.search.to_dict()
+
+        aggs = self._build_aggs()
+        if aggs:
+            body.setdefault("aggs", {}).update(aggs)
+
+        return body
+
+    def _build_aggs(self):
+        aggs = self._build_values_aggs()
+        having = self._having_by_idx()
+
+        # We build the aggregations from the deepest level up
+        for idx in reversed(range(len(self._group_by))):
+            params = self._group_by_params(idx, self._group_by[idx])
+            agg = agg_dict(params)
+            aggs = dict(aggs, **self._pipeline_aggs(idx, having))
+            if aggs:
+                agg["aggs"] = aggs
+            aggs = {params["name"]: agg}
+
+        return aggs
+
+    def _build_values_aggs(self):
+        # Aggregations of the last group_by level
+        metrics, reverse_nested, _ = self._plan_values()
+
+        aggs = {}
+        for key, expression in metrics.items():
+            aggs[key] = agg_dict(expression.metric_params())
+
+        for expression, path_metrics in reverse_nested.values():
+            params = expression.reverse_agg_params()
+            reverse_nested_agg = agg_dict(params)
+            if path_metrics:
+                reverse_nested_agg["aggs"] = {
+                    key: agg_dict(nested_expression.metric_params())
+                    for key, nested_expression in path_metrics.items()
+                }
+            aggs[params["name"]] = reverse_nested_agg
+
+        return aggs
+
     def _configure_search(self):
-        agg = self._configure_aggregations()
+        # We work on a copy, so that the FQuery can be evaluated several times
+        search = self.search._clone()
+        agg = self._configure_aggregations(search)
         self._configure_values(agg)
 
-        return self.search
+        return search
 
-    def _configure_aggregations(self):
-        current_agg = self.search.aggs
-        last_idx = len(self._group_by) - 1
+    def _configure_aggregations(self, search):
+        current_agg = search.aggs
+        having = self._having_by_idx()
 
         for idx, field_or_exp in enumerate(self._group_by):
-            if isinstance(field_or_exp, Aggregate):
-                params = field_or_exp.agg_params()
+            params = self._group_by_params(idx, field_or_exp)
+            current_agg = current_agg.bucket(**params)
 
-            elif isinstance(field_or_exp, NestedField):
-                params = field_or_exp.nested_params()
+            for name, agg in self._pipeline_aggs(idx, having).items():
+                ((agg_type, agg_params),) = agg.items()
+                if agg_type in PIPELINE_AGGREGATIONS:
+                    current_agg.pipeline(name, agg_type, **agg_params)
+                else:
+                    current_agg.metric(name, agg_type, **agg_params)
 
-            elif field_or_exp.is_range():
-                params = field_or_exp.range_params()
+        return current_agg
 
-            elif isinstance(field_or_exp, Field):
-                params = field_or_exp.bucket_params()
-                if not isinstance(field_or_exp, GroupedField) and self.default_size:
-                    params.setdefault("size", self.default_size)
+    def _pipeline_aggs(self, idx, having):
+        """Aggregations pruning and ordering the buckets of a group_by level,
+        with the hidden metrics they need"""
+        aggs = {}
+        if idx in having:
+            aggs.update(self._having_aggs(idx, having[idx]))
+        if self._level_orders:
+            aggs.update(self._order_params(idx)[1])
+        return aggs
+
+    def _parse_order(self, order_dict):
+        order = []
+        for key, direction in order_dict.items():
+            if direction not in ORDER_DIRECTIONS:
+                raise ConfigurationError(
+                    f"Invalid direction {direction!r}, expected asc or desc"
+                )
+            if not isinstance(key, str):
+                expression, key = key, str(key)
+                if key not in self._expressions and not expression.is_doc_count():
+                    self.values(expression)
+            order.append((key, direction))
 
+        return order
+
+    def _is_computed(self, key):
+        expression = self._expressions.get(key)
+        return expression is not None and expression.is_computed()
+
+    def _legacy_order(self):
+        # Identical metrics are sent once, under the key of the first one
+        _, _, aliases = self._plan_values()
+        return {aliases.get(key, key): order for key, order in self._order_by.items()}
+
+    def _level_idx(self, level):
+        # Index of a group_by level, the last one by default
+        if level is None:
+            return len(self._group_by) - 1
+        if level in self._group_by:
+            return self._group_by.index(level)
+        return None
+
+    def _level_orders_by_idx(self):
+        orders = {}
+        for level, level_order in self._level_orders.items():
+            idx = self._level_idx(level)
+            if idx is None:
+                raise ConfigurationError(f"Cannot order {level!r}, not in the group_by")
+            orders[idx] = level_order
+
+        return orders
+
+    def _having_by_idx(self):
+        having = {}
+        for level, key, lookup, value in self._having:
+            idx = self._level_idx(level)
+            if idx is None:
+                raise ConfigurationError(
+                    f"Cannot use having on {level!r}, not in the group_by"
+                )
+            if idx < 0:
+                raise ConfigurationError("Cannot use having without group_by")
+            having.setdefault(idx, []).append((key, lookup, value))
+
+        return having
+
+    def _order_params(self, idx):
+        """Compile the order of a group_by level to the order and size of its
+        terms aggregation, or to a bucket_sort aggregation when terms cannot
+        order by its keys. Returns the params to update, and the aggregations
+        to add to the level (helper metrics, bucket_script and bucket_sort)"""
+        level_order = self._level_orders_by_idx().get(idx)
+        if level_order is None:
+            return {}, {}
+
+        field_or_exp = self._group_by[idx]
+        if isinstance(field_or_exp, NestedField | ReverseNested):
+            raise ConfigurationError(f"Cannot order the single bucket {field_or_exp!r}")
+
+        bucket_paths = self._level_bucket_paths(idx)
+        level_key = calc_group_by_keys([field_or_exp])[0]
+
+        hidden = {}
+        sort = []
+        for key, direction in level_order["order"]:
+            if key in ("_key", level_key):
+                path = "_key"
+            elif key == "_count":
+                path = "_count"
+            elif key in bucket_paths:
+                path = bucket_paths[key]
             else:
-                raise NotImplementedError
+                expression = self._expressions.get(key)
+                if expression is None or not expression.is_computed():
+                    raise ConfigurationError(
+                        f"Cannot order the {level_key} buckets by {key}"
+                    )
+
+                # Computed expressions are computed by a bucket_script
+                buckets_path = {}
+                path = f"{HIDDEN_AGGREGATION_PREFIX}{key}"
+                hidden[path] = {
+                    "bucket_script": {
+                        "buckets_path": buckets_path,
+                        "script": self._script_source(key, bucket_paths, buckets_path),
+                    }
+                }
+            sort.append((path, direction))
+
+        paths = {path for path, _ in sort}
+        for agg in hidden.values():
+            paths.update(agg["bucket_script"]["buckets_path"].values())
+        hidden.update(self._hidden_metrics(idx, paths))
+
+        limit = level_order["limit"]
+        page = self._page if idx == len(self._group_by) - 1 else None
+        terms_level = (
+            isinstance(field_or_exp, Field)
+            and not isinstance(field_or_exp, GroupedField)
+            and not field_or_exp.is_range()
+        )
+        params = {}
+        bucket_sort = {}
+        if terms_level and not any("bucket_script" in agg for agg in hidden.values()):
+            if sort:
+                order = [{path: direction} for path, direction in sort]
+                params["order"] = order[0] if len(order) == 1 else order
+            if limit is not None and idx in self._having_by_idx():
+                # Limited after the bucket_selector pruned the buckets
+                bucket_sort["size"] = limit
+            elif limit is not None:
+                params["size"] = limit
+        else:
+            if sort:
+                bucket_sort["sort"] = [
+                    {path: {"order": direction}} for path, direction in sort
+                ]
+            if limit is not None:
+                bucket_sort["size"] = limit
+
+        if page is not None:
+            bucket_sort.update(page)
+            if terms_level:
+                # The terms aggregation must return the buckets of the page
+                size = (
+                    params.get("size")
+                    or field_or_exp.bucket_params().get("size")
+                    or self.default_size
+                    or ES_DEFAULT_TERMS_SIZE
+                )
+                params["size"] = max(size, page["from"] + page["size"])
+
+        if bucket_sort:
+            hidden[BUCKET_SORT_AGGREGATION] = {"bucket_sort": bucket_sort}
+
+        return params, hidden
+
+    def _composite_page(self, number, per_page, order_dict, profile):
+        if self._having or self._level_orders:
+            raise ConfigurationError(
+                "Cannot page through several levels with having or ordered levels"
+            )
+        profile, profiler = self._get_profile(profile, False)
+
+        with profiler:
+            with profiler.stage("build"):
+                sources = self._composite_sources(dict(self._parse_order(order_dict)))
+                page_agg = {"composite": {"sources": sources, "size": per_page}}
+                values_aggs = self._build_values_aggs()
+                if values_aggs:
+                    page_agg["aggs"] = values_aggs
+
+                body = self.search.to_dict()
+                body["aggs"] = {PAGE_AGGREGATION: page_agg}
+
+            index = self.search._index
+            # Cursors of other clusters, in a shared cache, are not ours
+            cluster = cluster_key(self.search._using)
+            page_key = fingerprint(index, {"cluster": cluster, "body": body})
+            cursors = self._page_cursors.setdefault(page_key, {1: None})
+            if number not in cursors and self.cache is not None:
+                # Another FQuery, maybe in another process, may know it
+                after = self._cached_cursor(page_key, number)
+                if after is not None:
+                    cursors[number] = after
+            after = self._page_cursor(
+                cursors, page_key, index, body, number, per_page, profiler
+            )
+
+            lines = []
+            if after is not False:
+                if after is not None:
+                    page_agg["composite"]["after"] = after
+
+                response, result = self._request(self.search, index, body, profiler)
+                profiler.record_response(response, result)
+
+                page_result = result["aggregations"][PAGE_AGGREGATION]
+                buckets = page_result["buckets"]
+                if len(buckets) == per_page and "after_key" in page_result:
+                    self._keep_cursor(
+                        cursors, page_key, number + 1, page_result["after_key"]
+                    )
+
+                if buckets:
+                    names = [next(iter(source)) for source in sources]
+                    result = dict(
+                        result,
+                        aggregations=self._nest_composite_buckets(buckets, names),
+                    )
+                    lines = self._flatten_result(
+                        result,
+                        profile=profiler,
+                        remove_nested_aggregations=False,
+                    )
+
+        self._record_metrics(profiler)
+        if profile:
+            return lines, profile
+        return lines
+
+    def _composite_sources(self, order):
+        sources = []
+        for idx, field_or_exp in enumerate(self._group_by):
+            if isinstance(field_or_exp, GroupedField | NestedField | ReverseNested):
+                raise ConfigurationError(
+                    f"Cannot page through {field_or_exp!r} with other levels"
+                )
 
-            if isinstance(field_or_exp, Field):
-                # /!\ TODO: not working with two group_by
-                if self._order_by and (
-                    idx == last_idx or set(self._order_by) == {"_count"}
+            params = self._group_by_params(idx, field_or_exp)
+            agg_type = params["agg_type"]
+            if agg_type not in COMPOSITE_SOURCE_PARAMS:
+                raise ConfigurationError(
+                    f"Cannot page through {field_or_exp!r} with other levels"
+                )
+
+            source = {
+                key: params[key]
+                for key in COMPOSITE_SOURCE_PARAMS[agg_type]
+                if key in params
+            }
+            direction = order.pop(params["name"], None)
+            if direction is not None:
+                source["order"] = direction
+            sources.append({params["name"]: {agg_type: source}})
+
+        if order:
+            raise ConfigurationError(
+                "Pages of several levels can only be ordered by the keys of the "
+                f"group_by, not by {', '.join(order)}"
+            )
+
+        return sources
+
+    def _page_cursor(
+        self, cursors, page_key, index, body, number, per_page, profiler
+    ):
+        """After key of the page, walking from the closest known cursor, or
+        False if the page is after the last one"""
+        known = max(page for page in cursors if page <= number)
+        after = cursors[known]
+        composite = body["aggs"][PAGE_AGGREGATION]["composite"]
+
+        with profiler.stage("cursor"):
+            while known < number:
+                # We only need the keys: no metric, and many pages at once
+                nb_pages = min(number - known, max(COMPOSITE_MAX_SIZE // per_page, 1))
+                walk = dict(composite, size=nb_pages * per_page)
+                if after is not None:
+                    walk["after"] = after
+                walk_body = dict(body, aggs={PAGE_AGGREGATION: {"composite": walk}})
+
+                _, result = self._request(self.search, index, walk_body)
+                walk_result = result["aggregations"][PAGE_AGGREGATION]
+                if (
+                    len(walk_result["buckets"]) < walk["size"]
+                    or "after_key" not in walk_result
                 ):
-                    params["order"] = self._order_by
+                    return False
+
+                known += nb_pages
+                after = walk_result["after_key"]
+                self._keep_cursor(cursors, page_key, known, after)
+
+        return after
+
+    def _cursor_cache_key(self, page_key, number):
+        return f"{page_key}-page-{number}"
+
+    def _cached_cursor(self, page_key, number):
+        cached = self.cache.get(self._cursor_cache_key(page_key, number))
+        if cached is None:
+            return None
+        return json.loads(cached[1])
+
+    def _keep_cursor(self, cursors, page_key, number, after):
+        cursors[number] = after
+        if self.cache is not None:
+            self.cache.set(
+                self._cursor_cache_key(page_key, number),
+                "json",
+                json.dumps(after).encode(),
+            )
 
-            current_agg = current_agg.bucket(**params)
+    def _nest_composite_buckets(self, buckets, names):
+        """Nest the buckets of a composite aggregation, as if each source was
+        an aggregation of its own. Composite buckets are sorted by their
+        sources, the buckets of a parent key follow each other"""
+        aggregations = {}
+        last_idx = len(names) - 1
+
+        for bucket in buckets:
+            node = aggregations
+            for idx, name in enumerate(names):
+                level_buckets = node.setdefault(name, {"buckets": []})["buckets"]
+                key = bucket["key"][name]
+                if idx == last_idx:
+                    leaf = {k: v for k, v in bucket.items() if k != "key"}
+                    leaf["key"] = key
+                    level_buckets.append(leaf)
+                    break
+
+                if not level_buckets or level_buckets[-1]["key"] != key:
+                    level_buckets.append({"key": key, "doc_count": 0})
+                node = level_buckets[-1]
+                node["doc_count"] += bucket["doc_count"]
+
+        return aggregations
+
+    def _hidden_metrics(self, idx, paths):
+        # Metrics are only sent in the last level, we add the ones the
+        # pipelines of an upper level use to this level
+        hidden = {}
+        if idx < len(self._group_by) - 1:
+            metrics, _, _ = self._plan_values()
+            for key, expression in metrics.items():
+                path = f"{HIDDEN_AGGREGATION_PREFIX}{key}"
+                if path in paths:
+                    hidden[path] = agg_dict(expression.metric_params())
+
+        return hidden
+
+    def _level_bucket_paths(self, idx):
+        # Buckets paths of the values in the buckets of a group_by level
+        if idx == len(self._group_by) - 1:
+            return self._bucket_paths()
+
+        if self._contains_nested_expressions():
+            # A metric of an upper level would not be in the right nested context
+            return {"doc_count": "_count"}
+
+        metrics, _, aliases = self._plan_values()
+        paths = {"doc_count": "_count"}
+        for key, expression in self._expressions.items():
+            if expression.is_doc_count():
+                paths[key] = "_count"
+        for key in metrics:
+            paths[key] = f"{HIDDEN_AGGREGATION_PREFIX}{key}"
+        for alias, key in aliases.items():
+            if key in paths:
+                paths[alias] = paths[key]
+
+        return paths
+
+    def _group_by_params(self, idx, field_or_exp):
+        if isinstance(field_or_exp, Aggregate):
+            params = field_or_exp.agg_params()
+
+        elif isinstance(field_or_exp, NestedField):
+            params = field_or_exp.nested_params()
+
+        elif field_or_exp.is_range():
+            params = field_or_exp.range_params()
+
+        elif isinstance(field_or_exp, Field):
+            params = field_or_exp.bucket_params()
+            if not isinstance(field_or_exp, GroupedField) and self.default_size:
+                params.setdefault("size", self.default_size)
+            if self.doc_count_errors and idx in self._terms_levels():
+                params["show_term_doc_count_error"] = True
+            if self.plan_sizes and idx in self._plan_sizes():
+                level_plan = self._plan_sizes()[idx]
+                params.update(
+                    {
+                        key: level_plan[key]
+                        for key in ("size", "shard_size", "collect_mode")
+                        if level_plan[key] is not None
+                    }
+                )
 
-        return current_agg
+        else:
+            raise NotImplementedError
+
+        if isinstance(field_or_exp, Field):
+            # Use order_by with a level to order other levels
+            last_idx = len(self._group_by) - 1
+            if self._order_by and (
+                idx == last_idx or set(self._order_by) == {"_count"}
+            ):
+                params["order"] = self._legacy_order()
+
+        if self._level_orders:
+            params.update(self._order_params(idx)[0])
+
+        if isinstance(field_or_exp, DateHistogram) and self.normalize:
+            self._round_extended_bounds(field_or_exp, params)
+
+        return params
+
+    def _round_extended_bounds(self, histogram, params):
+        # Rounded bounds give the same buckets, and the same body for all the
+        # time bounds falling in the same buckets
+        if "extended_bounds" in params:
+            params["extended_bounds"] = {
+                key: histogram.round_date(value)
+                for key, value in params["extended_bounds"].items()
+            }
+
+    def _terms_levels(self):
+        return {
+            idx: field_or_exp
+            for idx, field_or_exp in enumerate(self._group_by)
+            if isinstance(field_or_exp, Field)
+            and not isinstance(field_or_exp, GroupedField | NestedField)
+            and not field_or_exp.is_range()
+        }
+
+    def _plan_sizes(self):
+        """Size the terms aggregations from what we know of their fields: the
+        choices, or a cardinality probe. Outer terms aggregations with a small
+        size are collected breadth first."""
+        if self._size_plan is not None:
+            return self._size_plan
+
+        terms = self._terms_levels()
+
+        cardinalities = {}
+        if self.probe_cardinality:
+            cardinalities = self._probe_cardinalities(
+                [field for field in terms.values() if not field.choices]
+            )
+
+        plan = {}
+        last_idx = len(self._group_by) - 1
+        for idx, field in terms.items():
+            size = field.bucket_params().get("size", self.default_size)
+            size = size or ES_DEFAULT_TERMS_SIZE
+
+            bound, source = None, None
+            if field.choices:
+                bound, source = len(field.choice_keys()), "choices"
+            elif field.get_storage_field() in cardinalities:
+                cardinality = cardinalities[field.get_storage_field()]
+                bound = max(math.ceil(cardinality * CARDINALITY_MARGIN), 1)
+                source = "cardinality"
+
+            level_plan = {
+                "size": None,
+                "shard_size": None,
+                "collect_mode": None,
+                "source": None,
+            }
+            if bound is not None and bound < size:
+                # Every term fits, shards do not need to return more
+                size = bound
+                level_plan.update(size=bound, source=source)
+                if "shard_size" not in field.data:
+                    level_plan["shard_size"] = bound
+
+            # Sub aggregations are only collected for the top buckets
+            if (
+                idx < last_idx
+                and size <= BREADTH_FIRST_MAX_SIZE
+                and (bound is None or size < bound)
+            ):
+                level_plan["collect_mode"] = "breadth_first"
+
+            plan[idx] = level_plan
+
+        self._size_plan = plan
+        return plan
+
+    def _probe_cardinalities(self, fields):
+        es = get_connection(self.search._using)
+        index = self.search._index
+        cache_key = (id(es), tuple(index) if index else None)
+        now = time.monotonic()
+
+        cardinalities = {}
+        with _cardinality_cache_lock:
+            for field in fields:
+                storage_field = field.get_storage_field()
+                cached = _cardinality_cache.get(cache_key + (storage_field,))
+                if cached is not None and now - cached[1] < CARDINALITY_CACHE_TTL:
+                    cardinalities[storage_field] = cached[0]
+
+        missing = [
+            field for field in fields if field.get_storage_field() not in cardinalities
+        ]
+        if not missing:
+            return cardinalities
+
+        # A single request for all fields, over the whole indices so that it
+        # bounds any query, and can be cached
+        aggs = {}
+        for idx, field in enumerate(missing):
+            agg = {
+                "cardinality": {
+                    "field": field.get_storage_field(),
+                    "precision_threshold": 40000,
+                }
+            }
+            parent_field = field.get_parent_field()
+            if parent_field:
+                agg = {
+                    "nested": {"path": parent_field.get_storage_field()},
+                    "aggs": {"cardinality": agg},
+                }
+            aggs[f"cardinality_{idx}"] = agg
+
+        response = self._limited(
+            lambda: es.search(index=index, body={"size": 0, "aggs": aggs})
+        )
+        result = response.body
+
+        with _cardinality_cache_lock:
+            for idx, field in enumerate(missing):
+                node = result["aggregations"][f"cardinality_{idx}"]
+                if "cardinality" in node:
+                    node = node["cardinality"]
+                storage_field = field.get_storage_field()
+                cardinalities[storage_field] = node["value"]
+                _cardinality_cache[cache_key + (storage_field,)] = (node["value"], now)
+
+        return cardinalities
+
+    def _estimate_buckets(self):
+        levels = []
+        nb_parent_buckets = 1
+
+        for idx, field_or_exp in enumerate(self._group_by):
+            params = self._group_by_params(idx, field_or_exp)
+            nb_buckets = self._estimate_level_buckets(field_or_exp, params)
+            nb_parent_buckets = product_or_none([nb_parent_buckets, nb_buckets])
+
+            levels.append(
+                {
+                    "key": params["name"],
+                    "buckets": nb_buckets,
+                    "total_buckets": nb_parent_buckets,
+                    "filled_buckets": self._estimate_level_enum(
+                        field_or_exp, nb_buckets
+                    ),
+                    "size_plan": (
+                        self._plan_sizes().get(idx) if self.plan_sizes else None
+                    ),
+                }
+            )
+
+        return levels
+
+    def _estimate_level_buckets(self, field_or_exp, params):
+        # Upper bound of the number of buckets, for each parent bucket
+        # None means we cannot tell
+        if isinstance(field_or_exp, NestedField | ReverseNested):
+            return 1
+
+        if isinstance(field_or_exp, Aggregate):
+            choice_keys = field_or_exp.choice_keys()
+            if choice_keys is not None:
+                return len(choice_keys)
+
+            # Date histograms whose buckets we cannot enumerate have no
+            # numeric interval
+            if "extended_bounds" in params and not isinstance(
+                field_or_exp, DateHistogram
+            ):
+                bounds = params["extended_bounds"]
+                return int((bounds["max"] - bounds["min"]) // params["interval"]) + 1
+
+            return None
+
+        if field_or_exp.is_range():
+            return len(field_or_exp.choice_keys())
+
+        if isinstance(field_or_exp, GroupedField):
+            return len(field_or_exp.groups)
+
+        size = params.get("size", ES_DEFAULT_TERMS_SIZE)
+        if field_or_exp.choices:
+            return min(size, len(field_or_exp.choices))
+
+        return size
+
+    def _estimate_level_enum(self, field_or_exp, nb_buckets):
+        # Mirrors _get_field_enums: number of keys once missing buckets are filled
+        if isinstance(field_or_exp, NestedField | ReverseNested):
+            return None
+
+        if isinstance(field_or_exp, Aggregate):
+            if field_or_exp.choice_keys() is None and field_or_exp.field.choices:
+                return len(field_or_exp.field.choice_keys())
+            return nb_buckets
+
+        if field_or_exp.choices or field_or_exp.is_range():
+            return len(field_or_exp.choice_keys())
+
+        return nb_buckets
+
+    def _estimate_total_buckets(self, levels):
+        # Elasticsearch counts the buckets of every level against its own limit
+        totals = [level["total_buckets"] for level in levels]
+        if any(total is None for total in totals):
+            return None
+        return sum(totals)
+
+    def _estimate_lines(self, levels, fill_missing_buckets=True):
+        if not levels:
+            return 1
+
+        if not fill_missing_buckets:
+            return levels[-1]["total_buckets"]
+
+        return product_or_none(
+            [
+                level["filled_buckets"]
+                for level, field_or_exp in zip(levels, self._group_by)
+                if not isinstance(field_or_exp, NestedField | ReverseNested)
+            ]
+        )
+
+    def _estimate_response_size(self, levels):
+        metrics, reverse_nested, _ = self._plan_values()
+        metric_keys = list(metrics)
+        for expression, path_metrics in reverse_nested.values():
+            metric_keys.append(expression.reverse_agg_params()["name"])
+            metric_keys += list(path_metrics)
+
+        nb_leaf_buckets = levels[-1]["total_buckets"] if levels else 1
+        total_buckets = self._estimate_total_buckets(levels)
+        if total_buckets is None or nb_leaf_buckets is None:
+            return None
+
+        leaf_size = sum(len(key) + METRIC_RESPONSE_SIZE for key in metric_keys)
+        return total_buckets * BUCKET_RESPONSE_SIZE + nb_leaf_buckets * leaf_size
+
+    def _check_bucket_budget(self):
+        total_buckets = self._estimate_total_buckets(self._estimate_buckets())
+        if total_buckets is None or total_buckets > self.max_buckets:
+            raise TooManyBucketsError(
+                f"Query may return {total_buckets or 'an unbounded number of'} "
+                f"buckets, budget is {self.max_buckets}"
+            )
+
+    def _check_partition(self, flat, add_others_line, es_profile):
+        if self._partition is None:
+            return
+
+        if not flat:
+            raise ConfigurationError("Cannot partition in non-flat mode")
+        if add_others_line:
+            raise ConfigurationError("Cannot add an others line to partitions")
+        if es_profile:
+            raise ConfigurationError("Cannot profile partitions in Elasticsearch")
+
+        idx = self._partition_level()  # Raises if the field is not grouped by
+        level_order = self._level_orders_by_idx().get(idx)
+        if level_order is not None and level_order["limit"] is not None:
+            raise ConfigurationError("Cannot limit the buckets of a partitioned level")
+
+    def _check_flat_mode(self, flat):
+        # Raise if computed fields are present, and we are not in flat mode
+        if not flat:
+            for expression in self._expressions.values():
+                if expression.is_computed():
+                    raise ConfigurationError(
+                        "Cannot use computed fields in non-flat mode"
+                    )
+
+    def _get_profile(self, profile, es_profile):
+        if profile is True:
+            profile = Profile()
+        elif es_profile and not profile:
+            profile = Profile(trace_allocations=False)
+
+        if not profile and get_registry() is not None:
+            # The metrics need the timings, not the allocations
+            return profile, Profile(trace_allocations=False)
+        return profile, profile or NULL_PROFILE
+
+    def _record_metrics(self, profiler):
+        registry = get_registry()
+        if registry is not None and profiler is not NULL_PROFILE:
+            registry.record_eval(self.shape(), self._model_name(), profiler)
+
+    def _model_name(self):
+        for field_or_exp in self._group_by + list(self._expressions.values()):
+            model = getattr(field_or_exp, "model", None)
+            if model is None:
+                model = getattr(getattr(field_or_exp, "field", None), "model", None)
+            if model is not None:
+                return model.__name__
+        return ""
+
+    def _run(
+        self,
+        search,
+        index,
+        body,
+        profiler,
+        flat=True,
+        fill_missing_buckets=True,
+        add_others_line=False,
+        es_profile=False,
+        sample=None,
+        deadline=None,
+        opaque_id=None,
+    ):
+        if es_profile:
+            body["profile"] = True
+        if sample is not None:
+            body = self._sample_body(body, sample)
+        if self._prunes_buckets():
+            # Buckets pruned by Elasticsearch look like empty buckets, we must
+            # not add them back
+            fill_missing_buckets = False
+
+        if self._partition is not None:
+            return self._run_partitions(
+                search,
+                index,
+                body,
+                profiler,
+                fill_missing_buckets=fill_missing_buckets,
+                deadline=deadline,
+                opaque_id=opaque_id,
+            )
+
+        response, result = self._request(
+            search,
+            index,
+            body,
+            profiler,
+            deadline=deadline,
+            opaque_id=opaque_id,
+        )
+        profiler.record_response(response, result)
+
+        if es_profile:
+            profiler.aggregations = parse_es_profile(
+                result.get("profile", {}),
+                self._aggregation_paths(),
+            )
+
+        if not flat:
+            return Response(search, result)
+
+        scale = None
+        if sample is not None:
+            scale = self._sample_scale(result, sample)
+
+        lines = self._flatten_result(
+            result,
+            profile=profiler,
+            scale=scale,
+            add_others_line=add_others_line,
+            remove_nested_aggregations=self._contains_nested_expressions(),
+        )
+
+        if fill_missing_buckets:
+            with profiler.stage("fill_missing_buckets"):
+                nb_lines = len(lines)
+                lines = self._add_missing_lines(lines)
+            profiler.count("filled_lines", len(lines) - nb_lines)
+
+        if sample is not None:
+            sampled_doc_count = None
+            if "aggregations" in result:
+                sampled_doc_count = result["aggregations"][SAMPLE_AGGREGATION][
+                    "doc_count"
+                ]
+            lines = ApproximateResult(lines, sample, sampled_doc_count, scale)
+
+        return lines
+
+    def _prunes_buckets(self):
+        return bool(self._having) or any(
+            level_order["limit"] is not None
+            for level_order in self._level_orders.values()
+        )
+
+    def _check_sample(self, flat, sample):
+        if sample is None:
+            return
+
+        if not flat:
+            raise ConfigurationError("Cannot sample in non-flat mode")
+        if self._partition is not None:
+            raise ConfigurationError("Cannot sample partitions")
+
+        if self._having:
+            # Pruning would compare the thresholds to unscaled values
+            raise ConfigurationError("Cannot sample a query with having predicates")
+
+        if isinstance(sample, bool) or not isinstance(sample, int | float):
+            raise ConfigurationError(f"Invalid sample {sample!r}")
+        if isinstance(sample, float) and not (0 < sample < 0.5 or sample == 1):
+            # Elasticsearch restriction on the random_sampler probability
+            raise ConfigurationError(
+                f"Sampling probability must be in ]0, 0.5[ or 1, got {sample}"
+            )
+        if isinstance(sample, int) and sample < 1:
+            raise ConfigurationError(
+                f"Sample shard size must be positive, got {sample}"
+            )
+
+    def _sample_body(self, body, sample):
+        body = dict(body)
+        if not body.get("aggs"):
+            return body
+
+        if isinstance(sample, float):
+            sampler = {"random_sampler": {"probability": sample}}
+        else:
+            sampler = {"sampler": {"shard_size": sample}}
+            # We need the number of matching documents to scale the results
+            body["track_total_hits"] = True
+
+        body["aggs"] = {SAMPLE_AGGREGATION: dict(sampler, aggs=body["aggs"])}
+        return body
+
+    def _sample_scale(self, result, sample):
+        # Elasticsearch scales random_sampler results itself
+        if isinstance(sample, float) or "aggregations" not in result:
+            return None
+
+        sampled_doc_count = result["aggregations"][SAMPLE_AGGREGATION]["doc_count"]
+        total = result["hits"]["total"]
+        if isinstance(total, dict):
+            total = total["value"]
+
+        if not sampled_doc_count or total <= sampled_doc_count:
+            return None
+        return total / sampled_doc_count
+
+    def _scaled_keys(self):
+        # Keys whose values grow with the number of documents
+        keys = {"doc_count"}
+        for key, expression in self._expressions.items():
+            if isinstance(expression, Sum):
+                keys.add(key)
+            elif isinstance(expression, ReverseNested):
+                prefix = f"reverse_nested_{expression.path}__"
+                keys.add(f"{prefix}doc_count")
+                for nested_key, nested_expression in expression.expressions.items():
+                    if isinstance(nested_expression, Sum):
+                        keys.add(f"{prefix}{nested_key}")
+        return keys
+
+    def _request(
+        self,
+        search,
+        index,
+        body,
+        profiler=NULL_PROFILE,
+        deadline=None,
+        opaque_id=None,
+    ):
+        params = dict(search._params)
+        if self.normalize:
+            body = canonical_body(body)
+            params.setdefault("request_cache", True)
+        if self.stable_preference:
+            # The same request goes to the same shard copies, and their caches
+            params.setdefault("preference", f"fiqs-{fingerprint(index, body)}")
+
+        cache_key = None
+        if self.cache is not None:
+            # Computed before the deadline changes the params
+            cache_key = self._cache_key(search, index, body, params)
+            with profiler.stage("cache"):
+                result = self._cached_result(cache_key)
+            if result is not None:
+                return None, result
+        coalesce_key = None
+        if self.coalesce:
+            # Callers with different deadlines share the request too, but not
+            # with callers without one: its response may be partial
+            coalesce_key = self._coalesce_key(
+                search, index, body, params, deadline is not None
+            )
+
+        options = {}
+        if opaque_id is not None:
+            # Identifies the search task, to cancel it
+            options["opaque_id"] = opaque_id
+        if deadline is not None and deadline <= time.monotonic():
+            raise DeadlineExceededError("Deadline exceeded before the request")
+
+        with profiler.stage("request"):
+            try:
+                if coalesce_key is not None:
+                    response = self._coalesced_execute(
+                        coalesce_key, search, index, body, params, options, deadline
+                    )
+                else:
+                    response = self._send(
+                        search, index, body, params, options, deadline
+                    )
+            except ConnectionTimeout as e:
+                if deadline is None:
+                    # The timeout of the client, not ours
+                    raise
+
+                cancelled = False
+                if opaque_id is not None:
+                    cancelled = self._cancel_search(search, opaque_id)
+                message = "Deadline exceeded"
+                if cancelled:
+                    message += ", the search was cancelled"
+                raise DeadlineExceededError(message) from e
+
+        result = response.body
+        if isinstance(result, bytes | bytearray | memoryview):
+            # The client kept the CBOR payload as is, see fiqs.cbor
+            with profiler.stage("decode"):
+                result = cbor.loads(result)
+
+        if deadline is not None:
+            self._check_complete(result)
+        if cache_key is not None:
+            self._cache_result(cache_key, response, result)
+
+        return response, result
+
+    def _cache_key(self, search, index, body, params):
+        # Clusters sharing a cache do not share their responses
+        return fingerprint(
+            index,
+            {"cluster": cluster_key(search._using), "body": body, "params": params},
+        )
+
+    def _cached_result(self, key):
+        cached = self.cache.get(key)
+        if cached is None:
+            return None
+
+        response_format, payload = cached
+        if response_format == "cbor":
+            return cbor.loads(payload)
+        return json.loads(payload)
+
+    def _cache_result(self, key, response, result):
+        # Partial results must not outlive the request
+        if result.get("timed_out") or result.get("_shards", {}).get("failed"):
+            return
+
+        payload = response.body
+        if isinstance(payload, bytes | bytearray | memoryview):
+            self.cache.set(key, "cbor", bytes(payload))
+        else:
+            self.cache.set(key, "json", json.dumps(result).encode())
+
+    def _coalesce_key(self, search, index, body, params, with_deadline):
+        return (
+            id(get_connection(search._using)),
+            with_deadline,
+            self.response_format,
+            fingerprint(index, body),
+            json.dumps(params, sort_keys=True, default=str),
+        )
+
+    def _coalesced_execute(self, key, search, index, body, params, options, deadline):
+        """Concurrent identical requests share a single Elasticsearch request,
+        see fiqs.coalescing. Callers waiting for another one's request give
+        up at their own deadline"""
+        timeout = None
+        if deadline is not None:
+            timeout = max(deadline - time.monotonic(), 0)
+        return SINGLE_FLIGHT.do(
+            key,
+            lambda: self._send(search, index, body, params, options, deadline),
+            copy=copy_response,
+            timeout=timeout,
+        )
+
+    def _send(self, search, index, body, params, options, deadline=None):
+        if self.hedge is not None:
+            return self._hedged_execute(
+                search, index, body, params, options, deadline
+            )
+        return self._execute(search, index, body, params, options, deadline)
+
+    def _hedged_execute(self, search, index, body, params, options, deadline=None):
+        """If the request did not answer after the delay of the hedging
+        policy, send it again with another preference, so that it goes to
+        other shard copies. The first response wins, the other search is
+        cancelled. See fiqs.hedging"""
+        policy = self.hedge
+        policy.count_request()
+        delay = policy.delay()
+        start = time.monotonic()
+
+        if delay is None or not policy.within_budget():
+            response = self._execute(search, index, body, params, options, deadline)
+            policy.record_latency(time.monotonic() - start)
+            return response
+
+        # We need an X-Opaque-Id to cancel the slower search
+        options = dict(options or {})
+        options.setdefault("opaque_id", new_opaque_id())
+        race = HedgeRace()
+        timer = policy.schedule(
+            delay,
+            self._send_hedge,
+            race,
+            search,
+            index,
+            body,
+            params,
+            options,
+            deadline,
+        )
+
+        # The request is sent by the calling thread, only the hedge waits for
+        # the hedging pool
+        try:
+            response = self._execute(search, index, body, params, options, deadline)
+        except Exception:
+            timer.set()
+            if race.finish_request(failed=True) != "won":
+                raise
+        else:
+            timer.set()
+            if race.finish_request() == "lost":
+                hedge_opaque_id = f"{options['opaque_id']}-hedge"
+                policy.submit(self._cancel_search, search, hedge_opaque_id)
+
+        if race.hedge == "won":
+            policy.count_win()
+            response = race.hedge_response
+        policy.record_latency(time.monotonic() - start)
+        return response
+
+    def _send_hedge(self, race, search, index, body, params, options, deadline):
+        # In the hedging pool, once the request is slower than the delay
+        if not race.start_hedge():
+            return
+        if not self.hedge.reserve_hedge():
+            race.finish_hedge(failed=True)
+            return
+
+        opaque_id = options["opaque_id"]
+        params = dict(params, preference=f"fiqs-hedge-{uuid4().hex}")
+        options = dict(options, opaque_id=f"{opaque_id}-hedge")
+        try:
+            response = self._execute(search, index, body, params, options, deadline)
+        except Exception:
+            race.finish_hedge(failed=True)
+            return
+
+        if race.finish_hedge(response):
+            self._cancel_search(search, opaque_id)
+
+    def _check_complete(self, result):
+        # We do not flatten partial results, they look like complete ones
+        if result.get("timed_out"):
+            raise PartialResultsError(
+                "Elasticsearch timed out before the deadline, the result is partial",
+                result,
+            )
+
+        shards = result.get("_shards", {})
+        if shards.get("failed"):
+            raise PartialResultsError(
+                f"{shards['failed']} of {shards.get('total')} shards failed, "
+                "the result is partial",
+                result,
+            )
+
+    def _cancel_search(self, search, opaque_id):
+        """Cancel the search tasks sent with this X-Opaque-Id. Returns
+        whether a task was cancelled"""
+        es = get_connection(search._using)
+        cancelled = False
+        try:
+            tasks = es.tasks.list(actions="*search*", detailed=True)
+            for node in tasks["nodes"].values():
+                for task_id, task in node.get("tasks", {}).items():
+                    if task.get("headers", {}).get("X-Opaque-Id") == opaque_id:
+                        es.tasks.cancel(task_id=task_id)
+                        cancelled = True
+        except (ApiError, TransportError):
+            # Best effort, the task may be over, and Elasticsearch also
+            # cancels searches whose HTTP connection was closed
+            pass
+        return cancelled
+
+    def _run_partitions(
+        self,
+        search,
+        index,
+        body,
+        profiler,
+        fill_missing_buckets=True,
+        deadline=None,
+        opaque_id=None,
+    ):
+        idx = self._partition_level()
+        num_partitions = self._partition["num_partitions"]
+        if num_partitions is None:
+            with profiler.stage("cardinality"):
+                num_partitions = self._estimate_num_partitions(search, index, body, idx)
+
+        def run_partition(partition, num_partitions, splits=0):
+            partition_body = self._partition_body(body, idx, partition, num_partitions)
+            _, result = self._request(
+                search,
+                index,
+                partition_body,
+                deadline=deadline,
+                opaque_id=opaque_id,
+            )
+
+            if self._partition_truncated(result, idx):
+                if splits >= MAX_PARTITION_SPLITS:
+                    raise PartialResultsError(
+                        f"Partition {partition} of {num_partitions} holds more "
+                        "terms than its size",
+                        result,
+                    )
+                # Terms hashed to the partition p of n are the ones hashed to
+                # the partitions p and p + n of 2n
+                return [
+                    line
+                    for split in (partition, partition + num_partitions)
+                    for line in run_partition(split, 2 * num_partitions, splits + 1)
+                ]
+
+            return self._flatten_result(
+                result,
+                remove_nested_aggregations=self._contains_nested_expressions(),
+            )
+
+        with profiler.stage("partitions"):
+            max_workers = min(self._partition["max_workers"], num_partitions)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                lines = [
+                    line
+                    for partition_lines in executor.map(
+                        lambda partition: run_partition(partition, num_partitions),
+                        range(num_partitions),
+                    )
+                    for line in partition_lines
+                ]
+        profiler.count("lines", len(lines))
+
+        # Missing buckets are only known once we have seen every partition
+        if fill_missing_buckets:
+            with profiler.stage("fill_missing_buckets"):
+                nb_lines = len(lines)
+                lines = self._add_missing_lines(lines)
+            profiler.count("filled_lines", len(lines) - nb_lines)
+
+        return lines
+
+    def _partition_level(self):
+        field = self._partition["field"]
+        for idx, field_or_exp in enumerate(self._group_by):
+            if isinstance(field_or_exp, Field) and field_or_exp.key == field.key:
+                return idx
+
+        raise ConfigurationError(f"Cannot partition {field!r}, it is not grouped by")
+
+    def _estimate_num_partitions(self, search, index, body, idx):
+        field = self._group_by[idx]
+        cardinality_body = {key: value for key, value in body.items() if key != "aggs"}
+        cardinality_body["size"] = 0
+        cardinality_body["aggs"] = {
+            "cardinality": {"cardinality": {"field": field.get_storage_field()}}
+        }
+
+        _, result = self._request(search, index, cardinality_body)
+        cardinality = result["aggregations"]["cardinality"]["value"]
+
+        partition_size = self._partition["partition_size"]
+        return max(math.ceil(cardinality * CARDINALITY_MARGIN / partition_size), 1)
+
+    def _partition_body(self, body, idx, partition, num_partitions):
+        # We only copy the path to the partitioned terms aggregation
+        body = dict(body)
+        body["aggs"] = parent = dict(body["aggs"])
+
+        for level in range(idx + 1):
+            name = self._group_by_params(level, self._group_by[level])["name"]
+            node = parent[name] = dict(parent[name])
+            if level < idx:
+                node["aggs"] = parent = dict(node["aggs"])
+
+        terms = node["terms"] = dict(node["terms"])
+        terms["include"] = {"partition": partition, "num_partitions": num_partitions}
+        if self._partition["num_partitions"] is None:
+            # Otherwise the size of the field, or the default size, is kept
+            terms["size"] = self._partition["partition_size"]
+
+        return body
+
+    def _partition_truncated(self, result, idx):
+        """Whether a partitioned terms aggregation left terms out"""
+        nodes = [result.get("aggregations", {})]
+        for level in range(idx + 1):
+            name = self._group_by_params(level, self._group_by[level])["name"]
+            aggs = [node[name] for node in nodes if name in node]
+            if level == idx:
+                return any(agg.get("sum_other_doc_count", 0) > 0 for agg in aggs)
+
+            nodes = []
+            for agg in aggs:
+                buckets = agg.get("buckets", [])
+                if isinstance(buckets, dict):
+                    buckets = buckets.values()
+                nodes.extend(buckets)
+
+    def _execute(self, search, index, body, params, options=None, deadline=None):
+        def perform():
+            if deadline is None:
+                return self._perform(search, index, body, params, options)
+            # With the time left once the request leaves the limiter queue
+            timeout_params, timeout_options = deadline_timeouts(
+                params, options, deadline
+            )
+            return self._perform(search, index, body, timeout_params, timeout_options)
+
+        return self._limited(perform, deadline)
+
+    def _limited(self, function, deadline=None):
+        """Run the request under the limiter of the process, if any, see
+        fiqs.limiting"""
+        limiter = get_limiter()
+        if limiter is None:
+            return function()
+
+        timeout = None if deadline is None else deadline - time.monotonic()
+        return limiter.run(function, priority=self.priority, timeout=timeout)
+
+    def _perform(self, search, index, body, params, options=None):
+        es = get_connection(search._using)
+        if options:
+            es = es.options(**options)
+        if self.response_format == "json":
+            return es.search(index=index, body=body, **params)
+
+        # The search API always asks for JSON, we need a lower level call
+        path = "/_search"
+        if index:
+            if isinstance(index, str):
+                index = [index]
+            path = f"/{quote(','.join(index), safe=',*')}/_search"
+
+        return es.perform_request(
+            "POST",
+            path,
+            params=params,
+            headers={
+                "accept": RESPONSE_FORMATS[self.response_format],
+                "content-type": "application/json",
+            },
+            body=body,
+        )
+
+    def _aggregation_paths(self):
+        """Map the path of every aggregation we send to the expression behind it"""
+        paths = {}
+
+        path = []
+        for idx, field_or_exp in enumerate(self._group_by):
+            path.append(self._group_by_params(idx, field_or_exp)["name"])
+            paths[">".join(path)] = field_or_exp
+
+        metrics, reverse_nested, _ = self._plan_values()
+        for key, expression in metrics.items():
+            paths[">".join(path + [key])] = expression
+
+        for expression, path_metrics in reverse_nested.values():
+            reverse_nested_path = path + [expression.reverse_agg_params()["name"]]
+            paths[">".join(reverse_nested_path)] = expression
+            for key, nested_expression in path_metrics.items():
+                paths[">".join(reverse_nested_path + [key])] = nested_expression
+
+        return paths
+
+    def _plan_values(self):
+        """Merge reverse nested aggregations sharing the same path, and send
+        identical metrics only once. Aliases map every skipped key to the key
+        actually sent to Elasticsearch."""
+        if self._plan is not None:
+            return self._plan
+
+        metrics = {}
+        reverse_nested = {}
+        aliases = {}
+        signatures = {}
 
-    def _configure_values(self, agg):
         for key, expression in self._expressions.items():
             if isinstance(expression, ReverseNested):
-                expression.configure_aggregations(agg)
+                path = expression.path
+                _, path_metrics = reverse_nested.setdefault(path, (expression, {}))
+                prefix = f"reverse_nested_{path}__"
+
+                field_expressions = expression.field_expressions()
+                for nested_key, nested_expression in field_expressions.items():
+                    signature = (path, nested_expression.signature())
+                    sent_key = signatures.setdefault(signature, nested_key)
+                    if sent_key == nested_key:
+                        path_metrics[nested_key] = nested_expression
+                    else:
+                        aliases[prefix + nested_key] = prefix + sent_key
 
             elif expression.is_field_agg():
-                op = expression.__class__.__name__.lower()
-                agg.metric(
-                    key,
-                    op,
-                    field=expression.field.get_storage_field(),
-                    **expression.params,
-                )
+                sent_key = signatures.setdefault((None, expression.signature()), key)
+                if sent_key == key:
+                    metrics[key] = expression
+                else:
+                    aliases[key] = sent_key
 
-    def _flatten_result(self, result, **kwargs):
-        lines = flatten_result(result, **kwargs)
+        self._plan = (metrics, reverse_nested, aliases)
+        return self._plan
+
+    def _configure_values(self, agg):
+        metrics, reverse_nested, _ = self._plan_values()
+
+        for key, expression in metrics.items():
+            agg.metric(key, **expression.metric_params())
+
+        for expression, path_metrics in reverse_nested.values():
+            reverse_nested_bucket = agg.bucket(**expression.reverse_agg_params())
+            for key, nested_expression in path_metrics.items():
+                reverse_nested_bucket.metric(key, **nested_expression.metric_params())
+
+    def _having_aggs(self, idx, predicates):
+        """Compile the having predicates of a group_by level to a
+        bucket_selector aggregation, in the buckets of the level"""
+        if isinstance(self._group_by[idx], NestedField | ReverseNested):
+            raise ConfigurationError(
+                f"Cannot use having on the single bucket {self._group_by[idx]!r}"
+            )
+
+        bucket_paths = self._level_bucket_paths(idx)
+        buckets_path = {}
+        script_params = {}
+        conditions = []
+        for predicate_idx, (key, lookup, value) in enumerate(predicates):
+            source = self._script_source(key, bucket_paths, buckets_path)
+            threshold = f"t{predicate_idx}"
+            script_params[threshold] = value
+            conditions.append(f"{source} {HAVING_OPERATORS[lookup]} params.{threshold}")
+
+        aggs = self._hidden_metrics(idx, set(buckets_path.values()))
+        aggs[HAVING_AGGREGATION] = {
+            "bucket_selector": {
+                "buckets_path": buckets_path,
+                "script": {
+                    "source": " && ".join(conditions),
+                    "params": script_params,
+                },
+            }
+        }
+        return aggs
+
+    def _script_source(self, key, bucket_paths, buckets_path):
+        # Painless source of the value of a key, computed expressions are
+        # computed from the values of their operands
+        if key in bucket_paths:
+            path = bucket_paths[key]
+            for variable, variable_path in buckets_path.items():
+                if variable_path == path:
+                    return f"params.{variable}"
+            variable = f"v{len(buckets_path)}"
+            buckets_path[variable] = path
+            return f"params.{variable}"
+
+        expression = self._expressions.get(key)
+        if expression is None or not expression.is_computed():
+            raise ConfigurationError(f"Unknown value {key}")
+
+        return expression.script_source(
+            [
+                self._script_source(str(operand), bucket_paths, buckets_path)
+                for operand in expression.operands
+            ]
+        )
+
+    def _bucket_paths(self):
+        """Map the keys of the lines to their buckets path, from the buckets of
+        the last group_by level"""
+        metrics, reverse_nested, aliases = self._plan_values()
+
+        paths = {"doc_count": "_count"}
+        for key, expression in self._expressions.items():
+            if expression.is_doc_count():
+                paths[key] = "_count"
+        for key in metrics:
+            paths[key] = key
+
+        for expression, path_metrics in reverse_nested.values():
+            name = expression.reverse_agg_params()["name"]
+            paths[f"{name}__doc_count"] = f"{name}>_count"
+            for key in path_metrics:
+                paths[f"{name}__{key}"] = f"{name}>{key}"
+
+        for alias, key in aliases.items():
+            paths[alias] = paths[key]
+
+        return paths
+
+    def _flatten_result(self, result, profile=NULL_PROFILE, scale=None, **kwargs):
+        with profile.stage("flatten"):
+            tree = ResultTree(result)
+            lines = tree.flatten_result(
+                doc_count_errors=self.doc_count_errors,
+                remove_hidden_aggregations=bool(self._level_orders or self._having),
+                **kwargs,
+            )
 
+            if scale is not None:
+                scaled_keys = self._scaled_keys()
+                for line in lines:
+                    for key in scaled_keys:
+                        if line.get(key) is None:
+                            continue
+                        elif key.endswith("doc_count"):
+                            line[key] = round(line[key] * scale)
+                        else:
+                            line[key] = line[key] * scale
+        profile.count("buckets", tree.nb_buckets)
+        profile.count("lines", len(lines))
+
+        key_to_field = self._key_to_field
+        if key_to_field is None:
+            key_to_field = self._get_key_to_field()
+        _, _, aliases = self._plan_values()
+
+        with profile.stage("computed"):
+            pretty_lines = []
+            for line in lines:
+                pretty_line = line.copy()
+                for alias, key in aliases.items():
+                    if key in pretty_line:
+                        pretty_line[alias] = pretty_line[key]
+                self._add_computed_results(pretty_line)
+                pretty_lines.append(pretty_line)
+
+        with profile.stage("cast"):
+            for pretty_line in pretty_lines:
+                others_line = False
+                for key, value in pretty_line.items():
+                    if key in key_to_field:
+                        field = key_to_field[key]
+                        if value == "others":
+                            pretty_line[key] = value  # add_others_line mode
+                            others_line = True
+                        else:
+                            pretty_line[key] = field.get_casted_value(value)
+
+                if others_line:
+                    # We make sure all metrics are present
+                    for key in key_to_field:
+                        if key not in pretty_line:
+                            pretty_line[key] = None
+
+        return pretty_lines
+
+    def _get_key_to_field(self):
+        # Which field or expression casts the values of each key
         key_to_field = {}
         for key, exp in self._expressions.items():
             if exp.is_doc_count():
@@ -209,30 +2187,7 @@ class FQuery:
             else:
                 key_to_field[field_or_exp.key] = field_or_exp
 
-        pretty_lines = []
-        for line in lines:
-            pretty_line = line.copy()
-            self._add_computed_results(pretty_line)
-
-            others_line = False
-            for key, value in pretty_line.items():
-                if key in key_to_field:
-                    field = key_to_field[key]
-                    if value == "others":
-                        pretty_line[key] = value  # add_others_line mode
-                        others_line = True
-                    else:
-                        pretty_line[key] = field.get_casted_value(value)
-
-            if others_line:
-                # We make sure all metrics are present
-                for key in key_to_field:
-                    if key not in pretty_line:
-                        pretty_line[key] = None
-
-            pretty_lines.append(pretty_line)
-
-        return pretty_lines
+        return key_to_field
 
     def _build_computed_order(self):
         """Topologically sort computed expressions so each can be evaluated in one pass."""
@@ -361,4 +2316,185 @@ class FQuery:
 
         empty_line["doc_count"] = 0
 
+        if self.doc_count_errors:
+            for field in self._terms_levels().values():
+                for suffix in DOC_COUNT_ERROR_SUFFIXES:
+                    empty_line[f"{field.key}{suffix}"] = None
+
         return empty_line
+
+
+class PreparedFQuery:
+    """A FQuery whose aggregations are built once, and which can then be
+    evaluated many times with different filters, time bounds and indices.
+
+    Time bounds are applied as a range filter on the `time_field` (by default
+    the field of the first DateHistogram of the group_by), and as the bounds
+    of the DateHistogram aggregations. With probe_cardinality, the sizes of
+    the terms aggregations follow the cardinalities probed again once they
+    expire."""
+
+    def __init__(self, fquery, time_field=None):
+        # We freeze a copy, later changes to the FQuery are not taken into account
+        self.fquery = copy.copy(fquery)
+        self.fquery._expressions = dict(fquery._expressions)
+        self.fquery._group_by = list(fquery._group_by)
+        self.fquery._order_by = dict(fquery._order_by)
+        self.fquery._having = list(fquery._having)
+        self.fquery._level_orders = dict(fquery._level_orders)
+
+        self.search = self.fquery.search
+        if self.fquery.max_buckets is not None:
+            self.fquery._check_bucket_budget()
+
+        self.body = self.fquery._build_body()
+        self.aggs = self.body.pop("aggs", {})
+
+        self.fquery._plan_values()
+        self.fquery._computed_order = self.fquery._build_computed_order()
+        self.fquery._key_to_field = self.fquery._get_key_to_field()
+
+        self._level_names = [
+            self.fquery._group_by_params(idx, field_or_exp)["name"]
+            for idx, field_or_exp in enumerate(self.fquery._group_by)
+        ]
+        self._date_histograms = {
+            idx: field_or_exp
+            for idx, field_or_exp in enumerate(self.fquery._group_by)
+            if isinstance(field_or_exp, DateHistogram)
+        }
+
+        if time_field is None and self._date_histograms:
+            first_idx = min(self._date_histograms)
+            time_field = self._date_histograms[first_idx].field
+        if isinstance(time_field, Field):
+            time_field = time_field.get_storage_field()
+        self.time_field = time_field
+
+    def eval(
+        self,
+        filters=None,
+        index=None,
+        min=None,
+        max=None,
+        flat=True,
+        fill_missing_buckets=True,
+        add_others_line=False,
+        profile=False,
+        es_profile=False,
+        sample=None,
+        deadline=None,
+        opaque_id=None,
+    ):
+        deadline = get_deadline(deadline)
+        if deadline is not None and opaque_id is None:
+            opaque_id = new_opaque_id()
+        fquery = self.fquery
+        fquery._check_flat_mode(flat)
+        fquery._check_partition(flat, add_others_line, es_profile)
+        fquery._check_sample(flat, sample)
+        profile, profiler = fquery._get_profile(profile, es_profile)
+
+        with profiler:
+            with profiler.stage("build"):
+                if fquery.probe_cardinality:
+                    self._plan_sizes()
+                    fquery = self.fquery
+                aggs = self.aggs
+                filters = [
+                    f.to_dict() if hasattr(f, "to_dict") else f for f in filters or ()
+                ]
+
+                if min is not None or max is not None:
+                    if self._date_histograms:
+                        fquery, aggs = self._bind_time_bounds(min, max)
+                    filters.append(self._time_filter(min, max))
+
+                body = self._get_body(aggs, filters)
+
+            # We need the elasticsearch.dsl aggregations to build the Response
+            search = self.search if flat else fquery._configure_search()
+            result = fquery._run(
+                search,
+                index or self.search._index,
+                body,
+                profiler,
+                flat=flat,
+                fill_missing_buckets=fill_missing_buckets,
+                add_others_line=add_others_line,
+                es_profile=es_profile,
+                sample=sample,
+                deadline=deadline,
+                opaque_id=opaque_id,
+            )
+
+        fquery._record_metrics(profiler)
+        if profile:
+            return result, profile
+        return result
+
+    def _plan_sizes(self):
+        # The cardinalities are cached for a while, the aggregations are only
+        # built again when they were probed again, with other values
+        fquery = copy.copy(self.fquery)
+        fquery._size_plan = None
+        if fquery._plan_sizes() != self.fquery._size_plan:
+            aggs = fquery._build_body().get("aggs", {})
+            self.fquery, self.aggs = fquery, aggs
+
+    def _get_body(self, aggs, filters):
+        body = self.body.copy()
+        if aggs:
+            body["aggs"] = aggs
+
+        if filters:
+            if "query" in body:
+                filters.insert(0, body["query"])
+            body["query"] = {"bool": {"filter": filters}}
+
+        return body
+
+    def _time_filter(self, min, max):
+        if not self.time_field:
+            raise ConfigurationError("Cannot bind time bounds without a time field")
+
+        bounds = {}
+        if min is not None:
+            bounds["gte"] = min
+        if max is not None:
+            bounds["lte"] = max
+
+        return {"range": {self.time_field: bounds}}
+
+    def _bind_time_bounds(self, min, max):
+        if min is None or max is None:
+            raise MissingParameterException("cannot give min without max")
+
+        # We only copy what we change
+        fquery = copy.copy(self.fquery)
+        fquery._group_by = list(self.fquery._group_by)
+        aggs = dict(self.aggs)
+
+        parent = aggs
+        last_histogram_idx = sorted(self._date_histograms)[-1]
+        for idx, name in enumerate(self._level_names[: last_histogram_idx + 1]):
+            node = dict(parent[name])
+            parent[name] = node
+
+            if idx in self._date_histograms:
+                bound_histogram = self._date_histograms[idx].with_bounds(min, max)
+                fquery._group_by[idx] = bound_histogram
+
+                # The interval of an AutoDateHistogram depends on the bounds
+                agg_type = bound_histogram.reference()
+                params = fquery._group_by_params(idx, bound_histogram)
+                node[agg_type] = agg_dict(params)[agg_type]
+
+            if "aggs" in node:
+                node["aggs"] = dict(node["aggs"])
+                parent = node["aggs"]
+
+        if fquery.max_buckets is not None:
+            fquery._check_bucket_budget()
+
+        return fquery, aggs
@@ -0,0 +1,54 @@
+from collections import deque
+from datetime import datetime, timezone
+
+
+def utcnow():
+    # fiqs works with naive UTC datetimes
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class RollingWindow:
+    """The lines of the last buckets of a date histogram, bucket by bucket.
+
+    Buckets are kept in a ring buffer: each refresh replaces the buckets
+    which were still open at the previous one, appends the new ones, and
+    evicts the buckets which left the window."""
+
+    def __init__(self, histogram, window):
+        self.histogram = histogram
+        self.key = histogram.field.key
+        self.window = window
+
+        self.buckets = deque()  # (bucket start, lines), oldest first
+        self.refreshed_at = None
+
+    def window_start(self, now):
+        return self.histogram.round_date(now - self.window)
+
+    def since(self, now):
+        """Start of the buckets to query: buckets before the one which was
+        open at the last refresh are closed, and will not change"""
+        start = self.window_start(now)
+        if self.refreshed_at is None:
+            return start
+        return max(start, self.histogram.round_date(self.refreshed_at))
+
+    def update(self, lines, since, now):
+        while self.buckets and self.buckets[-1][0] >= since:
+            self.buckets.pop()
+
+        new_buckets = {}
+        for line in lines:
+            if line[self.key] >= since:
+                new_buckets.setdefault(line[self.key], []).append(line)
+        for start in sorted(new_buckets):
+            self.buckets.append((start, new_buckets[start]))
+
+        start = self.window_start(now)
+        while self.buckets and self.buckets[0][0] < start:
+            self.buckets.popleft()
+
+        self.refreshed_at = now
+
+    def lines(self):
+        return [line for _, lines in self.buckets for line in lines]
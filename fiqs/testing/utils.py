@@ -1,13 +1,22 @@
 import os
 
-from elasticsearch import Elasticsearch
 from elasticsearch.dsl import Search
 
+from fiqs import connections
+from fiqs.exceptions import ConfigurationError
+
 FIQS_ES_URL = os.environ.get("FIQS_ES_URL", "http://localhost:9201")
+TESTING_ALIAS = "fiqs_testing"
 
 
 def get_client():
-    return Elasticsearch([FIQS_ES_URL], request_timeout=60)
+    # The client, and its connections, are reused by every test
+    try:
+        return connections.get_client(TESTING_ALIAS)
+    except ConfigurationError:
+        return connections.configure(
+            TESTING_ALIAS, hosts=[FIQS_ES_URL], request_timeout=60
+        )
 
 
 def get_search(client=None, indices=None):
@@ -1,12 +1,27 @@
+import copy
+import itertools
 import json
 import os
+import threading
 import time
 
 import pytest
+from elastic_transport import (
+    ApiResponseMeta,
+    HttpHeaders,
+    NodeConfig,
+    ObjectApiResponse,
+)
+from elasticsearch import ApiError, ConnectionTimeout
 from elasticsearch.helpers import bulk
 from elasticsearch.dsl import Mapping, Nested
 
-from fiqs.testing.utils import get_client
+from fiqs import cbor
+from fiqs.aggregations import Sum
+from fiqs.limiting import ConcurrencyLimiter, set_limiter
+from fiqs.query import FQuery
+from fiqs.testing.models import Sale
+from fiqs.testing.utils import get_client, get_search
 
 SALE_INDEX_NAME = "test_sale"
 TRAFFIC_INDEX_NAME = "test_traffic"
@@ -183,3 +198,182 @@ def load_output(name):
         output = json.load(f)
 
     return output
+
+
+class FakeTasks:
+    """The search tasks of the requests sent with an opaque id, like the
+    tasks API lists them"""
+
+    def __init__(self):
+        self.running = {}  # Task id => (opaque id, event set on cancellation)
+        self.cancelled = []  # Opaque ids of the cancelled tasks
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def start(self, opaque_id):
+        task_id = f"node:{next(self._ids)}"
+        cancelled = threading.Event()
+        if opaque_id is not None:
+            with self._lock:
+                self.running[task_id] = (opaque_id, cancelled)
+        return task_id, cancelled
+
+    def finish(self, task_id):
+        with self._lock:
+            self.running.pop(task_id, None)
+
+    def list(self, **params):
+        with self._lock:
+            tasks = {
+                task_id: {"headers": {"X-Opaque-Id": opaque_id}}
+                for task_id, (opaque_id, _) in self.running.items()
+            }
+        return {"nodes": {"node": {"tasks": tasks}}}
+
+    def cancel(self, task_id=None):
+        with self._lock:
+            opaque_id, cancelled = self.running.pop(task_id)
+        self.cancelled.append(opaque_id)
+        cancelled.set()
+
+
+class FakeClient:
+    """Answers every search with a recorded output, and keeps the requests.
+
+    `transform(body, result)` returns what Elasticsearch would answer to the
+    body, from the recorded result. `errors` are raised by the next
+    requests, in order (None for a request which succeeds). Requests for
+    which `block(params)` is true wait until `release` is set, or until
+    their task is cancelled."""
+
+    def __init__(self, *names, transform=None, errors=(), block=None):
+        self.names = list(names)
+        self.transform = transform
+        self.errors = iter(errors)
+        self.block = block
+        self.release = threading.Event()
+        self.requests = []
+        self.tasks = FakeTasks()
+        self._options = {}
+
+    def options(self, **options):
+        # Like the client, options only apply to the requests of the copy
+        client = copy.copy(self)
+        client._options = options
+        return client
+
+    def search(self, index=None, body=None, **params):
+        options = self._pop_options()
+        self.requests.append(
+            {
+                "index": index,
+                "body": body,
+                "params": params,
+                "options": options,
+            }
+        )
+
+        task_id, cancelled = self.tasks.start(options.get("opaque_id"))
+        try:
+            if self.block is not None and self.block(params):
+                deadline = time.monotonic() + 5
+                while not (self.release.is_set() or cancelled.is_set()):
+                    assert time.monotonic() < deadline
+                    time.sleep(0.001)
+
+            error = next(self.errors, None)
+            if error is not None:
+                raise error
+
+            raw = self._next_output()
+            result = json.loads(raw)
+            if self.transform is not None:
+                result = self.transform(body, result)
+        except ConnectionTimeout:
+            # The client gave up, Elasticsearch goes on with the search
+            raise
+        except BaseException:
+            self.tasks.finish(task_id)
+            raise
+
+        self.tasks.finish(task_id)
+        return self._response(result, len(raw))
+
+    def perform_request(self, method, path, params=None, headers=None, body=None):
+        # Only used for CBOR responses, which are kept as raw bytes
+        self.requests.append(
+            {
+                "path": path,
+                "body": body,
+                "params": params,
+                "headers": headers,
+                "options": self._pop_options(),
+            }
+        )
+        raw = cbor.dumps(json.loads(self._next_output()))
+        return self._response(raw, len(raw))
+
+    def _pop_options(self):
+        options, self._options = self._options, {}
+        return options
+
+    def _next_output(self):
+        if not self.names:
+            return b"{}"
+        # We replay the outputs in order, the last one is kept for later calls
+        name = self.names.pop(0) if len(self.names) > 1 else self.names[0]
+        path = os.path.join(BASE_PATH, f"{name}.json")
+        with open(path, "rb") as f:
+            return f.read()
+
+    def _response(self, body, size):
+        return ObjectApiResponse(body=body, meta=response_meta(size=size))
+
+
+def response_meta(status=200, size=None):
+    headers = {} if size is None else {"content-length": str(size)}
+    return ApiResponseMeta(
+        status=status,
+        http_version="1.1",
+        headers=HttpHeaders(headers),
+        duration=0.001,
+        node=NodeConfig("http", "localhost", 9200),
+    )
+
+
+def api_error(status):
+    """The error raised by the client when Elasticsearch answers `status`"""
+    return ApiError(
+        "es_rejected_execution_exception", meta=response_meta(status), body={}
+    )
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def get_fake_search(*names, **kwargs):
+    return get_search(client=FakeClient(*names, **kwargs))
+
+
+def get_total_sales_by_shop_fquery(search, **options):
+    return (
+        FQuery(search, **options)
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.shop_id,
+        )
+    )
+
+
+@pytest.fixture
+def limiter():
+    limiter = ConcurrencyLimiter(base_delay=0.001)
+    set_limiter(limiter)
+    yield limiter
+    set_limiter(None)
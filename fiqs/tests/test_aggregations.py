@@ -1,6 +1,9 @@
 from datetime import datetime, timedelta
 
-from fiqs.aggregations import DateHistogram
+import pytest
+
+from fiqs.aggregations import AutoDateHistogram, DateHistogram
+from fiqs.exceptions import MissingParameterException
 from fiqs.testing.models import Sale
 
 
@@ -110,3 +113,73 @@ def test_date_histogram_choice_keys_month_intervals_offset():
     ]
     keys = date_histogram.choice_keys()
     assert expected_keys == keys
+
+
+def test_date_histogram_round_date():
+    date_histogram = get_date_histogram(
+        min=datetime(2016, 1, 1), max=datetime(2016, 2, 1), interval="15m"
+    )
+    assert date_histogram.round_date(datetime(2016, 1, 3, 6, 44, 59)) == datetime(
+        2016, 1, 3, 6, 30
+    )
+
+    date_histogram = get_date_histogram(
+        min=datetime(2016, 1, 1), max=datetime(2016, 2, 1), interval="1w"
+    )
+    # 2016-01-07 is a Thursday
+    assert date_histogram.round_date(datetime(2016, 1, 7, 12)) == datetime(2016, 1, 4)
+
+    date_histogram = get_date_histogram(
+        min=datetime(2016, 1, 1), max=datetime(2016, 2, 1), interval="1d", offset="+6h"
+    )
+    assert date_histogram.round_date(datetime(2016, 1, 7, 5)) == datetime(2016, 1, 6, 6)
+    assert date_histogram.round_date(datetime(2016, 1, 7, 7)) == datetime(2016, 1, 7, 6)
+
+    # Dates we cannot round are kept as is
+    assert date_histogram.round_date("now-1d") == "now-1d"
+
+
+@pytest.mark.parametrize(
+    "start,end,buckets,interval",
+    [
+        (datetime(2016, 1, 1), datetime(2016, 1, 1, 23, 59), 100, "15m"),
+        (datetime(2016, 1, 1), datetime(2016, 1, 1, 23, 59), 1000, "5m"),
+        (datetime(2016, 1, 1), datetime(2016, 1, 31), 100, "12h"),
+        (datetime(2016, 1, 1), datetime(2016, 1, 31), 31, "1d"),
+        (datetime(2016, 1, 1), datetime(2016, 12, 31), 60, "1w"),
+        (datetime(2016, 1, 1), datetime(2016, 12, 31), 12, "1M"),
+        (datetime(2010, 1, 1), datetime(2019, 12, 31), 20, "1y"),
+        # Nothing fits, we use the coarsest interval
+        (datetime(2010, 1, 1), datetime(2019, 12, 31), 5, "1y"),
+    ],
+)
+def test_auto_date_histogram_interval(start, end, buckets, interval):
+    date_histogram = AutoDateHistogram(
+        Sale.timestamp, min=start, max=end, buckets=buckets
+    )
+    date_histogram.agg_params()
+
+    assert date_histogram.interval == interval
+    if interval != "1y":
+        assert len(date_histogram.choice_keys()) <= buckets
+
+
+def test_auto_date_histogram_with_bounds():
+    date_histogram = AutoDateHistogram(
+        Sale.timestamp,
+        min=datetime(2016, 1, 1),
+        max=datetime(2016, 1, 31),
+        buckets=40,
+    )
+    assert date_histogram.params["interval"] == "1d"
+
+    bound_histogram = date_histogram.with_bounds(
+        datetime(2016, 1, 1), datetime(2016, 3, 31)
+    )
+    assert bound_histogram.buckets == 40
+    assert bound_histogram.params["interval"] == "1w"
+    # The original histogram is left untouched
+    assert date_histogram.params["interval"] == "1d"
+
+    with pytest.raises(MissingParameterException):
+        AutoDateHistogram(Sale.timestamp, buckets=40)
@@ -0,0 +1,246 @@
+import multiprocessing
+
+from elasticsearch import Elasticsearch
+from elasticsearch.dsl import Search
+from elasticsearch.dsl.connections import add_connection, remove_connection
+
+from fiqs.aggregations import Avg
+from fiqs.caching import DiskCache
+from fiqs.query import cluster_key
+from fiqs.testing.models import Sale
+from fiqs.testing.utils import get_search
+from fiqs.tests.conftest import (
+    FakeClient,
+    get_fake_search,
+    get_total_sales_by_shop_fquery,
+)
+
+
+def test_disk_cache(tmp_path):
+    cache = DiskCache(tmp_path / "cache.sqlite")
+
+    assert cache.get("key") is None
+
+    cache.set("key", "json", b'{"took": 1}')
+    assert cache.get("key") == ("json", b'{"took": 1}')
+    assert len(cache) == 1
+
+    # Another instance, like another worker or a restarted one, shares it
+    assert DiskCache(tmp_path / "cache.sqlite").get("key") == ("json", b'{"took": 1}')
+
+    cache.delete("key")
+    assert cache.get("key") is None
+
+    cache.set("key", "json", b"{}")
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_disk_cache_compression(tmp_path):
+    cache = DiskCache(tmp_path / "cache.sqlite")
+    payload = b'{"key": "value"}' * 1000
+
+    cache.set("key", "json", payload)
+
+    assert cache.size() < len(payload) / 10
+    assert cache.get("key") == ("json", payload)
+
+
+def test_disk_cache_ttl(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("fiqs.caching.time.time", lambda: now[0])
+    cache = DiskCache(tmp_path / "cache.sqlite", ttl=60)
+
+    cache.set("key", "json", b"{}")
+    cache.set("short", "json", b"{}", ttl=10)
+
+    now[0] += 30
+    assert cache.get("key") is not None
+    assert cache.get("short") is None
+
+    now[0] += 30
+    assert cache.get("key") is None
+
+    # Expired entries are removed on the next write
+    cache.set("other", "json", b"{}")
+    assert len(cache) == 1
+
+
+def test_disk_cache_eviction(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("fiqs.caching.time.time", lambda: now[0])
+    cache = DiskCache(
+        tmp_path / "cache.sqlite", max_size=100, compress_level=0, touch_interval=1
+    )
+
+    # Without compression, payloads take their size plus a few bytes
+    for key in ["a", "b", "c"]:
+        cache.set(key, "json", b"x" * 30)
+        now[0] += 1
+    assert len(cache) == 2
+    assert cache.get("a") is None
+
+    # b was used last, c is evicted first
+    now[0] += 1
+    cache.get("b")
+    now[0] += 1
+    cache.set("d", "json", b"x" * 30)
+    assert cache.get("b") is not None
+    assert cache.get("c") is None
+    assert cache.size() <= 100
+
+    # Payloads larger than the cache are not stored
+    cache.set("e", "json", b"x" * 200)
+    assert cache.get("e") is None
+
+
+def test_disk_cache_touch_interval(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("fiqs.caching.time.time", lambda: now[0])
+    cache = DiskCache(tmp_path / "cache.sqlite", touch_interval=60)
+    cache.set("key", "json", b"{}")
+
+    def accessed_at():
+        return (
+            cache._connection()
+            .execute("SELECT accessed_at FROM responses WHERE key = 'key'")
+            .fetchone()[0]
+        )
+
+    # Recent accesses are not written again
+    now[0] += 30
+    cache.get("key")
+    assert accessed_at() == 1000.0
+
+    now[0] += 30
+    cache.get("key")
+    assert accessed_at() == 1060.0
+
+
+def test_disk_cache_size(tmp_path):
+    path = tmp_path / "cache.sqlite"
+    cache = DiskCache(path, compress_level=0)
+
+    cache.set("a", "json", b"x" * 30)
+    cache.set("b", "json", b"x" * 30)
+    size = cache.size()
+    assert size > 60
+
+    # The running size follows replaced and deleted entries
+    cache.set("a", "json", b"x" * 60)
+    assert cache.size() == size + 30
+    cache.delete("b")
+    assert cache.size() == size + 30 - size // 2
+    assert DiskCache(path).size() == cache.size()
+    cache.clear()
+    assert cache.size() == 0
+
+
+def write_entries(path, worker):
+    cache = DiskCache(path)
+    for idx in range(50):
+        cache.set(f"{worker}-{idx}", "json", b"{}")
+        cache.get(f"{worker}-{idx}")
+
+
+def test_disk_cache_processes(tmp_path):
+    path = tmp_path / "cache.sqlite"
+    DiskCache(path)
+
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=write_entries, args=(path, worker))
+        for worker in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    assert [process.exitcode for process in processes] == [0] * 4
+    assert len(DiskCache(path)) == 200
+
+
+def test_cache(tmp_path):
+    cache = DiskCache(tmp_path / "cache.sqlite")
+    fsearch = get_fake_search("total_sales_by_shop")
+    fquery = get_total_sales_by_shop_fquery(fsearch, cache=cache)
+
+    lines = fquery.eval()
+    assert len(fsearch._using.requests) == 1
+    assert len(cache) == 1
+
+    # Another FQuery, e.g. in another worker, gets the cached response
+    fquery = get_total_sales_by_shop_fquery(fsearch, cache=cache)
+    cached_lines, profile = fquery.eval(profile=True)
+
+    assert len(fsearch._using.requests) == 1
+    assert cached_lines == lines
+    assert profile.cached
+    assert "cache" in profile.stages
+    assert fquery.eval(flat=False).aggregations.shop_id.buckets
+
+    # Other requests are not served from the cache
+    fquery.values(Avg(Sale.price)).eval()
+    assert len(fsearch._using.requests) == 2
+
+
+def test_cache_cbor(tmp_path):
+    cache = DiskCache(tmp_path / "cache.sqlite")
+    fsearch = get_fake_search("total_sales_by_shop")
+    fquery = get_total_sales_by_shop_fquery(
+        fsearch, response_format="cbor", cache=cache
+    )
+
+    lines = fquery.eval()
+    assert fquery.eval() == lines
+    assert len(fsearch._using.requests) == 1
+    assert cache.get(next(iter(cache_keys(cache))))[0] == "cbor"
+
+
+def cache_keys(cache):
+    with cache._transaction() as connection:
+        return [row[0] for row in connection.execute("SELECT key FROM responses")]
+
+
+def test_cache_partial_results(tmp_path):
+    cache = DiskCache(tmp_path / "cache.sqlite")
+    client = FakeClient(
+        "total_sales_by_shop",
+        transform=lambda body, result: dict(result, timed_out=True),
+    )
+    fquery = get_total_sales_by_shop_fquery(get_search(client=client), cache=cache)
+
+    fquery.eval()
+    fquery.eval()
+
+    assert len(client.requests) == 2
+    assert len(cache) == 0
+
+
+def test_cache_clusters(tmp_path):
+    cache = DiskCache(tmp_path / "cache.sqlite")
+    clients = {
+        "fiqs_tests_a": FakeClient("total_sales_by_shop"),
+        "fiqs_tests_b": FakeClient("total_sales_by_shop"),
+    }
+    for alias, client in clients.items():
+        add_connection(alias, client)
+
+    try:
+        for alias in clients:
+            search = Search(using=alias, index="sale_data")
+            get_total_sales_by_shop_fquery(search, cache=cache).eval()
+    finally:
+        for alias in clients:
+            remove_connection(alias)
+
+    # The same request to another cluster is not served from the cache
+    assert [len(client.requests) for client in clients.values()] == [1, 1]
+    assert len(cache) == 2
+
+    # Clients are identified by their nodes
+    assert cluster_key(Elasticsearch("http://a:9200")) == ["http://a:9200"]
+    assert cluster_key(Elasticsearch("http://a:9200")) != cluster_key(
+        Elasticsearch("http://b:9200")
+    )
@@ -0,0 +1,113 @@
+import glob
+import math
+import os
+
+import pytest
+
+from fiqs import cbor
+from fiqs.tests.conftest import BASE_PATH, load_output
+
+OUTPUT_NAMES = sorted(
+    os.path.splitext(os.path.basename(path))[0]
+    for path in glob.glob(os.path.join(BASE_PATH, "*.json"))
+)
+
+
+@pytest.mark.parametrize(
+    "value,encoded",
+    [
+        (0, b"\x00"),
+        (23, b"\x17"),
+        (24, b"\x18\x18"),
+        (1000, b"\x19\x03\xe8"),
+        (1000000, b"\x1a\x00\x0f\x42\x40"),
+        (1000000000000, b"\x1b\x00\x00\x00\xe8\xd4\xa5\x10\x00"),
+        (-1, b"\x20"),
+        (-1000, b"\x39\x03\xe7"),
+        (1.1, b"\xfb\x3f\xf1\x99\x99\x99\x99\x99\x9a"),
+        (False, b"\xf4"),
+        (True, b"\xf5"),
+        (None, b"\xf6"),
+        ("", b"\x60"),
+        ("a", b"\x61\x61"),
+        ("ü", b"\x62\xc3\xbc"),
+        (b"\x01\x02", b"\x42\x01\x02"),
+        ([], b"\x80"),
+        ([1, [2, 3]], b"\x82\x01\x82\x02\x03"),
+        ({"a": 1, "b": [2]}, b"\xa2\x61\x61\x01\x61\x62\x81\x02"),
+    ],
+)
+def test_round_trip(value, encoded):
+    # Examples from RFC 8949, appendix A
+    assert cbor.dumps(value) == encoded
+    assert cbor.loads(encoded) == value
+
+
+@pytest.mark.parametrize(
+    "encoded,value",
+    [
+        (b"\xf9\x3c\x00", 1.0),
+        (b"\xf9\x00\x01", 5.960464477539063e-08),
+        (b"\xf9\xc4\x00", -4.0),
+        (b"\xf9\x7c\x00", math.inf),
+        (b"\xfa\x47\xc3\x50\x00", 100000.0),
+        (b"\xc2\x49\x01\x00\x00\x00\x00\x00\x00\x00\x00", 2**64),
+        (b"\xc3\x49\x01\x00\x00\x00\x00\x00\x00\x00\x00", -(2**64) - 1),
+        (b"\xc1\x1a\x51\x4b\x67\xb0", 1363896240),
+        (b"\x5f\x42\x01\x02\x41\x03\xff", b"\x01\x02\x03"),
+        (b"\x7f\x65strea\x64ming\xff", "streaming"),
+        (b"\x9f\x01\x82\x02\x03\x9f\xff\xff", [1, [2, 3], []]),
+        (b"\xbf\x61a\x01\x61b\x9f\x02\xff\xff", {"a": 1, "b": [2]}),
+    ],
+)
+def test_loads(encoded, value):
+    # Half and single precision floats, tags and indefinite lengths,
+    # which we never produce but Elasticsearch may
+    assert cbor.loads(encoded) == value
+
+
+def test_loads_nan():
+    assert math.isnan(cbor.loads(b"\xf9\x7e\x00"))
+
+
+@pytest.mark.parametrize(
+    "encoded",
+    [
+        b"",
+        b"\x19\x03",
+        b"\x62a",
+        b"\x82\x01",
+        b"\xbf\x61a\x01",
+        b"\x01\x02",
+        b"\xff",
+        b"\x1c",
+    ],
+)
+def test_loads_invalid(encoded):
+    with pytest.raises(cbor.CBORDecodeError):
+        cbor.loads(encoded)
+
+
+def test_loads_bytearray_and_memoryview():
+    encoded = cbor.dumps({"key": [1, 2.5, "three"]})
+
+    assert cbor.loads(bytearray(encoded)) == {"key": [1, 2.5, "three"]}
+    assert cbor.loads(memoryview(encoded)) == {"key": [1, 2.5, "three"]}
+
+
+@pytest.mark.parametrize("name", OUTPUT_NAMES)
+def test_outputs_round_trip(name):
+    output = load_output(name)
+
+    assert cbor.loads(cbor.dumps(output)) == output
+
+
+def test_serializer():
+    encoded = cbor.dumps({"took": 3})
+
+    assert cbor.CBORSerializer().loads(encoded) == {"took": 3}
+    assert cbor.CBORSerializer(decode=False).loads(encoded) == encoded
+    assert cbor.CBORSerializer().dumps({"took": 3}) == encoded
+
+    serializers = cbor.cbor_serializers()
+    assert set(serializers) == {cbor.CBOR_MIMETYPE, cbor.CBOR_COMPAT_MIMETYPE}
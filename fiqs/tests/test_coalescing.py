@@ -0,0 +1,205 @@
+import threading
+
+import pytest
+
+from fiqs.coalescing import SINGLE_FLIGHT, SingleFlight
+from fiqs.exceptions import DeadlineExceededError, PartialResultsError
+from fiqs.testing.utils import get_search
+from fiqs.tests.conftest import (
+    FakeClient,
+    get_fake_search,
+    get_total_sales_by_shop_fquery,
+    wait_for,
+)
+
+
+def run_concurrently(single_flight, function, nb_calls):
+    results = [None] * nb_calls
+    errors = [None] * nb_calls
+
+    def call(idx):
+        try:
+            results[idx] = single_flight.do("key", function, copy=list)
+        except Exception as e:
+            errors[idx] = e
+
+    threads = [threading.Thread(target=call, args=(idx,)) for idx in range(nb_calls)]
+    for thread in threads:
+        thread.start()
+    return threads, results, errors
+
+
+def test_single_flight():
+    single_flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def function():
+        calls.append(1)
+        release.wait(5)
+        return [1, 2, 3]
+
+    threads, results, errors = run_concurrently(single_flight, function, 5)
+    wait_for(lambda: single_flight.coalesced == 4)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert errors == [None] * 5
+    assert results == [[1, 2, 3]] * 5
+    # Every caller got its own copy
+    assert len({id(result) for result in results}) == 5
+
+    # Once done, the function runs again
+    result = single_flight.do("key", function, copy=list)
+    assert len(calls) == 2
+    assert single_flight.coalesced == 4
+
+
+def test_single_flight_not_shared():
+    single_flight = SingleFlight()
+    result = [1]
+
+    assert single_flight.do("key", lambda: result, copy=list) is result
+    assert single_flight.coalesced == 0
+
+
+def test_single_flight_error():
+    single_flight = SingleFlight()
+    release = threading.Event()
+
+    def function():
+        release.wait(5)
+        raise ValueError("Boom")
+
+    threads, results, errors = run_concurrently(single_flight, function, 3)
+    wait_for(lambda: single_flight.coalesced == 2)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert all(isinstance(error, ValueError) for error in errors)
+
+    with pytest.raises(ValueError):
+        single_flight.do("key", function, copy=list)
+
+
+def test_single_flight_timeout():
+    single_flight = SingleFlight()
+    release = threading.Event()
+
+    def function():
+        release.wait(5)
+        return [1]
+
+    threads, results, errors = run_concurrently(single_flight, function, 1)
+    wait_for(lambda: "key" in single_flight._calls)
+
+    # The waiter gives up, the function keeps running
+    with pytest.raises(DeadlineExceededError):
+        single_flight.do("key", function, copy=list, timeout=0.01)
+    release.set()
+    threads[0].join()
+    assert results == [[1]]
+
+
+def test_coalesce():
+    client = FakeClient("total_sales_by_shop", block=lambda params: True)
+    search = get_search(client=client)
+    expected = get_total_sales_by_shop_fquery(get_fake_search("total_sales_by_shop"))
+    expected = expected.eval()
+
+    nb_threads = 4
+    coalesced = SINGLE_FLIGHT.coalesced
+    results = [None] * nb_threads
+
+    def evaluate(idx):
+        # Each thread has its own, identical, FQuery
+        fquery = get_total_sales_by_shop_fquery(search, coalesce=True)
+        results[idx] = fquery.eval()
+
+    threads = [
+        threading.Thread(target=evaluate, args=(idx,)) for idx in range(nb_threads)
+    ]
+    for thread in threads:
+        thread.start()
+    wait_for(lambda: SINGLE_FLIGHT.coalesced - coalesced == nb_threads - 1)
+    client.release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(client.requests) == 1
+    assert results == [expected] * nb_threads
+    assert SINGLE_FLIGHT.coalesced - coalesced == nb_threads - 1
+
+    # Without coalescing, every evaluation sends its request
+    get_total_sales_by_shop_fquery(search).eval()
+    get_total_sales_by_shop_fquery(search).eval()
+    assert len(client.requests) == 3
+
+    # Deadlines do not prevent coalescing
+    client.release.clear()
+    coalesced = SINGLE_FLIGHT.coalesced
+    errors = []
+
+    def evaluate_with_deadline(deadline):
+        fquery = get_total_sales_by_shop_fquery(search, coalesce=True)
+        try:
+            fquery.eval(deadline=deadline)
+        except DeadlineExceededError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=evaluate_with_deadline, args=(10,))
+    leader.start()
+    wait_for(lambda: len(client.requests) == 4)
+    # The waiter gives up at its own deadline
+    evaluate_with_deadline(0.05)
+    client.release.set()
+    leader.join()
+
+    assert len(client.requests) == 4
+    assert SINGLE_FLIGHT.coalesced - coalesced == 1
+    assert len(errors) == 1
+
+
+def test_coalesce_with_and_without_deadline():
+    # Partial responses are only errors for callers with a deadline
+    client = FakeClient(
+        "total_sales_by_shop",
+        transform=lambda body, result: dict(result, timed_out=True),
+        block=lambda params: True,
+    )
+    search = get_search(client=client)
+    coalesced = SINGLE_FLIGHT.coalesced
+    errors = []
+    lines = []
+
+    def evaluate_with_deadline():
+        fquery = get_total_sales_by_shop_fquery(search, coalesce=True)
+        try:
+            fquery.eval(deadline=10)
+        except PartialResultsError as e:
+            errors.append(e)
+
+    def evaluate():
+        fquery = get_total_sales_by_shop_fquery(search, coalesce=True)
+        lines.extend(fquery.eval())
+
+    leader = threading.Thread(target=evaluate_with_deadline)
+    leader.start()
+    wait_for(lambda: len(client.requests) == 1)
+    # The caller without a deadline does not wait for the request with a
+    # timeout, it sends its own
+    caller = threading.Thread(target=evaluate)
+    caller.start()
+    wait_for(lambda: len(client.requests) == 2)
+    client.release.set()
+    leader.join()
+    caller.join()
+
+    assert "timeout" in client.requests[0]["params"]
+    assert "timeout" not in client.requests[1]["params"]
+    assert SINGLE_FLIGHT.coalesced == coalesced
+    assert len(errors) == 1
+    assert len(lines) == 10
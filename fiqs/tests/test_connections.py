@@ -0,0 +1,59 @@
+import pytest
+from elasticsearch.dsl.connections import get_connection
+
+from fiqs import connections
+from fiqs.exceptions import ConfigurationError
+
+
+@pytest.fixture
+def alias():
+    yield "fiqs_tests_cluster"
+    connections.remove("fiqs_tests_cluster")
+
+
+def test_configure(alias):
+    client = connections.configure(
+        alias,
+        hosts=["http://localhost:9200"],
+        pool_size=4,
+        compression=True,
+        request_timeout=12,
+    )
+
+    assert connections.get_client(alias) is client
+    # Searches using the alias get the same client
+    assert get_connection(alias) is client
+
+    node = client.transport.node_pool.all()[0]
+    assert node.config.connections_per_node == 4
+    assert node.config.http_compress
+    assert client._request_timeout == 12
+    # Rejected requests are retried by the concurrency limiter
+    assert 429 not in client._retry_on_status
+
+    # A new configuration replaces the client
+    other_client = connections.configure(alias, hosts=["http://localhost:9200"])
+    assert connections.get_client(alias) is other_client
+
+
+def test_unknown_alias(alias):
+    with pytest.raises(ConfigurationError):
+        connections.get_client(alias)
+    with pytest.raises(ConfigurationError):
+        connections.get_async_client(alias)
+
+    connections.configure(alias, hosts=["http://localhost:9200"])
+    connections.remove(alias)
+    with pytest.raises(ConfigurationError):
+        connections.get_client(alias)
+
+
+def test_async_client(alias):
+    pytest.importorskip("aiohttp")
+    connections.configure(alias, hosts=["http://localhost:9200"], pool_size=4)
+
+    client = connections.get_async_client(alias)
+
+    assert connections.get_async_client(alias) is client
+    node = client.transport.node_pool.all()[0]
+    assert node.config.connections_per_node == 4
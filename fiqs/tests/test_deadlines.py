@@ -0,0 +1,101 @@
+import asyncio
+import itertools
+from datetime import timedelta
+
+import pytest
+from elasticsearch import ConnectionTimeout
+
+from fiqs.exceptions import DeadlineExceededError, PartialResultsError
+from fiqs.testing.utils import get_search
+from fiqs.tests.conftest import (
+    FakeClient,
+    get_fake_search,
+    get_total_sales_by_shop_fquery,
+)
+
+
+def test_deadline():
+    fsearch = get_fake_search("total_sales_by_shop")
+    fquery = get_total_sales_by_shop_fquery(fsearch)
+    expected = fquery.eval()
+    assert fsearch._using.requests[-1]["options"] == {}
+
+    assert fquery.eval(deadline=timedelta(seconds=5)) == expected
+
+    request = fsearch._using.requests[-1]
+    timeout = int(request["params"]["timeout"].removesuffix("ms"))
+    assert 4000 < timeout <= 4500
+    assert 4.5 < request["options"]["request_timeout"] <= 5
+    assert request["options"]["opaque_id"].startswith("fiqs-")
+
+    fquery.prepare().eval(deadline=5, opaque_id="my-request")
+    assert fsearch._using.requests[-1]["options"]["opaque_id"] == "my-request"
+
+    nb_requests = len(fsearch._using.requests)
+    with pytest.raises(DeadlineExceededError):
+        fquery.eval(deadline=0)
+    assert len(fsearch._using.requests) == nb_requests
+
+
+def test_deadline_exceeded():
+    client = FakeClient(
+        "total_sales_by_shop",
+        errors=itertools.repeat(ConnectionTimeout("Connection timed out")),
+    )
+    fquery = get_total_sales_by_shop_fquery(get_search(client=client))
+
+    with pytest.raises(DeadlineExceededError, match="the search was cancelled"):
+        fquery.eval(deadline=5)
+    opaque_id = client.requests[-1]["options"]["opaque_id"]
+    assert client.tasks.cancelled == [opaque_id]
+
+    # Without a deadline, the timeout of the client is raised as is
+    with pytest.raises(ConnectionTimeout):
+        fquery.eval()
+    # And when the task is over, nothing is cancelled
+    client.tasks.list = lambda **params: {"nodes": {}}
+    with pytest.raises(DeadlineExceededError) as excinfo:
+        fquery.eval(deadline=5)
+    assert str(excinfo.value) == "Deadline exceeded"
+
+
+@pytest.mark.parametrize(
+    "partial",
+    [
+        {"timed_out": True},
+        {"_shards": {"total": 5, "successful": 3, "skipped": 0, "failed": 2}},
+    ],
+)
+def test_deadline_partial_results(partial):
+    fsearch = get_fake_search(
+        "total_sales_by_shop", transform=lambda body, result: dict(result, **partial)
+    )
+    fquery = get_total_sales_by_shop_fquery(fsearch)
+
+    with pytest.raises(PartialResultsError) as excinfo:
+        fquery.eval(deadline=5)
+    assert excinfo.value.result["aggregations"]
+
+    # Without a deadline, results are flattened as before
+    assert fquery.eval()
+
+
+def test_aeval_cancellation():
+    client = FakeClient("total_sales_by_shop", block=lambda params: True)
+    fquery = get_total_sales_by_shop_fquery(get_search(client=client))
+
+    async def run():
+        assert await fquery.aeval() == fquery.eval()
+
+        client.release.clear()
+        task = asyncio.create_task(fquery.aeval(opaque_id="my-request"))
+        while not client.tasks.running:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    client.release.set()
+    asyncio.run(run())
+    # The blocked search was cancelled
+    assert client.tasks.cancelled == ["my-request"]
@@ -829,3 +829,18 @@ def test_nb_sales_by_product_type_by_part_id_filter_product_type_1(elasticsearch
         a,
     )
     write_output(search, "nb_sales_by_product_type_by_part_id_filter_product_type_1")
+
+
+def test_total_sales_by_shop_with_profile(elasticsearch_sale):
+    # Total sales by shop, profiled by Elasticsearch
+    search = get_search().extra(profile=True, size=0)
+    search.aggs.bucket(
+        "shop_id",
+        "terms",
+        field="shop_id",
+    ).metric(
+        "total_sales",
+        "sum",
+        field="price",
+    )
+    write_output(search, "total_sales_by_shop_with_profile")
@@ -0,0 +1,190 @@
+import pytest
+
+from fiqs.aggregations import Cardinality, Count, Ratio, ReverseNested, Sum
+from fiqs.exceptions import ConfigurationError
+from fiqs.query import FQuery
+from fiqs.testing.models import Sale
+from fiqs.testing.utils import get_search
+from fiqs.tests.conftest import get_fake_search
+
+
+def select_buckets(body, result):
+    """Prunes the payment type buckets whose total sales are not greater than
+    the threshold, like the bucket_selector aggregation would"""
+    having = body["aggs"]["payment_type"]["aggs"]["fiqs_having"]
+    threshold = having["bucket_selector"]["script"]["params"]["t0"]
+    aggregation = result["aggregations"]["payment_type"]
+    aggregation["buckets"] = [
+        bucket
+        for bucket in aggregation["buckets"]
+        if bucket["total_sales"]["value"] > threshold
+    ]
+    return result
+
+
+def test_having():
+    fquery = (
+        FQuery(get_search())
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.shop_id,
+            Sale.payment_type,
+        )
+        .having("total_sales", gt=1000)
+    )
+
+    body = fquery._build_body()
+    shop_aggs = body["aggs"]["shop_id"]["aggs"]
+    assert "fiqs_having" not in shop_aggs
+    assert shop_aggs["payment_type"]["aggs"]["fiqs_having"] == {
+        "bucket_selector": {
+            "buckets_path": {"v0": "total_sales"},
+            "script": {
+                "source": "params.v0 > params.t0",
+                "params": {"t0": 1000},
+            },
+        },
+    }
+    # Same aggregations in non-flat mode
+    assert fquery._configure_search().to_dict() == body
+
+
+def test_having_level():
+    fquery = (
+        FQuery(get_search())
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.shop_id,
+            Sale.payment_type,
+        )
+        .having("total_sales", gt=1000, level=Sale.shop_id)
+        .having(Ratio(Sum(Sale.price), Count(Sale)), gt=50, level=Sale.shop_id)
+        .having("doc_count", gt=5)
+    )
+
+    body = fquery._build_body()
+    shop_aggs = body["aggs"]["shop_id"]["aggs"]
+    # The metrics of the upper level are hidden, like the ones we order by
+    assert shop_aggs["fiqs_hidden__total_sales"] == {"sum": {"field": "price"}}
+    assert shop_aggs["fiqs_having"] == {
+        "bucket_selector": {
+            "buckets_path": {"v0": "fiqs_hidden__total_sales", "v1": "_count"},
+            "script": {
+                "source": "params.v0 > params.t0 && "
+                "(params.v1 == 0 ? Double.NaN : 100.0 * params.v0 / params.v1)"
+                " > params.t1",
+                "params": {"t0": 1000, "t1": 50},
+            },
+        },
+    }
+    assert shop_aggs["payment_type"]["aggs"]["fiqs_having"] == {
+        "bucket_selector": {
+            "buckets_path": {"v0": "_count"},
+            "script": {"source": "params.v0 > params.t0", "params": {"t0": 5}},
+        },
+    }
+    assert fquery._configure_search().to_dict() == body
+
+    fquery.having("total_sales", gt=1, level=Sale.client_id)
+    with pytest.raises(ConfigurationError):
+        fquery._build_body()
+
+
+def test_having_computed_expressions():
+    fquery = (
+        FQuery(get_search())
+        .values(
+            Count(Sale),
+            total_sales=Sum(Sale.price),
+            total_sales_bis=Sum(Sale.price),
+            nb_clients=ReverseNested(Sale, Cardinality(Sale.client_id)),
+        )
+        .group_by(
+            Sale.shop_id,
+        )
+        .having("doc_count", gte=10, lt=100)
+        .having(Ratio(Sum(Sale.price), Count(Sale)), gt=50)
+        .having("total_sales_bis", lte=5000)
+        .having("reverse_nested_root__sale__client_id__cardinality", gt=1)
+    )
+
+    having = fquery._build_body()["aggs"]["shop_id"]["aggs"]["fiqs_having"]
+
+    # Identical metrics are sent once, and share their buckets path
+    assert having["bucket_selector"] == {
+        "buckets_path": {
+            "v0": "_count",
+            "v1": "total_sales",
+            "v2": "reverse_nested_root>sale__client_id__cardinality",
+        },
+        "script": {
+            "source": " && ".join(
+                [
+                    "params.v0 >= params.t0",
+                    "params.v0 < params.t1",
+                    "(params.v0 == 0 ? Double.NaN : 100.0 * params.v1 / params.v0)"
+                    " > params.t2",
+                    "params.v1 <= params.t3",
+                    "params.v2 > params.t4",
+                ]
+            ),
+            "params": {"t0": 10, "t1": 100, "t2": 50, "t3": 5000, "t4": 1},
+        },
+    }
+    # The ratio was added to the values
+    assert str(Ratio(Sum(Sale.price), Count(Sale))) in fquery._expressions
+
+
+def test_having_does_not_fill_pruned_buckets():
+    search = get_fake_search("total_sales_by_payment_type", transform=select_buckets)
+    fquery = (
+        FQuery(search)
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.payment_type,
+        )
+        .having("total_sales", gt=80000)
+    )
+
+    lines = fquery.eval()
+    assert sorted(line["payment_type"] for line in lines) == [
+        "store_credit",
+        "wire_transfer",
+    ]
+
+    lines = fquery.prepare().eval()
+    assert len(lines) == 2
+
+
+def test_having_errors():
+    fquery = FQuery(get_search()).values(
+        total_sales=Sum(Sale.price),
+    )
+
+    with pytest.raises(ConfigurationError):
+        fquery.having("total_sales")
+    with pytest.raises(ConfigurationError):
+        fquery.having("total_sales", gt=1, between=(1, 2))
+    with pytest.raises(ConfigurationError):
+        fquery.having(ReverseNested(Sale, Count(Sale)), gt=1)
+
+    # No group_by
+    fquery.having("total_sales", gt=1)
+    with pytest.raises(ConfigurationError):
+        fquery._build_body()
+
+    fquery.group_by(Sale.shop_id)
+    fquery._build_body()
+
+    with pytest.raises(ConfigurationError):
+        fquery.eval(sample=0.1)
+
+    fquery.having("unknown", gt=1)
+    with pytest.raises(ConfigurationError):
+        fquery._build_body()
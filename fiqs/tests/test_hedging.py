@@ -0,0 +1,150 @@
+import threading
+import time
+
+from fiqs.hedging import HedgeRace, HedgingPolicy
+from fiqs.testing.utils import get_search
+from fiqs.tests.conftest import (
+    FakeClient,
+    get_fake_search,
+    get_total_sales_by_shop_fquery,
+    wait_for,
+)
+
+
+def is_hedge(params):
+    return params.get("preference", "").startswith("fiqs-hedge-")
+
+
+def test_hedging_delay():
+    policy = HedgingPolicy(percentile=90, min_samples=5, window=10)
+
+    for latency in range(4):
+        policy.record_latency(latency / 10)
+    assert policy.delay() is None
+
+    policy.record_latency(0.4)
+    assert policy.delay() == 0.4
+
+    for latency in range(10, 20):
+        policy.record_latency(latency / 10)
+    # Only the last 10 latencies are kept
+    assert policy.delay() == 1.8
+
+
+def test_hedging_budget():
+    policy = HedgingPolicy(budget=0.1)
+
+    for _ in range(9):
+        policy.count_request()
+    assert not policy.within_budget()
+    assert not policy.reserve_hedge()
+
+    policy.count_request()
+    assert policy.reserve_hedge()
+    assert not policy.reserve_hedge()
+    assert policy.hedged == 1
+
+    policy.count_win()
+    assert policy.hedge_rate == 0.1
+    assert policy.win_rate == 1.0
+
+
+def test_hedging_rates():
+    policy = HedgingPolicy()
+
+    assert policy.hedge_rate == 0.0
+    assert policy.win_rate == 0.0
+
+
+def test_hedging_schedule():
+    policy = HedgingPolicy()
+    calls = []
+    done = threading.Event()
+
+    cancelled = policy.schedule(0.01, calls.append, "cancelled")
+    cancelled.set()
+    policy.schedule(0.02, calls.append, "run")
+    policy.schedule(0.03, done.set)
+
+    assert done.wait(5)
+    assert calls == ["run"]
+
+
+def test_hedge_race():
+    # The hedge answers first, the request must be cancelled
+    race = HedgeRace()
+    assert race.start_hedge()
+    assert race.finish_hedge("hedge")
+    assert race.finish_request(failed=True) == "won"
+    assert race.hedge_response == "hedge"
+
+    # The request answers first
+    race = HedgeRace()
+    assert race.start_hedge()
+    assert race.finish_request() == "lost"
+    assert not race.finish_hedge("hedge")
+
+    # The request answered before the delay
+    race = HedgeRace()
+    assert race.finish_request() is None
+    assert not race.start_hedge()
+
+
+def test_hedge():
+    policy = HedgingPolicy(percentile=50, budget=1, min_samples=2)
+    policy.record_latency(0.05)
+    policy.record_latency(0.05)
+    # Requests sent without a hedging preference hang until cancelled
+    client = FakeClient(
+        "total_sales_by_shop", block=lambda params: not is_hedge(params)
+    )
+    fquery = get_total_sales_by_shop_fquery(get_search(client=client), hedge=policy)
+
+    lines = fquery.eval(opaque_id="dashboard")
+
+    expected = get_total_sales_by_shop_fquery(get_fake_search("total_sales_by_shop"))
+    assert lines == expected.eval()
+    request, hedge = client.requests
+    assert "preference" not in request["params"]
+    assert is_hedge(hedge["params"])
+    assert hedge["options"]["opaque_id"] == "dashboard-hedge"
+
+    # The slow search is cancelled
+    wait_for(lambda: client.tasks.cancelled)
+    assert client.tasks.cancelled == ["dashboard"]
+    assert (policy.requests, policy.hedged, policy.hedge_wins) == (1, 1, 1)
+    assert policy.hedge_rate == policy.win_rate == 1.0
+
+
+def test_hedge_not_needed():
+    policy = HedgingPolicy(budget=1, min_samples=1, window=1)
+    client = FakeClient("total_sales_by_shop")
+    fquery = get_total_sales_by_shop_fquery(get_search(client=client), hedge=policy)
+
+    # Without latencies, we do not know when to hedge
+    assert policy.delay() is None
+    fquery.eval()
+    assert policy.delay() < 5
+
+    # Fast requests are not hedged
+    policy.record_latency(5)
+    assert policy.delay() == 5
+    fquery.eval()
+    assert len(client.requests) == 2
+    assert client.requests[1]["options"]["opaque_id"].startswith("fiqs-")
+    assert (policy.requests, policy.hedged) == (2, 0)
+
+
+def test_hedge_busy_pool():
+    policy = HedgingPolicy(budget=1, min_samples=1, max_workers=1)
+    policy.record_latency(5)
+    busy = threading.Event()
+    policy.submit(busy.wait, 5)
+    fsearch = get_fake_search("total_sales_by_shop")
+    fquery = get_total_sales_by_shop_fquery(fsearch, hedge=policy)
+
+    # The request does not wait for the hedging pool
+    start = time.monotonic()
+    assert len(fquery.eval()) == 10
+    assert time.monotonic() - start < 1
+    busy.set()
@@ -0,0 +1,173 @@
+import threading
+import time
+
+import pytest
+from elasticsearch import ApiError
+
+from fiqs.exceptions import DeadlineExceededError
+from fiqs.limiting import ConcurrencyLimiter, is_rejected
+from fiqs.testing.utils import get_search
+from fiqs.tests.conftest import (
+    FakeClient,
+    api_error,
+    get_fake_search,
+    get_total_sales_by_shop_fquery,
+)
+
+
+def test_is_rejected():
+    assert is_rejected(api_error(429))
+    assert not is_rejected(api_error(500))
+    assert not is_rejected(ValueError())
+
+
+def test_limiter_aimd():
+    limiter = ConcurrencyLimiter(initial_limit=2, max_limit=3, backoff_ratio=0.5)
+
+    # The limit grows by one every `limit` successful requests
+    limiter.acquire()
+    limiter.release(0.1)
+    assert limiter.limit == 2.5
+    for _ in range(5):
+        limiter.acquire()
+        limiter.release(0.1)
+    assert limiter.limit == 3
+
+    limiter.acquire()
+    limiter.release(0.1, rejected=True)
+    assert limiter.limit == 1.5
+    assert limiter.rejected == 1
+
+    assert limiter.in_flight == 0
+
+
+def test_limiter_latency_gradient():
+    limiter = ConcurrencyLimiter(initial_limit=3, short_window=10, backoff_ratio=0.5)
+    for _ in range(10):
+        limiter.acquire()
+        limiter.release(0.1)
+    limit = limiter.limit
+
+    # A single slow request is noise
+    limiter.acquire()
+    limiter.release(0.5)
+    assert limiter.limit > limit
+
+    # The recent latency rising over twice its usual value decreases the limit
+    limit = limiter.limit
+    limiter.acquire()
+    limiter.release(0.5)
+    assert limiter.limit == limit / 2
+
+    # Whatever the latency of other kinds of requests, only the gradient counts
+    limiter = ConcurrencyLimiter(initial_limit=3)
+    for idx in range(50):
+        limiter.acquire()
+        limiter.release(0.01 if idx % 2 else 1)
+    assert limiter.limit > 3
+
+
+def test_limiter_priorities():
+    limiter = ConcurrencyLimiter(initial_limit=1)
+    order = []
+
+    limiter.acquire()
+
+    def request(priority):
+        limiter.run(lambda: order.append(priority), priority=priority)
+
+    threads = []
+    for priority in [0, 10, 5]:
+        thread = threading.Thread(target=request, args=(priority,))
+        thread.start()
+        threads.append(thread)
+        while len(limiter._queue) < len(threads):
+            time.sleep(0.001)
+
+    limiter.release(0.1)
+    for thread in threads:
+        thread.join()
+
+    assert order == [10, 5, 0]
+
+
+def test_limiter_deadline():
+    limiter = ConcurrencyLimiter(initial_limit=1)
+    limiter.acquire()
+
+    with pytest.raises(DeadlineExceededError):
+        limiter.run(lambda: None, timeout=0.01)
+    assert limiter._queue == []
+
+
+def test_limiter_retries(monkeypatch):
+    delays = []
+    monkeypatch.setattr("fiqs.limiting.time.sleep", delays.append)
+    limiter = ConcurrencyLimiter(max_retries=2, base_delay=1)
+    errors = [api_error(429), api_error(429)]
+
+    def request():
+        if errors:
+            raise errors.pop()
+        return "result"
+
+    assert limiter.run(request) == "result"
+    assert limiter.retries == 2
+    assert limiter.rejected == 2
+    # Full jitter, growing exponentially
+    assert 0 <= delays[0] <= 1 and 0 <= delays[1] <= 2
+
+    errors = [api_error(429)] * 3
+    with pytest.raises(ApiError):
+        limiter.run(request)
+    assert limiter.retries == 4
+
+    # Other errors are not retried, and do not change the limit
+    errors = [api_error(500)]
+    limit = limiter.limit
+    with pytest.raises(ApiError):
+        limiter.run(request)
+    assert limiter.retries == 4
+    assert limiter.limit == limit
+    assert limiter.in_flight == 0
+
+
+def test_limiter_fquery(limiter):
+    client = FakeClient("total_sales_by_shop", errors=[api_error(429)])
+    fquery = get_total_sales_by_shop_fquery(get_search(client=client))
+
+    lines = fquery.eval()
+
+    assert len(lines) == 10
+    assert len(client.requests) == 2
+    assert (limiter.rejected, limiter.retries, limiter.in_flight) == (1, 1, 0)
+
+
+def test_limiter_fquery_deadline(limiter):
+    # The only slot is taken
+    limiter.limit = 1
+    limiter.acquire()
+    fquery = get_total_sales_by_shop_fquery(get_fake_search("total_sales_by_shop"))
+
+    with pytest.raises(DeadlineExceededError):
+        fquery.eval(deadline=0.05)
+    assert limiter._queue == []
+
+
+def test_limiter_fquery_deadline_after_queueing(limiter):
+    limiter.limit = 1
+    limiter.acquire()
+    fsearch = get_fake_search("total_sales_by_shop")
+    fquery = get_total_sales_by_shop_fquery(fsearch)
+
+    # The slot is freed after 0.3s
+    timer = threading.Timer(0.3, limiter.release)
+    timer.start()
+    fquery.eval(deadline=1)
+    timer.join()
+
+    # The timeouts are the time left once out of the queue
+    request = fsearch._using.requests[-1]
+    assert request["options"]["request_timeout"] <= 0.7
+    timeout = int(request["params"]["timeout"].removesuffix("ms"))
+    assert timeout <= 0.7 * 900
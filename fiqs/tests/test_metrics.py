@@ -0,0 +1,151 @@
+import pytest
+
+from fiqs.caching import DiskCache
+from fiqs.metrics import Counter, Histogram, MetricsRegistry, set_registry
+from fiqs.profiling import Profile
+from fiqs.testing.models import Sale
+from fiqs.testing.utils import get_search
+from fiqs.tests.conftest import (
+    FakeClient,
+    api_error,
+    get_fake_search,
+    get_total_sales_by_shop_fquery,
+)
+
+
+def test_counter():
+    counter = Counter("fiqs_lines_total", "Lines", ("shape",))
+
+    counter.inc(("a",))
+    counter.inc(("a",), 2)
+    counter.inc(("b",))
+
+    assert list(counter.samples()) == [
+        ("fiqs_lines_total", {"shape": "a"}, 3),
+        ("fiqs_lines_total", {"shape": "b"}, 1),
+    ]
+
+
+def test_histogram():
+    histogram = Histogram("fiqs_eval_seconds", "Latency", ("shape",), buckets=(1, 5))
+
+    histogram.observe(("a",), 0.5)
+    histogram.observe(("a",), 3)
+    histogram.observe(("a",), 10)
+
+    assert list(histogram.samples()) == [
+        ("fiqs_eval_seconds_bucket", {"shape": "a", "le": "1.0"}, 1),
+        ("fiqs_eval_seconds_bucket", {"shape": "a", "le": "5.0"}, 2),
+        ("fiqs_eval_seconds_bucket", {"shape": "a", "le": "+Inf"}, 3),
+        ("fiqs_eval_seconds_sum", {"shape": "a"}, 13.5),
+        ("fiqs_eval_seconds_count", {"shape": "a"}, 3),
+    ]
+
+
+def get_profile():
+    profile = Profile(trace_allocations=False)
+    with profile.stage("request"):
+        pass
+    profile.count("lines", 10)
+    profile.count("filled_lines", 2)
+    profile.count("buckets", 12)
+    profile.response_size = 2000
+    return profile
+
+
+def test_registry():
+    registry = MetricsRegistry()
+    records = []
+    registry.add_callback(records.append)
+
+    registry.record_eval("abc", "Sale", get_profile())
+    registry.record_eval("abc", "Sale", get_profile())
+    registry.count_retry()
+
+    assert registry.evals.values == {("abc", "Sale"): 2}
+    assert registry.lines.values == {("abc", "Sale"): 20}
+    assert registry.filled_lines.values == {("abc", "Sale"): 4}
+    assert registry.buckets.values == {("abc", "Sale"): 24}
+    assert registry.cache_hits.values == {}
+    assert registry.retries.values == {(): 1}
+    assert registry.response_bytes.values[("abc", "Sale")][-1] == 4000
+
+    assert len(records) == 2
+    assert records[0]["shape"] == "abc"
+    assert records[0]["model"] == "Sale"
+    assert records[0]["lines"] == 10
+
+
+def test_prometheus():
+    registry = MetricsRegistry()
+    registry.record_eval("abc", 'Sale"\n', get_profile())
+    registry.count_retry()
+
+    text = registry.to_prometheus()
+
+    assert text.endswith("\n")
+    assert "# TYPE fiqs_evals_total counter\n" in text
+    assert "# TYPE fiqs_eval_seconds histogram\n" in text
+    assert 'fiqs_evals_total{shape="abc",model="Sale\\"\\n"} 1\n' in text
+    assert 'fiqs_lines_total{shape="abc",model="Sale\\"\\n"} 10\n' in text
+    assert (
+        'fiqs_response_bytes_bucket{shape="abc",model="Sale\\"\\n",le="10000.0"} 1\n'
+        in text
+    )
+    assert (
+        'fiqs_stage_seconds_count{shape="abc",model="Sale\\"\\n",stage="request"} 1\n'
+        in text
+    )
+    assert "fiqs_request_retries_total 1\n" in text
+
+
+@pytest.fixture
+def registry():
+    registry = MetricsRegistry()
+    set_registry(registry)
+    yield registry
+    set_registry(None)
+
+
+def test_shape():
+    fquery = get_total_sales_by_shop_fquery(get_search())
+    shape = fquery.shape()
+
+    assert len(shape) == 12
+    fquery.search = fquery.search.filter("term", shop_id=1)
+    assert fquery.shape() == shape
+    assert fquery.group_by(Sale.payment_type).shape() != shape
+
+
+def test_metrics(registry, tmp_path):
+    records = []
+    registry.add_callback(records.append)
+    fquery = get_total_sales_by_shop_fquery(
+        get_fake_search("total_sales_by_shop"),
+        cache=DiskCache(tmp_path / "cache.sqlite"),
+    )
+    labels = (fquery.shape(), "Sale")
+
+    assert fquery.eval() == fquery.eval()
+    lines, profile = fquery.eval(profile=True)
+
+    assert registry.evals.values == {labels: 3}
+    assert registry.lines.values == {labels: 30}
+    assert registry.buckets.values == {labels: 30}
+    assert registry.cache_hits.values == {labels: 2}
+    # Responses served by the cache have no size
+    assert sum(registry.response_bytes.values[labels][:-1]) == 1
+    stages = {key[2] for key in registry.stage_seconds.values}
+    assert {"build", "cache", "request", "flatten", "cast"} <= stages
+    assert [record["cached"] for record in records] == [False, True, True]
+
+    prepared = fquery.prepare()
+    prepared.eval()
+    assert registry.evals.values == {labels: 4}
+
+
+def test_metrics_retries(registry, limiter):
+    client = FakeClient("total_sales_by_shop", errors=[api_error(429)])
+    get_total_sales_by_shop_fquery(get_search(client=client)).eval()
+
+    assert registry.retries.values == {(): 1}
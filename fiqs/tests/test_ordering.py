@@ -0,0 +1,252 @@
+from datetime import datetime
+
+import pytest
+
+from fiqs.aggregations import Count, DateHistogram, Ratio, Sum
+from fiqs.exceptions import ConfigurationError
+from fiqs.query import FQuery
+from fiqs.testing.models import Sale
+from fiqs.testing.utils import get_search
+from fiqs.tests.conftest import get_fake_search
+
+
+def add_hidden_values(body, result):
+    """Adds the values of the hidden aggregations of the request to the
+    recorded result, as Elasticsearch would"""
+
+    def add(aggs, node):
+        for name, agg in aggs.items():
+            if name.startswith("fiqs_hidden__") and "bucket_sort" not in agg:
+                node[name] = {"value": 1.0}
+            elif name in node and "buckets" in node[name]:
+                for bucket in node[name]["buckets"]:
+                    add(agg.get("aggs", {}), bucket)
+
+    add(body["aggs"], result["aggregations"])
+    return result
+
+
+def test_order_by_level():
+    fquery = (
+        FQuery(get_search())
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.shop_id,
+            Sale.payment_type,
+        )
+        .order_by({"total_sales": "desc"}, level=Sale.shop_id, limit=3)
+        .order_by({"total_sales": "desc", "_key": "asc"}, limit=2)
+    )
+
+    body = fquery._build_body()
+    shop_agg = body["aggs"]["shop_id"]
+    assert shop_agg["terms"] == {
+        "field": "shop_id",
+        "order": {"fiqs_hidden__total_sales": "desc"},
+        "size": 3,
+    }
+    assert shop_agg["aggs"]["fiqs_hidden__total_sales"] == {"sum": {"field": "price"}}
+
+    payment_type_agg = shop_agg["aggs"]["payment_type"]
+    assert payment_type_agg["terms"] == {
+        "field": "payment_type",
+        "order": [{"total_sales": "desc"}, {"_key": "asc"}],
+        "size": 2,
+    }
+    assert list(payment_type_agg["aggs"]) == ["total_sales"]
+
+    # Same aggregations in non-flat mode
+    assert fquery._configure_search().to_dict() == body
+
+
+def test_order_by_computed_expression():
+    fquery = (
+        FQuery(get_search())
+        .values(
+            Count(Sale),
+            total_sales=Sum(Sale.price),
+            average_sale=Ratio(Sum(Sale.price), Count(Sale)),
+        )
+        .group_by(
+            Sale.shop_id,
+            DateHistogram(
+                Sale.timestamp,
+                interval="1d",
+                min=datetime(2016, 1, 1),
+                max=datetime(2016, 1, 31),
+            ),
+        )
+        .order_by({"average_sale": "desc"}, level=Sale.shop_id, limit=5)
+        .order_by({"doc_count": "desc"}, limit=10)
+    )
+
+    body = fquery._build_body()
+    shop_aggs = body["aggs"]["shop_id"]["aggs"]
+    assert "order" not in body["aggs"]["shop_id"]["terms"]
+    assert shop_aggs["fiqs_hidden__average_sale"] == {
+        "bucket_script": {
+            "buckets_path": {"v0": "fiqs_hidden__total_sales", "v1": "_count"},
+            "script": "(params.v1 == 0 ? Double.NaN : 100.0 * params.v0 / params.v1)",
+        },
+    }
+    assert shop_aggs["fiqs_hidden__total_sales"] == {"sum": {"field": "price"}}
+    assert shop_aggs["fiqs_hidden__sort"] == {
+        "bucket_sort": {
+            "sort": [{"fiqs_hidden__average_sale": {"order": "desc"}}],
+            "size": 5,
+        },
+    }
+
+    # Histograms are ordered by a bucket_sort aggregation
+    timestamp_aggs = shop_aggs["timestamp"]["aggs"]
+    assert timestamp_aggs["fiqs_hidden__sort"] == {
+        "bucket_sort": {"sort": [{"_count": {"order": "desc"}}], "size": 10},
+    }
+
+
+def test_order_by_hidden_aggregations_are_removed():
+    fsearch = get_fake_search("total_sales_by_payment_type_by_shop")
+    expected = (
+        FQuery(fsearch)
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.payment_type,
+            Sale.shop_id,
+        )
+        .eval(fill_missing_buckets=False)
+    )
+
+    search = get_fake_search(
+        "total_sales_by_payment_type_by_shop", transform=add_hidden_values
+    )
+    fquery = (
+        FQuery(search)
+        .values(
+            total_sales=Sum(Sale.price),
+            total_sales_ratio=Ratio(Sum(Sale.price), Sum(Sale.price)),
+        )
+        .group_by(
+            Sale.payment_type,
+            Sale.shop_id,
+        )
+        .order_by({"total_sales": "asc"}, level=Sale.payment_type)
+        .order_by({"total_sales_ratio": "desc"}, limit=5)
+    )
+    lines = fquery.eval()
+
+    # Missing buckets are not filled, they may have been left out by the limit
+    assert [
+        {
+            key: value
+            for key, value in line.items()
+            if key not in ("total_sales_ratio", "sale__price__sum")
+        }
+        for line in lines
+    ] == expected
+    assert fquery.prepare().eval() == lines
+
+
+def test_order_by_expression_without_level():
+    fquery = (
+        FQuery(get_search())
+        .values(
+            total_sales=Sum(Sale.price),
+            average_sale=Ratio(Sum(Sale.price), Count(Sale)),
+        )
+        .group_by(
+            Sale.shop_id,
+        )
+        .order_by({Sum(Sale.price): "desc"})
+    )
+
+    shop_agg = fquery._build_body()["aggs"]["shop_id"]
+    # Sent under the key of the identical value
+    assert shop_agg["terms"]["order"] == {"total_sales": "desc"}
+
+    # Computed expressions are ordered by a bucket_sort
+    fquery.order_by({"average_sale": "asc"})
+    shop_agg = fquery._build_body()["aggs"]["shop_id"]
+    assert "order" not in shop_agg["terms"]
+    assert shop_agg["aggs"]["fiqs_hidden__sort"] == {
+        "bucket_sort": {
+            "sort": [{"fiqs_hidden__average_sale": {"order": "asc"}}],
+        },
+    }
+
+
+def test_order_by_limit_with_having():
+    fquery = (
+        FQuery(get_search())
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.shop_id,
+        )
+        .order_by({"total_sales": "desc"}, limit=3)
+        .having("total_sales", gt=1000)
+    )
+
+    body = fquery._build_body()
+    shop_agg = body["aggs"]["shop_id"]
+    # The first 3 buckets are kept after the bucket_selector
+    assert shop_agg["terms"] == {
+        "field": "shop_id",
+        "order": {"total_sales": "desc"},
+    }
+    assert list(shop_agg["aggs"]) == ["total_sales", "fiqs_having", "fiqs_hidden__sort"]
+    assert shop_agg["aggs"]["fiqs_hidden__sort"] == {"bucket_sort": {"size": 3}}
+    assert fquery._configure_search().to_dict() == body
+
+
+def test_order_by_errors():
+    fquery = (
+        FQuery(get_search())
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.shop_id,
+        )
+    )
+
+    with pytest.raises(ConfigurationError):
+        fquery.order_by({"total_sales": "down"}, limit=2)
+    with pytest.raises(ConfigurationError):
+        fquery.order_by({"total_sales": "desc"}, limit=0)
+
+    fquery.order_by({"total_sales": "desc"}, level=Sale.payment_type)
+    with pytest.raises(ConfigurationError):
+        fquery._build_body()
+
+    fquery = (
+        FQuery(get_search())
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.shop_id,
+        )
+        .order_by({"unknown": "desc"}, level=Sale.shop_id)
+    )
+    with pytest.raises(ConfigurationError):
+        fquery._build_body()
+
+    fquery = (
+        FQuery(get_search())
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.shop_id,
+            Sale.client_id,
+        )
+        .order_by({"total_sales": "desc"}, level=Sale.client_id, limit=10)
+        .partition(Sale.client_id)
+    )
+    with pytest.raises(ConfigurationError):
+        fquery.eval()
@@ -0,0 +1,250 @@
+import pytest
+from elasticsearch.dsl import Search
+from elasticsearch.dsl.connections import add_connection, remove_connection
+
+from fiqs.aggregations import Count, Ratio, Sum
+from fiqs.caching import DiskCache
+from fiqs.exceptions import ConfigurationError
+from fiqs.fields import GroupedField
+from fiqs.query import FQuery
+from fiqs.testing.models import Sale
+from fiqs.testing.utils import get_search
+from fiqs.tests.conftest import FakeClient, get_fake_search, load_output
+
+
+def composite_page(body, result):
+    """Answers the composite aggregation of pages with the buckets of a
+    recorded two levels result"""
+    composite = body["aggs"]["page"]["composite"]
+    names = [next(iter(source)) for source in composite["sources"]]
+    buckets = []
+    for outer_bucket in result["aggregations"][names[0]]["buckets"]:
+        for inner_bucket in outer_bucket[names[1]]["buckets"]:
+            bucket = {"key": {names[0]: outer_bucket["key"]}}
+            bucket["key"][names[1]] = inner_bucket["key"]
+            bucket["doc_count"] = inner_bucket["doc_count"]
+            if "aggs" in body["aggs"]["page"]:
+                bucket["total_sales"] = inner_bucket["total_sales"]
+            buckets.append(bucket)
+
+    def sort_key(bucket):
+        return tuple(bucket["key"][name] for name in names)
+
+    buckets.sort(key=sort_key)
+    if "after" in composite:
+        after = tuple(composite["after"][name] for name in names)
+        buckets = [bucket for bucket in buckets if sort_key(bucket) > after]
+    buckets = buckets[: composite["size"]]
+
+    page = {"buckets": buckets}
+    if buckets:
+        page["after_key"] = buckets[-1]["key"]
+    result["aggregations"] = {"page": page}
+    return result
+
+
+def test_page_single_level():
+    fsearch = get_fake_search("total_sales_by_shop")
+    fquery = (
+        FQuery(fsearch)
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.shop_id,
+        )
+    )
+
+    lines = fquery.page(4, per_page=3, order_by={"total_sales": "desc"})
+
+    shop_agg = fsearch._using.requests[-1]["body"]["aggs"]["shop_id"]
+    assert shop_agg["terms"] == {
+        "field": "shop_id",
+        "order": {"total_sales": "desc"},
+        # The terms aggregation returns the buckets of the first pages
+        "size": 12,
+    }
+    assert shop_agg["aggs"]["fiqs_hidden__sort"] == {
+        "bucket_sort": {"from": 9, "size": 3},
+    }
+    # The recorded output is not paged, but the lines are not filled
+    output = load_output("total_sales_by_shop")
+    assert len(lines) == len(output["aggregations"]["shop_id"]["buckets"])
+
+    # The query itself is left untouched
+    assert "fiqs_hidden__sort" not in fquery._build_body()["aggs"]["shop_id"]["aggs"]
+
+    # Computed expressions are sorted by the bucket_sort aggregation
+    fquery.page(2, per_page=20, order_by={Ratio(Sum(Sale.price), Count(Sale)): "asc"})
+
+    shop_agg = fsearch._using.requests[-1]["body"]["aggs"]["shop_id"]
+    assert shop_agg["terms"]["size"] == 40
+    assert shop_agg["aggs"]["fiqs_hidden__sort"] == {
+        "bucket_sort": {
+            "sort": [
+                {"fiqs_hidden__sale__price__sum__div__doc_count": {"order": "asc"}}
+            ],
+            "from": 20,
+            "size": 20,
+        },
+    }
+
+
+def test_page_limited_level():
+    fsearch = get_fake_search("total_sales_by_shop")
+    fquery = (
+        FQuery(fsearch)
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.shop_id,
+        )
+        .order_by({"total_sales": "desc"}, limit=5)
+    )
+
+    fquery.page(2, per_page=3)
+    shop_agg = fsearch._using.requests[-1]["body"]["aggs"]["shop_id"]
+    assert shop_agg["terms"]["size"] == 5
+    # The last page is cut at the limit
+    assert shop_agg["aggs"]["fiqs_hidden__sort"] == {
+        "bucket_sort": {"from": 3, "size": 2},
+    }
+
+    # Even ordered differently
+    fquery.page(2, per_page=3, order_by={"total_sales": "asc"})
+    shop_agg = fsearch._using.requests[-1]["body"]["aggs"]["shop_id"]
+    assert shop_agg["terms"]["size"] == 5
+    assert shop_agg["aggs"]["fiqs_hidden__sort"]["bucket_sort"]["size"] == 2
+
+    # Pages after the limit are empty, without a request
+    nb_requests = len(fsearch._using.requests)
+    assert fquery.page(3, per_page=3) == []
+    lines, profile = fquery.page(3, per_page=3, profile=True)
+    assert lines == []
+    assert profile.response_size is None
+    assert len(fsearch._using.requests) == nb_requests
+
+
+def get_paged_fquery(search, **options):
+    return (
+        FQuery(search, **options)
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.payment_type,
+            Sale.shop_id,
+        )
+    )
+
+
+def test_page_several_levels():
+    fsearch = get_fake_search("total_sales_by_payment_type_by_shop")
+    all_lines = get_paged_fquery(fsearch).eval(fill_missing_buckets=False)
+    all_lines.sort(key=lambda line: (line["payment_type"], line["shop_id"]))
+
+    client = FakeClient("total_sales_by_payment_type_by_shop", transform=composite_page)
+    fquery = get_paged_fquery(get_search(client=client))
+
+    lines = fquery.page(1, per_page=4, order_by={"shop_id": "desc"})
+    assert lines == all_lines[:4]
+
+    request = client.requests[-1]["body"]["aggs"]["page"]
+    assert request["composite"] == {
+        "sources": [
+            {"payment_type": {"terms": {"field": "payment_type"}}},
+            {"shop_id": {"terms": {"field": "shop_id", "order": "desc"}}},
+        ],
+        "size": 4,
+    }
+    assert request["aggs"] == {"total_sales": {"sum": {"field": "price"}}}
+
+    # We walk to the cursor of the page, without metrics
+    lines = fquery.page(4, per_page=4, order_by={"shop_id": "desc"})
+    assert lines == all_lines[12:16]
+
+    assert len(client.requests) == 3
+    walk = client.requests[1]["body"]["aggs"]["page"]
+    assert "aggs" not in walk
+    assert walk["composite"]["size"] == 8
+    assert walk["composite"]["after"] == {
+        "payment_type": all_lines[3]["payment_type"],
+        "shop_id": all_lines[3]["shop_id"],
+    }
+
+    # Cursors are kept
+    assert fquery.page(5, per_page=4, order_by={"shop_id": "desc"}) == all_lines[16:20]
+    assert fquery.page(2, per_page=4, order_by={"shop_id": "desc"}) == all_lines[4:8]
+    assert len(client.requests) == 5
+
+    # After the last page
+    assert fquery.page(1000, per_page=4, order_by={"shop_id": "desc"}) == []
+
+
+def test_page_cursors_cached(tmp_path):
+    fsearch = get_fake_search("total_sales_by_payment_type_by_shop")
+    all_lines = get_paged_fquery(fsearch).eval(fill_missing_buckets=False)
+    all_lines.sort(key=lambda line: (line["payment_type"], line["shop_id"]))
+
+    client = FakeClient("total_sales_by_payment_type_by_shop", transform=composite_page)
+    cache = DiskCache(tmp_path / "cache.sqlite")
+    get_paged_fquery(get_search(client=client), cache=cache).page(4, per_page=4)
+    assert len(client.requests) == 2
+
+    # A new FQuery finds the cursors in the cache
+    fquery = get_paged_fquery(get_search(client=client), cache=cache)
+    assert fquery.page(5, per_page=4) == all_lines[16:20]
+    assert len(client.requests) == 3
+    assert "after" in client.requests[-1]["body"]["aggs"]["page"]["composite"]
+
+
+def test_page_cursors_cached_by_cluster(tmp_path):
+    cache = DiskCache(tmp_path / "cache.sqlite")
+    clients = {
+        "fiqs_tests_a": FakeClient(
+            "total_sales_by_payment_type_by_shop", transform=composite_page
+        ),
+        "fiqs_tests_b": FakeClient(
+            "total_sales_by_payment_type_by_shop", transform=composite_page
+        ),
+    }
+    for alias, client in clients.items():
+        add_connection(alias, client)
+
+    try:
+        for alias in clients:
+            search = Search(using=alias, index="sale_data")
+            get_paged_fquery(search, cache=cache).page(4, per_page=4)
+    finally:
+        for alias in clients:
+            remove_connection(alias)
+
+    # The other cluster walks to its own cursor
+    assert [len(client.requests) for client in clients.values()] == [2, 2]
+
+
+def test_page_errors():
+    fquery = get_paged_fquery(get_search())
+
+    with pytest.raises(ConfigurationError):
+        fquery.page(0)
+    with pytest.raises(ConfigurationError):
+        fquery.page(1, per_page=0)
+    with pytest.raises(ConfigurationError):
+        fquery.page(1, order_by={"total_sales": "desc"})
+    with pytest.raises(ConfigurationError):
+        FQuery(get_search()).values(Count(Sale)).page(1)
+
+    fquery = (
+        FQuery(get_search())
+        .values(
+            Count(Sale),
+        )
+        .group_by(
+            GroupedField(Sale.shop_id, groups={"a": [1, 2], "b": [3]}),
+            Sale.payment_type,
+        )
+    )
+    with pytest.raises(ConfigurationError):
+        fquery.page(1)
@@ -0,0 +1,234 @@
+import pytest
+
+from fiqs.aggregations import Count, Ratio, Sum
+from fiqs.exceptions import ConfigurationError, PartialResultsError
+from fiqs.fields import FieldWithChoices, GroupedField
+from fiqs.query import FQuery
+from fiqs.testing.models import Sale
+from fiqs.testing.utils import get_search
+from fiqs.tests.conftest import get_fake_search
+
+
+def _keys(node, name):
+    keys = set()
+    for key, child in node.items():
+        if isinstance(child, dict) and "buckets" in child:
+            for bucket in child["buckets"]:
+                if key == name:
+                    keys.add(bucket["key"])
+                keys |= _keys(bucket, name)
+    return keys
+
+
+def _filter_partitions(node, aggs):
+    for name, agg in aggs.items():
+        buckets = node[name]["buckets"]
+        include = agg.get("terms", {}).get("include")
+        if include is not None:
+            buckets[:] = [
+                bucket
+                for bucket in buckets
+                if bucket["key"] % include["num_partitions"] == include["partition"]
+            ]
+            # Terms over the size of the partition are left out
+            size = agg["terms"].get("size", 10)
+            node[name]["sum_other_doc_count"] = sum(
+                bucket["doc_count"] for bucket in buckets[size:]
+            )
+            del buckets[size:]
+
+        for bucket in buckets:
+            sub_aggs = {
+                key: value
+                for key, value in agg.get("aggs", {}).items()
+                if "buckets" in bucket.get(key, {})
+            }
+            _filter_partitions(bucket, sub_aggs)
+
+
+def partition(body, result):
+    """Answers like Elasticsearch would with terms partitioning: every
+    partition gets the buckets whose (integer) key falls in it"""
+    if "cardinality" in body["aggs"]:
+        field = body["aggs"]["cardinality"]["cardinality"]["field"]
+        keys = _keys(result["aggregations"], field)
+        return {"aggregations": {"cardinality": {"value": len(keys)}}}
+
+    _filter_partitions(result["aggregations"], body["aggs"])
+    return result
+
+
+def get_partitioned_search(name):
+    return get_fake_search(name, transform=partition)
+
+
+def test_partition():
+    fsearch = get_partitioned_search("total_sales_by_shop")
+    fquery = (
+        FQuery(fsearch)
+        .values(
+            total_sales=Sum(Sale.price),
+            total_sales_ratio=Ratio(Sum(Sale.price), Sum(Sale.price)),
+        )
+        .group_by(
+            Sale.shop_id,
+        )
+        .partition(Sale.shop_id, partition_size=4)
+    )
+
+    lines, profile = fquery.eval(profile=True)
+
+    expected_lines = (
+        FQuery(get_fake_search("total_sales_by_shop"))
+        .values(
+            total_sales=Sum(Sale.price),
+            total_sales_ratio=Ratio(Sum(Sale.price), Sum(Sale.price)),
+        )
+        .group_by(
+            Sale.shop_id,
+        )
+        .eval()
+    )
+
+    key = lambda line: line["shop_id"]  # noqa: E731
+    assert sorted(lines, key=key) == sorted(expected_lines, key=key)
+    assert {"cardinality", "partitions"} <= set(profile.stages)
+
+    # 10 shops, 4 partitions of about 4 shops, plus the cardinality request
+    requests = fsearch._using.requests
+    assert len(requests) == 5
+    assert requests[0]["body"]["aggs"] == {
+        "cardinality": {"cardinality": {"field": "shop_id"}}
+    }
+    includes = sorted(
+        request["body"]["aggs"]["shop_id"]["terms"]["include"]["partition"]
+        for request in requests[1:]
+    )
+    assert includes == [0, 1, 2, 3]
+    for request in requests[1:]:
+        assert request["body"]["aggs"]["shop_id"]["terms"]["size"] == 4
+
+
+def test_partition_inner_level():
+    def get_fquery(search):
+        return (
+            FQuery(search)
+            .values(
+                total_sales=Sum(Sale.price),
+            )
+            .group_by(
+                FieldWithChoices(
+                    Sale.payment_type,
+                    choices=["cash", "wire_transfer", "store_credit", "gift_card"],
+                ),
+                Sale.shop_id,
+            )
+        )
+
+    fsearch = get_partitioned_search("total_sales_by_payment_type_by_shop")
+    # More partitions than shops, some partitions are empty
+    lines = (
+        get_fquery(fsearch)
+        .partition(Sale.shop_id, num_partitions=12, max_workers=3)
+        .eval()
+    )
+    expected_lines = get_fquery(
+        get_fake_search("total_sales_by_payment_type_by_shop")
+    ).eval()
+
+    # The missing gift_card lines are filled for every shop
+    assert len(lines) == 4 * 10
+    key = lambda line: (line["payment_type"], line["shop_id"])  # noqa: E731
+    assert sorted(lines, key=key) == sorted(expected_lines, key=key)
+    assert len(fsearch._using.requests) == 12
+
+
+def test_partition_split():
+    fsearch = get_partitioned_search("total_sales_by_shop")
+    fquery = (
+        FQuery(fsearch, default_size=3)
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.shop_id,
+        )
+        .partition(Sale.shop_id, num_partitions=2)
+    )
+
+    lines = fquery.eval()
+
+    expected_lines = (
+        FQuery(get_fake_search("total_sales_by_shop"))
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.shop_id,
+        )
+        .eval()
+    )
+    key = lambda line: line["shop_id"]  # noqa: E731
+    assert sorted(lines, key=key) == sorted(expected_lines, key=key)
+
+    # The 2 partitions hold 5 shops each, more than the default size: each
+    # one is split in 2 partitions of at most 3 shops
+    requests = fsearch._using.requests
+    includes = [
+        request["body"]["aggs"]["shop_id"]["terms"]["include"] for request in requests
+    ]
+    assert sorted((i["num_partitions"], i["partition"]) for i in includes) == [
+        (2, 0),
+        (2, 1),
+        (4, 0),
+        (4, 1),
+        (4, 2),
+        (4, 3),
+    ]
+    for request in requests:
+        assert request["body"]["aggs"]["shop_id"]["terms"]["size"] == 3
+
+
+def test_partition_truncated(monkeypatch):
+    monkeypatch.setattr("fiqs.query.MAX_PARTITION_SPLITS", 0)
+    fquery = (
+        FQuery(get_partitioned_search("total_sales_by_shop"), default_size=3)
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.shop_id,
+        )
+        .partition(Sale.shop_id, num_partitions=2)
+    )
+
+    with pytest.raises(PartialResultsError):
+        fquery.eval()
+
+
+def test_partition_errors():
+    with pytest.raises(ConfigurationError):
+        FQuery(get_search()).partition(Count(Sale))
+
+    with pytest.raises(ConfigurationError):
+        FQuery(get_search()).partition(
+            GroupedField(Sale.shop_id, groups={"1": [1], "2": [2]})
+        )
+
+    fquery = (
+        FQuery(get_search())
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.payment_type,
+        )
+    )
+    with pytest.raises(ConfigurationError):
+        fquery.partition(Sale.shop_id).eval()
+
+    fquery.partition(Sale.payment_type)
+    with pytest.raises(ConfigurationError):
+        fquery.eval(flat=False)
+    with pytest.raises(ConfigurationError):
+        fquery.eval(add_others_line=True)
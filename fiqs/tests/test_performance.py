@@ -1,7 +1,10 @@
+import gzip
+import json
 from datetime import datetime
 
 import pytest
 
+from fiqs import cbor
 from fiqs.aggregations import Count, DateHistogram
 from fiqs.query import FQuery
 from fiqs.testing.models import Sale
@@ -54,3 +57,29 @@ def test_flatten_performance():
         result,
         remove_nested_aggregations=fquery._contains_nested_expressions(),
     )
+
+
+@pytest.mark.performance
+@pytest.mark.parametrize("response_format", ["json", "cbor"])
+def test_decode_performance(response_format):
+    # Compares the JSON decoder of the standard library with fiqs' CBOR one
+    result = load_output("nb_sales_by_15_minutes_performance")
+    if response_format == "json":
+        payload = json.dumps(result).encode()
+        loads = json.loads
+    else:
+        payload = cbor.dumps(result)
+        loads = cbor.loads
+
+    assert loads(payload) == result
+
+
+@pytest.mark.performance
+def test_response_size():
+    # What CBOR saves on the wire, with and without HTTP compression
+    result = load_output("nb_sales_by_15_minutes_performance")
+    json_payload = json.dumps(result).encode()
+    cbor_payload = cbor.dumps(result)
+
+    assert len(cbor_payload) < 0.8 * len(json_payload)
+    assert len(gzip.compress(cbor_payload)) > len(gzip.compress(json_payload))
@@ -1,10 +1,15 @@
+import asyncio
+import copy
+import tracemalloc
 from collections import Counter
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import pytest
+from elasticsearch.dsl.connections import add_connection, remove_connection
 
 from fiqs.aggregations import (
     Addition,
+    AutoDateHistogram,
     Avg,
     Cardinality,
     Count,
@@ -16,7 +21,11 @@ from fiqs.aggregations import (
     Subtraction,
     Sum,
 )
-from fiqs.exceptions import ConfigurationError, MissingParameterException
+from fiqs.exceptions import (
+    ConfigurationError,
+    MissingParameterException,
+    TooManyBucketsError,
+)
 from fiqs.fields import (
     DataExtendedField,
     FieldWithChoices,
@@ -25,10 +34,11 @@ from fiqs.fields import (
     IntegerField,
 )
 from fiqs.models import Model
+from fiqs.profiling import Profile
 from fiqs.query import FQuery
 from fiqs.testing.models import Sale, TrafficCount
 from fiqs.testing.utils import get_search
-from fiqs.tests.conftest import load_output
+from fiqs.tests.conftest import FakeClient, get_fake_search, load_output
 
 
 def test_one_metric():
@@ -828,6 +838,89 @@ def test_reverse_nested_aggregation_doc_count_path_2():
     assert search.to_dict() == fsearch.to_dict()
 
 
+def test_reverse_nested_aggregations_same_path_are_merged():
+    search = get_search()
+    reverse_nested_bucket = (
+        search.aggs.bucket(
+            "products",
+            "nested",
+            path="products",
+        )
+        .bucket(
+            "product_id",
+            "terms",
+            field="products.product_id",
+        )
+        .bucket(
+            "reverse_nested_root",
+            "reverse_nested",
+        )
+    )
+    reverse_nested_bucket.metric(
+        "avg_price",
+        "avg",
+        field="price",
+    )
+    reverse_nested_bucket.metric(
+        "total_price",
+        "sum",
+        field="price",
+    )
+
+    fquery = (
+        FQuery(get_search())
+        .values(
+            ReverseNested(
+                Sale,
+                avg_price=Avg(Sale.price),
+            ),
+            ReverseNested(
+                Sale,
+                total_price=Sum(Sale.price),
+                total_price_bis=Sum(Sale.price),
+            ),
+        )
+        .group_by(
+            Sale.product_id,
+        )
+    )
+    fsearch = fquery._configure_search()
+
+    assert search.to_dict() == fsearch.to_dict()
+
+
+def test_identical_metrics_are_sent_once():
+    search = get_search()
+    search.aggs.bucket(
+        "shop_id",
+        "terms",
+        field="shop_id",
+    ).metric(
+        "total_sales",
+        "sum",
+        field="price",
+    ).metric(
+        "avg_sales",
+        "avg",
+        field="price",
+    )
+
+    fquery = (
+        FQuery(get_search())
+        .values(
+            total_sales=Sum(Sale.price),
+            avg_sales=Avg(Sale.price),
+            other_total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.shop_id,
+        )
+    )
+    fsearch = fquery._configure_search()
+
+    assert search.to_dict() == fsearch.to_dict()
+
+
 def test_default_size():
     search = get_search()
     search.aggs.bucket(
@@ -1218,6 +1311,27 @@ def test_order_by_field_with_choices():
     assert fsearch.to_dict() == expected
 
 
+def test_order_by_identical_metric():
+    fquery = (
+        FQuery(get_search())
+        .values(
+            total_sales=Sum(Sale.price),
+            total_sales_bis=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.shop_id,
+        )
+        .order_by({"total_sales_bis": "desc"})
+    )
+
+    body = fquery._build_body()
+    shop_agg = body["aggs"]["shop_id"]
+    # The metric is sent once, the order uses the key it was sent with
+    assert list(shop_agg["aggs"]) == ["total_sales"]
+    assert shop_agg["terms"]["order"] == {"total_sales": "desc"}
+    assert fquery._configure_search().to_dict() == body
+
+
 def test_order_by_count():
     pass
 
@@ -1775,6 +1889,53 @@ def test_reverse_nested_2():
         assert isinstance(line["avg_product_price"], float)
 
 
+def test_identical_metrics_under_every_key():
+    fquery = (
+        FQuery(get_search())
+        .values(
+            total_sales=Sum(Sale.price),
+            other_total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.shop_id,
+        )
+    )
+
+    result = load_output("total_sales_by_shop")
+    lines = fquery._flatten_result(result)
+
+    assert len(lines) == 10
+    for line in lines:
+        assert isinstance(line["total_sales"], int)
+        assert line["other_total_sales"] == line["total_sales"]
+
+
+def test_reverse_nested_same_path_under_every_key():
+    avg_sales = ReverseNested(Sale, avg_sales=Avg(Sale.price))
+    total_sales = ReverseNested(Sale, total_sales=Sum(Sale.price))
+    other_total_sales = ReverseNested(Sale, other_total_sales=Sum(Sale.price))
+    fquery = (
+        FQuery(get_search())
+        .values(
+            avg_sales,
+            total_sales,
+            other_total_sales,
+        )
+        .group_by(
+            Sale.product_type,
+        )
+    )
+
+    result = load_output("total_and_avg_sales_by_product_type")
+    lines = fquery._flatten_result(result)
+
+    assert len(lines) == 5
+    for line in lines:
+        assert isinstance(line[str(avg_sales)], float)
+        assert isinstance(line[str(total_sales)], int)
+        assert line[str(other_total_sales)] == line[str(total_sales)]
+
+
 def test_add_others_doc_count():
     fquery = (
         FQuery(get_search(), default_size=2)
@@ -2766,3 +2927,962 @@ def test_fill_missing_buckets_grouped_field_2():
 
     lines = fquery._add_missing_lines(lines)
     assert len(lines) == 6  # 3 payment types, 2 groups
+
+
+###########
+# Explain #
+###########
+
+
+def test_configure_search_twice():
+    fquery = (
+        FQuery(get_search())
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            DateHistogram(
+                Sale.timestamp,
+                interval="1d",
+                min=datetime(2016, 1, 1),
+                max=datetime(2016, 1, 31),
+            ),
+        )
+    )
+
+    expected = fquery._configure_search().to_dict()
+    assert fquery._configure_search().to_dict() == expected
+    assert "extended_bounds" in expected["aggs"]["timestamp"]["date_histogram"]
+
+
+def test_explain():
+    fquery = (
+        FQuery(get_search(), default_size=5)
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.payment_type,
+            Sale.shop_id,
+            DateHistogram(
+                Sale.timestamp,
+                interval="1d",
+                min=datetime(2016, 1, 1),
+                max=datetime(2016, 1, 31),
+            ),
+        )
+    )
+
+    explain = fquery.explain()
+
+    assert explain["body"] == fquery._configure_search().to_dict()
+    assert [level["key"] for level in explain["levels"]] == [
+        "payment_type",
+        "shop_id",
+        "timestamp",
+    ]
+    # 3 payment types, size 5 for shops, 31 days
+    assert [level["buckets"] for level in explain["levels"]] == [3, 5, 31]
+    assert [level["total_buckets"] for level in explain["levels"]] == [3, 15, 465]
+    assert explain["total_buckets"] == 3 + 15 + 465
+    assert explain["lines"] == 465
+    assert explain["response_size"] > 0
+
+
+def test_explain_lines_with_choices():
+    fquery = (
+        FQuery(get_search(), default_size=2)
+        .values(
+            Count(Sale),
+        )
+        .group_by(
+            Sale.payment_type,
+        )
+    )
+
+    # Only 2 buckets are returned, but all choices are filled
+    assert fquery.explain()["levels"][0]["buckets"] == 2
+    assert fquery.explain()["lines"] == 3
+    assert fquery.explain(fill_missing_buckets=False)["lines"] == 2
+
+
+def test_explain_nested():
+    fquery = (
+        FQuery(get_search())
+        .values(
+            ReverseNested(
+                Sale,
+                avg_price=Avg(Sale.price),
+            ),
+        )
+        .group_by(
+            Sale.product_id,
+        )
+    )
+
+    explain = fquery.explain()
+
+    # ES default size for the terms aggregation
+    assert [level["buckets"] for level in explain["levels"]] == [1, 10]
+    assert explain["total_buckets"] == 11
+    assert explain["lines"] == 10
+
+
+def test_explain_unbounded():
+    fquery = (
+        FQuery(get_search())
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Histogram(Sale.price, interval=100),
+        )
+    )
+
+    explain = fquery.explain()
+
+    assert explain["total_buckets"] is None
+    assert explain["lines"] is None
+    assert explain["response_size"] is None
+
+
+def test_explain_unhandled_date_interval():
+    fquery = (
+        FQuery(get_search(), max_buckets=1000)
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            DateHistogram(
+                Sale.timestamp,
+                interval="1q",
+                min=datetime(2016, 1, 1),
+                max=datetime(2017, 1, 1),
+            ),
+        )
+    )
+
+    explain = fquery.explain()
+
+    assert explain["levels"][0]["buckets"] is None
+    assert explain["total_buckets"] is None
+    with pytest.raises(TooManyBucketsError):
+        fquery.eval()
+
+
+def test_max_buckets():
+    fquery = (
+        FQuery(get_search(), default_size=0, max_buckets=1000)
+        .values(
+            Count(Sale),
+        )
+        .group_by(
+            Sale.shop_id,
+        )
+    )
+
+    with pytest.raises(TooManyBucketsError):
+        fquery.eval()
+
+    fquery = (
+        FQuery(get_search(), max_buckets=1000)
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Histogram(Sale.price, interval=100),
+        )
+    )
+
+    with pytest.raises(TooManyBucketsError):
+        fquery.eval()
+
+
+#############
+# Profiling #
+#############
+
+
+def test_eval_with_fake_client():
+    fquery = (
+        FQuery(get_fake_search("total_sales_by_shop"))
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.shop_id,
+        )
+    )
+
+    lines = fquery.eval()
+    assert len(lines) == 10
+
+    result = fquery.eval(flat=False)
+    assert len(result.aggregations.shop_id.buckets) == 10
+
+
+def test_eval_profile():
+    fquery = (
+        FQuery(get_fake_search("total_sales_by_payment_type"))
+        .values(
+            total_sales=Sum(Sale.price),
+            total_sales_ratio=Ratio(Sum(Sale.price), Sum(Sale.price)),
+        )
+        .group_by(
+            FieldWithChoices(
+                Sale.payment_type,
+                choices=["cash", "wire_transfer", "store_credit", "gift_card"],
+            ),
+        )
+    )
+
+    lines, profile = fquery.eval(profile=True)
+
+    assert len(lines) == 4
+    assert set(profile.stages) == {
+        "build",
+        "request",
+        "flatten",
+        "computed",
+        "cast",
+        "fill_missing_buckets",
+    }
+    for stats in profile.stages.values():
+        assert stats["wall_time"] >= 0
+        assert stats["allocated"] is not None
+        assert stats["peak"] is not None
+
+    assert profile.buckets == 3
+    assert profile.lines == 3
+    assert profile.filled_lines == 1
+    assert profile.response_size > 0
+    assert profile.http_time == 0.001
+
+    d = profile.to_dict()
+    assert d["lines"] == 3
+    assert d["wall_time"] == profile.wall_time
+
+
+def test_eval_profile_without_allocations():
+    fquery = (
+        FQuery(get_fake_search("total_sales_by_shop"))
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.shop_id,
+        )
+    )
+
+    profile = Profile(trace_allocations=False)
+    lines, returned_profile = fquery.eval(profile=profile)
+
+    assert returned_profile is profile
+    assert len(lines) == 10
+    assert profile.stages["flatten"]["allocated"] is None
+
+
+def test_eval_concurrent_profiles():
+    fquery = (
+        FQuery(get_fake_search("total_sales_by_shop"))
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.shop_id,
+        )
+    )
+
+    # Another evaluation is profiled at the same time
+    with Profile():
+        _, profile = fquery.eval(profile=True)
+        # Tracing goes on for the other profile
+        assert tracemalloc.is_tracing()
+
+    assert not tracemalloc.is_tracing()
+    assert profile.stages["flatten"]["allocated"] is not None
+    # The peak of a stage cannot be told apart
+    assert profile.stages["flatten"]["peak"] is None
+
+
+def test_eval_es_profile():
+    fsearch = get_fake_search("total_sales_by_shop_with_profile")
+    fquery = (
+        FQuery(fsearch)
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.shop_id,
+        )
+    )
+
+    lines, profile = fquery.eval(es_profile=True)
+
+    assert len(lines) == 10
+    assert fsearch._using.requests[0]["body"]["profile"] is True
+
+    shop_id_stats = profile.aggregations["shop_id"]
+    assert shop_id_stats["expression"] is Sale.shop_id
+    assert shop_id_stats["shards"] == 2
+    assert shop_id_stats["collect"] > 0
+    assert shop_id_stats["build_aggregation"] > 0
+    assert shop_id_stats["time_in_nanos"] >= shop_id_stats["collect"]
+
+    total_sales_stats = profile.aggregations["shop_id>total_sales"]
+    assert isinstance(total_sales_stats["expression"], Sum)
+    assert total_sales_stats["type"] == "SumAggregator"
+
+
+def test_aggregation_paths():
+    fquery = (
+        FQuery(get_search())
+        .values(
+            ReverseNested(
+                Sale,
+                avg_price=Avg(Sale.price),
+            ),
+            avg_product_price=Avg(Sale.product_price),
+        )
+        .group_by(
+            Sale.product_id,
+        )
+    )
+
+    paths = fquery._aggregation_paths()
+
+    assert set(paths) == {
+        "products",
+        "products>product_id",
+        "products>product_id>avg_product_price",
+        "products>product_id>reverse_nested_root",
+        "products>product_id>reverse_nested_root>avg_price",
+    }
+    assert paths["products>product_id"] is Sale.product_id
+
+
+###################
+# Prepared FQuery #
+###################
+
+
+def test_configure_search_does_not_mutate_search():
+    search = get_search()
+    fquery = (
+        FQuery(search)
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.shop_id,
+        )
+    )
+
+    fsearch = fquery._configure_search()
+
+    assert "aggs" in fsearch.to_dict()
+    assert "aggs" not in search.to_dict()
+
+
+def test_prepared_fquery():
+    fsearch = get_fake_search("total_sales_by_shop")
+    fquery = (
+        FQuery(fsearch)
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.shop_id,
+        )
+    )
+    expected_body = fquery._configure_search().to_dict()
+
+    template = fquery.prepare()
+    # Later changes are ignored by the template
+    fquery.values(avg_sales=Avg(Sale.price))
+
+    lines = template.eval()
+    assert len(lines) == 10
+    assert all(isinstance(line["total_sales"], int) for line in lines)
+    assert "avg_sales" not in lines[0]
+    assert fsearch._using.requests[-1]["body"] == expected_body
+
+    template.eval(
+        filters=[{"term": {"shop_id": 1}}],
+        index="sale_2016",
+    )
+    request = fsearch._using.requests[-1]
+    assert request["index"] == "sale_2016"
+    assert request["body"]["aggs"] == expected_body["aggs"]
+    assert request["body"]["query"] == {
+        "bool": {
+            "filter": [
+                {"term": {"shop_id": 1}},
+            ],
+        },
+    }
+
+
+def test_prepared_fquery_time_bounds():
+    start = datetime(2016, 1, 1)
+    end = datetime(2016, 1, 31)
+    fsearch = get_fake_search("total_sales_day_by_day")
+    template = (
+        FQuery(fsearch)
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            DateHistogram(
+                Sale.timestamp,
+                interval="1d",
+                min=start,
+                max=end,
+            ),
+        )
+        .prepare()
+    )
+    template_aggs = copy.deepcopy(template.aggs)
+
+    # The output goes from 2015-12-31 to 2016-01-30, 6 days are missing
+    lines = template.eval(min=start, max=datetime(2016, 2, 5))
+    assert len(lines) == 31 + 6
+
+    body = fsearch._using.requests[-1]["body"]
+    assert body["aggs"]["timestamp"]["date_histogram"]["extended_bounds"] == {
+        "min": start,
+        "max": datetime(2016, 2, 5),
+    }
+    assert body["query"] == {
+        "bool": {
+            "filter": [
+                {"range": {"timestamp": {"gte": start, "lte": datetime(2016, 2, 5)}}},
+            ],
+        },
+    }
+
+    # The template is left untouched
+    assert template.aggs == template_aggs
+    assert len(template.eval()) == 31
+
+    with pytest.raises(MissingParameterException):
+        template.eval(min=start)
+
+
+################
+# Request body #
+################
+
+
+@pytest.mark.parametrize(
+    "fquery",
+    [
+        FQuery(get_search()),
+        FQuery(get_search()).values(
+            total_sales=Sum(Sale.price),
+            avg_sales=Avg(Sale.price),
+        ),
+        FQuery(get_search(), default_size=5)
+        .values(
+            Count(Sale),
+            total_sales=Sum(Sale.price),
+            other_total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.shop_id,
+            Sale.payment_type,
+        )
+        .order_by(
+            {"total_sales": "desc"},
+        ),
+        FQuery(get_search())
+        .values(
+            ReverseNested(
+                Sale,
+                avg_price=Avg(Sale.price),
+            ),
+            ReverseNested(
+                Sale,
+                Count(Sale),
+            ),
+            avg_part_price=Avg(Sale.part_price),
+        )
+        .group_by(
+            Sale.product_id,
+            Sale.part_id,
+        ),
+        FQuery(get_search())
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            DateHistogram(
+                Sale.timestamp,
+                interval="1d",
+                min=datetime(2016, 1, 1),
+                max=datetime(2016, 1, 31),
+            ),
+            Histogram(
+                Sale.price,
+                interval=100,
+                min=0,
+                max=500,
+            ),
+        ),
+        FQuery(get_search())
+        .values(
+            Count(Sale),
+        )
+        .group_by(
+            FieldWithRanges(Sale.shop_id, ranges=[(1, 5), (5, 11)]),
+            GroupedField(Sale.payment_type, groups={"cash": ["cash"]}),
+            DateRange(
+                Sale.timestamp,
+                ranges=[
+                    {"from": datetime(2016, 1, 1), "to": datetime(2016, 1, 15)},
+                ],
+            ),
+        ),
+        FQuery(get_search().filter("term", shop_id=1))
+        .values(
+            nb_clients=Cardinality(Sale.client_id),
+        )
+        .group_by(
+            DataExtendedField(Sale.payment_type, size=2),
+        ),
+    ],
+)
+def test_build_body(fquery):
+    assert fquery._build_body() == fquery._configure_search().to_dict()
+
+
+def test_eval_sends_plain_dicts():
+    fsearch = get_fake_search("total_sales_by_shop")
+    fquery = (
+        FQuery(fsearch)
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.shop_id,
+        )
+    )
+
+    lines = fquery.eval()
+
+    body = fsearch._using.requests[-1]["body"]
+    assert body == fquery._configure_search().to_dict()
+    assert type(body["aggs"]["shop_id"]) is dict
+    assert lines == fquery._flatten_result(load_output("total_sales_by_shop"))
+
+
+def test_eval_cbor():
+    fsearch = get_fake_search("total_sales_by_shop")
+    fquery = (
+        FQuery(fsearch, response_format="cbor")
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.shop_id,
+        )
+    )
+
+    lines, profile = fquery.eval(profile=True)
+
+    request = fsearch._using.requests[-1]
+    assert request["path"] == "/*/_search"
+    assert request["headers"]["accept"] == "application/cbor"
+    assert request["body"] == fquery._build_body()
+    assert lines == fquery._flatten_result(load_output("total_sales_by_shop"))
+    assert "decode" in profile.stages
+    assert profile.decode_time >= profile.stages["decode"]["wall_time"]
+
+    result = fquery.eval(flat=False)
+    assert len(result.aggregations.shop_id.buckets) == 10
+
+
+def test_unsupported_response_format():
+    with pytest.raises(ConfigurationError):
+        FQuery(get_search(), response_format="smile")
+
+
+#################
+# Normalization #
+#################
+
+
+def get_day_by_day_fquery(search, start, end, **kwargs):
+    return (
+        FQuery(search, **kwargs)
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            DateHistogram(
+                Sale.timestamp,
+                interval="1d",
+                min=start,
+                max=end,
+            ),
+        )
+    )
+
+
+def test_normalize():
+    fsearch = get_fake_search("total_sales_day_by_day")
+    start = datetime(2016, 1, 1, 10, 12)
+    end = datetime(2016, 1, 31, 18, 3)
+
+    fquery = get_day_by_day_fquery(fsearch, start, end, normalize=True)
+    lines = fquery.eval()
+
+    request = fsearch._using.requests[-1]
+    assert request["params"] == {"request_cache": True}
+    histogram = request["body"]["aggs"]["timestamp"]["date_histogram"]
+    assert histogram["extended_bounds"] == {
+        "min": datetime(2016, 1, 1),
+        "max": datetime(2016, 1, 31),
+    }
+
+    def check_sorted(value):
+        if isinstance(value, dict):
+            assert list(value) == sorted(value)
+            for item in value.values():
+                check_sorted(item)
+
+    check_sorted(request["body"])
+
+    # Rounding the bounds does not change the result
+    expected_lines = get_day_by_day_fquery(fsearch, start, end).eval()
+    assert lines == expected_lines
+
+
+def test_normalize_fingerprint():
+    search = get_search()
+    start = datetime(2016, 1, 1)
+    end = datetime(2016, 1, 31)
+
+    fingerprint = get_day_by_day_fquery(
+        search, start, end, normalize=True
+    ).fingerprint()
+
+    # Same buckets, same request
+    assert (
+        get_day_by_day_fquery(
+            search,
+            datetime(2016, 1, 1, 23, 59),
+            datetime(2016, 1, 31, 12),
+            normalize=True,
+        ).fingerprint()
+        == fingerprint
+    )
+    assert (
+        get_day_by_day_fquery(
+            search,
+            datetime(2016, 1, 1, 23, 59),
+            datetime(2016, 1, 31, 12),
+        ).fingerprint()
+        != fingerprint
+    )
+    assert (
+        get_day_by_day_fquery(
+            search, start, datetime(2016, 2, 1), normalize=True
+        ).fingerprint()
+        != fingerprint
+    )
+    assert (
+        get_day_by_day_fquery(
+            get_search(indices="sale_2016"), start, end, normalize=True
+        ).fingerprint()
+        != fingerprint
+    )
+
+
+def test_stable_preference():
+    fsearch = get_fake_search("total_sales_day_by_day")
+    start = datetime(2016, 1, 1)
+
+    for end in [
+        datetime(2016, 1, 31, 12),
+        datetime(2016, 1, 31, 18),
+        datetime(2016, 2, 1),
+    ]:
+        get_day_by_day_fquery(
+            fsearch, start, end, normalize=True, stable_preference=True
+        ).eval()
+
+    first, second, third = (
+        request["params"]["preference"] for request in fsearch._using.requests
+    )
+    assert first.startswith("fiqs-")
+    assert first == second
+    assert first != third
+
+    # The preference given to the search is kept
+    fquery = get_day_by_day_fquery(
+        fsearch.params(preference="_local"),
+        start,
+        datetime(2016, 1, 31),
+        stable_preference=True,
+    )
+    fquery.eval()
+    assert fsearch._using.requests[-1]["params"] == {"preference": "_local"}
+
+
+def test_prepared_fquery_normalize():
+    fsearch = get_fake_search("total_sales_day_by_day")
+    template = get_day_by_day_fquery(
+        fsearch, datetime(2016, 1, 1), datetime(2016, 1, 31), normalize=True
+    ).prepare()
+
+    template.eval(min=datetime(2016, 1, 1, 8), max=datetime(2016, 1, 31, 8))
+
+    body = fsearch._using.requests[-1]["body"]
+    assert body["aggs"]["timestamp"]["date_histogram"]["extended_bounds"] == {
+        "min": datetime(2016, 1, 1),
+        "max": datetime(2016, 1, 31),
+    }
+    # The filter keeps the exact bounds
+    assert body["query"] == {
+        "bool": {
+            "filter": [
+                {
+                    "range": {
+                        "timestamp": {
+                            "gte": datetime(2016, 1, 1, 8),
+                            "lte": datetime(2016, 1, 31, 8),
+                        }
+                    }
+                },
+            ],
+        },
+    }
+
+
+####################
+# Doc count errors #
+####################
+
+
+def test_doc_count_errors():
+    fsearch = get_fake_search("nb_sales_by_shop_by_payment_type_limited_size")
+    fquery = (
+        FQuery(fsearch, doc_count_errors=True)
+        .values(
+            Count(Sale),
+        )
+        .group_by(
+            DataExtendedField(Sale.shop_id, size=2, shard_size=20),
+            DataExtendedField(Sale.payment_type, size=2),
+        )
+    )
+
+    lines = fquery.eval()
+
+    aggs = fsearch._using.requests[-1]["body"]["aggs"]
+    assert aggs["shop_id"]["terms"] == {
+        "field": "shop_id",
+        "size": 2,
+        "shard_size": 20,
+        "show_term_doc_count_error": True,
+    }
+    assert aggs["shop_id"]["aggs"]["payment_type"]["terms"] == {
+        "field": "payment_type",
+        "size": 2,
+        "show_term_doc_count_error": True,
+    }
+
+    # 2 shops, 3 payment types
+    assert len(lines) == 6
+    for line in lines:
+        assert line["shop_id__max_doc_count_error"] in (0, None)
+        assert "payment_type__sum_other_doc_count" in line
+
+    filled_lines = [line for line in lines if line["doc_count"] == 0]
+    assert len(filled_lines) == 2
+    for line in filled_lines:
+        assert line["shop_id__sum_other_doc_count"] is None
+        assert line["payment_type__doc_count_error"] is None
+
+
+def test_doc_count_errors_others_line():
+    fquery = (
+        FQuery(
+            get_fake_search("nb_sales_by_shop_by_payment_type_limited_size"),
+            doc_count_errors=True,
+        )
+        .values(
+            Count(Sale),
+        )
+        .group_by(
+            DataExtendedField(Sale.shop_id, size=2),
+            DataExtendedField(Sale.payment_type, size=2),
+        )
+    )
+
+    lines = fquery.eval(add_others_line=True, fill_missing_buckets=False)
+
+    others_lines = [line for line in lines if line["shop_id"] == "others"]
+    assert len(others_lines) == 1
+    assert others_lines[0]["doc_count"] == 776
+    assert others_lines[0]["shop_id__sum_other_doc_count"] == 776
+
+
+#######################
+# Auto date histogram #
+#######################
+
+
+def test_auto_date_histogram():
+    fsearch = get_fake_search("total_sales_day_by_day")
+    fquery = (
+        FQuery(fsearch)
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            AutoDateHistogram(
+                Sale.timestamp,
+                min=datetime(2016, 1, 1),
+                max=datetime(2016, 1, 31),
+                buckets=40,
+            ),
+        )
+    )
+
+    lines = fquery.eval()
+
+    histogram = fsearch._using.requests[-1]["body"]["aggs"]["timestamp"]
+    assert histogram["date_histogram"]["calendar_interval"] == "1d"
+    assert len(lines) == 31
+    assert fquery.explain()["levels"][0]["buckets"] == 31
+
+    # With other bounds, a prepared query picks another interval
+    template = fquery.prepare()
+    template.eval(min=datetime(2016, 1, 1), max=datetime(2016, 3, 31))
+
+    histogram = fsearch._using.requests[-1]["body"]["aggs"]["timestamp"]
+    assert histogram["date_histogram"]["calendar_interval"] == "1w"
+    assert histogram["date_histogram"]["extended_bounds"] == {
+        "min": datetime(2016, 1, 1),
+        "max": datetime(2016, 3, 31),
+    }
+
+
+#################
+# Subscriptions #
+#################
+
+
+def take(async_iterator, nb_items):
+    async def run():
+        items = []
+        async for item in async_iterator:
+            items.append(item)
+            if len(items) == nb_items:
+                break
+        return items
+
+    return asyncio.run(run())
+
+
+def test_subscribe():
+    fsearch = get_fake_search("total_sales_day_by_day")
+    fquery = (
+        FQuery(fsearch)
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            DateHistogram(Sale.timestamp, interval="1d"),
+        )
+    )
+
+    ticks = iter([datetime(2016, 1, 30, 18), datetime(2016, 1, 31, 6)])
+    first_view, second_view = take(
+        fquery.subscribe(timedelta(days=5), every=0, clock=lambda: next(ticks)),
+        2,
+    )
+
+    assert [line["timestamp"] for line in first_view] == [
+        datetime(2016, 1, day) for day in range(25, 31)
+    ]
+    assert fsearch._using.requests[0]["body"]["query"] == {
+        "bool": {
+            "filter": [
+                {
+                    "range": {
+                        "timestamp": {
+                            "gte": datetime(2016, 1, 25),
+                            "lte": datetime(2016, 1, 30, 18),
+                        }
+                    }
+                }
+            ]
+        }
+    }
+
+    # Only the bucket open at the first tick is queried again, the oldest
+    # bucket left the window
+    assert [line["timestamp"] for line in second_view] == [
+        datetime(2016, 1, day) for day in range(26, 32)
+    ]
+    assert second_view[:4] == first_view[1:5]
+    assert second_view[-1]["doc_count"] == 0
+    assert fsearch._using.requests[1]["body"]["query"]["bool"]["filter"] == [
+        {
+            "range": {
+                "timestamp": {
+                    "gte": datetime(2016, 1, 30),
+                    "lte": datetime(2016, 1, 31, 6),
+                }
+            }
+        }
+    ]
+
+
+def test_subscribe_errors():
+    fquery = FQuery(get_search()).values(Count(Sale)).group_by(Sale.shop_id)
+    with pytest.raises(ConfigurationError):
+        take(fquery.subscribe(timedelta(hours=1), every=10), 1)
+
+    for histogram in (
+        DateHistogram(Sale.timestamp, interval="1q"),
+        DateHistogram(Sale.timestamp, interval="1d", time_zone="Europe/Paris"),
+        AutoDateHistogram(
+            Sale.timestamp, min=datetime(2016, 1, 1), max=datetime(2016, 1, 2)
+        ),
+    ):
+        fquery = FQuery(get_search()).values(Count(Sale)).group_by(histogram)
+        with pytest.raises(ConfigurationError):
+            take(fquery.subscribe(timedelta(hours=1), every=10), 1)
+
+
+###############
+# From models #
+###############
+
+
+class SaleFromCluster(Sale):
+    index = "sale_data"
+    connection = "fiqs_tests_sales"
+
+
+def test_from_model():
+    client = FakeClient("total_sales_by_shop")
+    add_connection("fiqs_tests_sales", client)
+
+    try:
+        fquery = (
+            FQuery.from_model(SaleFromCluster, default_size=5)
+            .values(total_sales=Sum(SaleFromCluster.price))
+            .group_by(SaleFromCluster.shop_id)
+        )
+        lines = fquery.eval()
+    finally:
+        remove_connection("fiqs_tests_sales")
+
+    assert fquery.default_size == 5
+    assert client.requests[0]["index"] == ["sale_data"]
+    assert len(lines) == 10
@@ -0,0 +1,102 @@
+import pytest
+
+from fiqs.aggregations import Count, Ratio, Sum
+from fiqs.exceptions import ConfigurationError
+from fiqs.fields import FieldWithChoices
+from fiqs.query import FQuery
+from fiqs.testing.models import Sale
+from fiqs.testing.utils import get_search
+from fiqs.tests.conftest import get_fake_search
+
+
+def sample_aggregations(body, result):
+    """Wraps the aggregations of the recorded result in the sampling
+    aggregation, with 100 sampled documents out of 1000"""
+    sampler = body["aggs"]["sample"]
+    sample = {"doc_count": 100}
+    if "random_sampler" in sampler:
+        sample.update(seed=42, probability=sampler["random_sampler"]["probability"])
+    sample.update(result["aggregations"])
+    result["aggregations"] = {"sample": sample}
+    return result
+
+
+def get_sampled_search():
+    return get_fake_search(
+        "total_sales_by_payment_type", transform=sample_aggregations
+    )
+
+
+def get_sampled_fquery(search):
+    return (
+        FQuery(search)
+        .values(
+            Count(Sale),
+            total_sales=Sum(Sale.price),
+            total_sales_ratio=Ratio(Sum(Sale.price), Sum(Sale.price)),
+        )
+        .group_by(
+            FieldWithChoices(
+                Sale.payment_type,
+                choices=["cash", "wire_transfer", "store_credit", "gift_card"],
+            ),
+        )
+    )
+
+
+def test_sample_random_sampler():
+    fsearch = get_sampled_search()
+
+    lines = get_sampled_fquery(fsearch).eval(sample=0.01)
+
+    body = fsearch._using.requests[-1]["body"]
+    assert body["aggs"]["sample"]["random_sampler"] == {"probability": 0.01}
+    expected_aggs = get_sampled_fquery(get_search())._build_body()["aggs"]
+    assert body["aggs"]["sample"]["aggs"] == expected_aggs
+
+    # Elasticsearch already scaled the results
+    expected_lines = get_sampled_fquery(
+        get_fake_search("total_sales_by_payment_type")
+    ).eval()
+    assert lines == expected_lines
+    assert len(lines) == 4
+    assert lines.approximate is True
+    assert lines.sample == 0.01
+    assert lines.sampled_doc_count == 100
+    assert lines.scale is None
+
+
+def test_sample_sampler():
+    fsearch = get_sampled_search()
+
+    lines = get_sampled_fquery(fsearch).eval(sample=200)
+
+    body = fsearch._using.requests[-1]["body"]
+    assert body["aggs"]["sample"]["sampler"] == {"shard_size": 200}
+    assert body["track_total_hits"] is True
+
+    # 100 documents sampled out of 1000
+    expected_lines = get_sampled_fquery(
+        get_fake_search("total_sales_by_payment_type")
+    ).eval()
+    assert lines.scale == 10
+    for line, expected_line in zip(lines, expected_lines):
+        assert line["payment_type"] == expected_line["payment_type"]
+        if expected_line["doc_count"]:
+            assert line["doc_count"] == expected_line["doc_count"] * 10
+            assert line["total_sales"] == expected_line["total_sales"] * 10
+        else:
+            # Filled line
+            assert line["total_sales"] is None
+        assert line["total_sales_ratio"] == expected_line["total_sales_ratio"]
+
+
+def test_sample_errors():
+    fquery = get_sampled_fquery(get_search())
+
+    for sample in [0.5, 0.0, -1, 0, True, "0.1"]:
+        with pytest.raises(ConfigurationError):
+            fquery.eval(sample=sample)
+
+    with pytest.raises(ConfigurationError):
+        fquery.eval(flat=False, sample=0.1)
@@ -0,0 +1,166 @@
+from fiqs.aggregations import Sum
+from fiqs.query import FQuery, clear_cardinality_cache
+from fiqs.testing.models import Sale
+from fiqs.testing.utils import get_search
+from fiqs.tests.conftest import FakeClient
+
+
+def probe_cardinalities(cardinalities):
+    """Answers the cardinality probes with the given cardinalities, and
+    leaves the other results as recorded"""
+
+    def transform(body, result):
+        if "cardinality_0" not in body.get("aggs", {}):
+            return result
+
+        aggregations = {}
+        for name, agg in body["aggs"].items():
+            if "nested" in agg:
+                field = agg["aggs"]["cardinality"]["cardinality"]["field"]
+                value = {"cardinality": {"value": cardinalities[field]}}
+            else:
+                value = {"value": cardinalities[agg["cardinality"]["field"]]}
+            aggregations[name] = value
+        return {"aggregations": aggregations}
+
+    return transform
+
+
+def test_plan_sizes_from_choices():
+    fquery = (
+        FQuery(get_search(), default_size=0, plan_sizes=True)
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.payment_type,
+            Sale.shop_id,
+        )
+    )
+
+    aggs = fquery._build_body()["aggs"]
+    assert aggs["payment_type"]["terms"] == {
+        "field": "payment_type",
+        "size": 3,
+        "shard_size": 3,
+    }
+    assert aggs["payment_type"]["aggs"]["shop_id"]["terms"] == {
+        "field": "shop_id",
+        "size": 2**31 - 1,
+    }
+
+    levels = fquery.explain()["levels"]
+    assert levels[0]["size_plan"] == {
+        "size": 3,
+        "shard_size": 3,
+        "collect_mode": None,
+        "source": "choices",
+    }
+    assert levels[1]["size_plan"] == {
+        "size": None,
+        "shard_size": None,
+        "collect_mode": None,
+        "source": None,
+    }
+    assert fquery._build_body() == fquery._configure_search().to_dict()
+
+    # Without planning, choices do not bound the size
+    fquery = (
+        FQuery(get_search(), default_size=0)
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.payment_type,
+        )
+    )
+    assert fquery._build_body()["aggs"]["payment_type"]["terms"]["size"] == 2**31 - 1
+    assert fquery.explain()["levels"][0]["size_plan"] is None
+
+
+def test_plan_sizes_breadth_first():
+    fquery = (
+        FQuery(get_search(), default_size=5, plan_sizes=True)
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.shop_id,
+            Sale.client_id,
+        )
+    )
+
+    aggs = fquery._build_body()["aggs"]
+    assert aggs["shop_id"]["terms"]["collect_mode"] == "breadth_first"
+    assert "collect_mode" not in aggs["shop_id"]["aggs"]["client_id"]["terms"]
+
+
+def test_plan_sizes_from_cardinality():
+    clear_cardinality_cache()
+    client = FakeClient(
+        transform=probe_cardinalities({"shop_id": 10, "products.product_id": 1000})
+    )
+
+    def get_fquery():
+        return (
+            FQuery(get_search(client=client), default_size=0, probe_cardinality=True)
+            .values(
+                total_sales=Sum(Sale.price),
+            )
+            .group_by(
+                Sale.shop_id,
+                Sale.products,
+                Sale.product_id,
+            )
+        )
+
+    aggs = get_fquery()._build_body()["aggs"]
+    # 10 shops, with a margin
+    assert aggs["shop_id"]["terms"]["size"] == 13
+    assert aggs["shop_id"]["terms"]["shard_size"] == 13
+    product_aggs = aggs["shop_id"]["aggs"]["products"]["aggs"]
+    assert product_aggs["product_id"]["terms"]["size"] == 1250
+
+    assert len(client.requests) == 1
+    probe = client.requests[0]["body"]
+    assert probe["size"] == 0
+    assert probe["aggs"]["cardinality_1"]["nested"] == {"path": "products"}
+
+    # The probe is cached
+    explain = get_fquery().explain()
+    assert len(client.requests) == 1
+    assert explain["levels"][0]["size_plan"]["source"] == "cardinality"
+
+    clear_cardinality_cache()
+    get_fquery()._build_body()
+    assert len(client.requests) == 2
+
+
+def test_prepared_plan_sizes_from_cardinality():
+    clear_cardinality_cache()
+    cardinalities = {"shop_id": 10}
+    client = FakeClient(
+        "total_sales_by_shop", transform=probe_cardinalities(cardinalities)
+    )
+    template = (
+        FQuery(get_search(client=client), default_size=0, probe_cardinality=True)
+        .values(
+            total_sales=Sum(Sale.price),
+        )
+        .group_by(
+            Sale.shop_id,
+        )
+        .prepare()
+    )
+    assert template.aggs["shop_id"]["terms"]["size"] == 13
+
+    template.eval()
+    assert client.requests[-1]["body"]["aggs"]["shop_id"]["terms"]["size"] == 13
+    assert len(client.requests) == 2
+
+    # Once the probe expires, the sizes follow the new cardinality
+    clear_cardinality_cache()
+    cardinalities["shop_id"] = 20
+    template.eval()
+    assert len(client.requests) == 4
+    assert client.requests[-1]["body"]["aggs"]["shop_id"]["terms"]["size"] == 25
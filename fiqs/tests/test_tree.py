@@ -1,6 +1,6 @@
 import pytest
 
-from fiqs import flatten_result
+from fiqs import cbor, flatten_result
 from fiqs.tests.conftest import load_output
 from fiqs.tree import ResultTree
 
@@ -32,6 +32,83 @@ def test_nb_sales_by_shop():
         assert isinstance(line["shop_id"], int)
 
 
+def test_cbor_payload():
+    name = "total_sales_day_by_day_by_shop_and_by_payment"
+    expected = flatten_result(load_output(name))
+    output = load_output(name)
+
+    assert ResultTree(cbor.dumps(output)).flatten_result() == expected
+    assert ResultTree(memoryview(cbor.dumps(output))).flatten_result() == expected
+
+
+def test_sample():
+    # FQuery wraps the aggregations in a sampling aggregation
+    output = load_output("total_sales_by_shop")
+    sampled_output = load_output("total_sales_by_shop")
+    sampled_output["aggregations"] = {
+        "sample": {
+            "doc_count": 12,
+            "seed": 1,
+            "probability": 0.1,
+            **sampled_output["aggregations"],
+        }
+    }
+
+    lines = ResultTree(output).flatten_result()
+    assert ResultTree(sampled_output).flatten_result() == lines
+
+
+def test_hidden_aggregations():
+    # FQuery adds metrics to order the buckets of upper levels
+    output = load_output("total_sales_by_payment_type_by_shop")
+    hidden_output = load_output("total_sales_by_payment_type_by_shop")
+    for bucket in hidden_output["aggregations"]["payment_type"]["buckets"]:
+        shop_aggregation = bucket.pop("shop_id")
+        bucket["fiqs_hidden__total_sales"] = {"value": 1.0}
+        bucket["shop_id"] = shop_aggregation
+        for shop_bucket in shop_aggregation["buckets"]:
+            shop_bucket["fiqs_hidden__ratio"] = {"value": 2.0}
+
+    lines = ResultTree(output).flatten_result()
+    hidden_lines = ResultTree(hidden_output).flatten_result(
+        remove_hidden_aggregations=True,
+    )
+    assert hidden_lines == lines
+
+
+def test_doc_count_errors():
+    output = load_output("nb_sales_by_shop_by_payment_type_limited_size")
+    shop_buckets = output["aggregations"]["shop_id"]["buckets"]
+    shop_buckets[0]["doc_count_error_upper_bound"] = 3
+    shop_buckets[1]["doc_count_error_upper_bound"] = 0
+    shop_buckets[1]["payment_type"]["buckets"][0]["doc_count_error_upper_bound"] = 2
+
+    lines = ResultTree(output).flatten_result(doc_count_errors=True)
+
+    assert lines[0] == {
+        "shop_id": 5,
+        "shop_id__doc_count_error": 3,
+        "shop_id__max_doc_count_error": 0,
+        "shop_id__sum_other_doc_count": 776,
+        "payment_type": "wire_transfer",
+        "payment_type__max_doc_count_error": 0,
+        "payment_type__sum_other_doc_count": 16,
+        "doc_count": 23,
+    }
+    assert lines[2]["shop_id"] == 8
+    assert lines[2]["shop_id__doc_count_error"] == 0
+    assert lines[2]["payment_type__doc_count_error"] == 2
+    assert lines[2]["payment_type__sum_other_doc_count"] == 15
+
+    # Errors are only added on demand
+    output = load_output("nb_sales_by_shop_by_payment_type_limited_size")
+    assert set(ResultTree(output).flatten_result()[0]) == {
+        "shop_id",
+        "payment_type",
+        "doc_count",
+    }
+
+
 def test_total_sales_by_shop():
     lines = flatten_result(load_output("total_sales_by_shop"))
 
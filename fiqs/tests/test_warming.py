@@ -0,0 +1,199 @@
+import threading
+
+import pytest
+
+from fiqs.caching import DiskCache
+from fiqs.tests.conftest import get_fake_search, get_total_sales_by_shop_fquery
+from fiqs.warming import CacheWarmer
+
+
+class FakeTemplate:
+    def __init__(self):
+        self.calls = []
+        self.release = threading.Event()
+        self.release.set()
+        self.error = None
+
+    def eval(self, **params):
+        self.calls.append(params)
+        self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        return [dict(params, call=len(self.calls))]
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def warmer():
+    clock = Clock()
+    warmer = CacheWarmer(max_concurrency=2, clock=clock)
+    warmer.clock_ = clock
+    yield warmer
+    warmer.stop()
+
+
+def wait_refreshes(warmer):
+    for entry in list(warmer._entries.values()):
+        if entry.refreshing is not None:
+            entry.refreshing.result(5)
+
+
+def test_warmer_get(warmer):
+    template = FakeTemplate()
+    warmer.register("sales", template, max_age=60, stale_for=30)
+
+    # Missing results are evaluated at once
+    assert warmer.get("sales") == [{"call": 1}]
+    assert warmer.get("sales") == [{"call": 1}]
+    assert len(template.calls) == 1
+
+    # Stale results are served while they are refreshed
+    warmer.clock_.now += 70
+    template.release.clear()
+    assert warmer.get("sales") == [{"call": 1}]
+    assert warmer.get("sales") == [{"call": 1}]
+    template.release.set()
+    wait_refreshes(warmer)
+    assert len(template.calls) == 2
+    assert warmer.get("sales") == [{"call": 2}]
+
+    # Expired results are evaluated again
+    warmer.clock_.now += 100
+    assert warmer.get("sales") == [{"call": 3}]
+
+    with pytest.raises(KeyError):
+        warmer.get("sales", min="2024-01-01")
+
+
+def test_warmer_params(warmer):
+    template = FakeTemplate()
+    warmer.register("sales", template, params=[{"index": "a"}, {"index": "b"}])
+
+    assert warmer.get("sales", index="b") == [{"index": "b", "call": 1}]
+    assert warmer.get("sales", index="a") == [{"index": "a", "call": 2}]
+
+
+def test_warmer_errors(warmer):
+    template = FakeTemplate()
+    warmer.register("sales", template, max_age=60)
+    warmer.get("sales")
+
+    # A failed refresh keeps the stale result
+    template.error = ValueError("Boom")
+    warmer.clock_.now += 70
+    assert warmer.get("sales") == [{"call": 1}]
+    wait_refreshes(warmer)
+    assert warmer.get("sales") == [{"call": 1}]
+
+    warmer.clock_.now += 100
+    with pytest.raises(ValueError):
+        warmer.get("sales")
+
+
+def test_warmer_run_pending(warmer):
+    templates = {name: FakeTemplate() for name in ["a", "b", "c"]}
+    for name, template in templates.items():
+        warmer.register(name, template, max_age=100, refresh_ahead=0.5)
+
+    # At most max_concurrency refreshes run at the same time
+    for template in templates.values():
+        template.release.clear()
+    assert warmer.run_pending() == 2
+    assert warmer.run_pending() == 0
+    for template in templates.values():
+        template.release.set()
+    wait_refreshes(warmer)
+    assert warmer.run_pending() == 1
+    wait_refreshes(warmer)
+    assert all(len(template.calls) == 1 for template in templates.values())
+
+    # Nothing to do while the results are fresh enough
+    warmer.clock_.now += 40
+    assert warmer.run_pending() == 0
+
+    # The most requested results are refreshed first
+    for _ in range(3):
+        warmer.get("c")
+    warmer.get("b")
+    warmer.clock_.now += 20
+    for template in templates.values():
+        template.release.clear()
+    assert warmer.run_pending() == 2
+    refreshing = [warmer._entries[(name, "{}")].refreshing for name in "abc"]
+    assert [future is not None for future in refreshing] == [False, True, True]
+    for template in templates.values():
+        template.release.set()
+    wait_refreshes(warmer)
+
+
+def test_warmer_start(warmer):
+    template = FakeTemplate()
+    warmer.register("sales", template)
+
+    warmer.start(interval=0.01)
+    for _ in range(500):
+        if warmer._entries[("sales", "{}")].refreshed_at is not None:
+            break
+        threading.Event().wait(0.01)
+    warmer.stop()
+
+    assert warmer.get("sales") == [{"call": 1}]
+
+
+def test_warmer_prepared_fquery():
+    fsearch = get_fake_search("total_sales_by_shop")
+    warmer = CacheWarmer()
+    warmer.register(
+        "total_sales_by_shop",
+        get_total_sales_by_shop_fquery(fsearch).prepare(),
+        params=[{"filters": [{"term": {"shop_id": 1}}]}],
+    )
+
+    assert warmer.run_pending() == 1
+    warmer.stop()
+
+    lines = warmer.get("total_sales_by_shop", filters=[{"term": {"shop_id": 1}}])
+    assert len(lines) == 10
+    assert len(fsearch._using.requests) == 1
+    assert fsearch._using.requests[0]["body"]["query"] == {
+        "bool": {"filter": [{"term": {"shop_id": 1}}]}
+    }
+
+
+def test_warmer_shared_cache(warmer, tmp_path):
+    cache = DiskCache(tmp_path / "cache.sqlite")
+    fsearch = get_fake_search("total_sales_by_shop")
+    fquery = get_total_sales_by_shop_fquery(fsearch, cache=cache)
+    warmer.register("sales", fquery.prepare())
+
+    # Scheduled refreshes send their request, even with a cached response
+    warmer.run_pending()
+    wait_refreshes(warmer)
+    warmer.clock_.now += 300
+    warmer.run_pending()
+    wait_refreshes(warmer)
+    assert len(fsearch._using.requests) == 2
+    assert len(cache) == 1
+
+    # Another process sharing the cache gets the result from it
+    other_warmer = CacheWarmer(clock=warmer.clock_)
+    other_warmer.register("sales", fquery.prepare())
+    try:
+        assert other_warmer.get("sales") == warmer.get("sales")
+        assert len(fsearch._using.requests) == 2
+
+        # Once stale, its results are refreshed from Elasticsearch: the
+        # cached response may be as old as they are
+        warmer.clock_.now += 300
+        other_warmer.get("sales")
+        wait_refreshes(other_warmer)
+        assert len(fsearch._using.requests) == 3
+    finally:
+        other_warmer.stop()
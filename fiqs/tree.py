@@ -1,3 +1,10 @@
+from fiqs import cbor
+
+# Name of the random_sampler or sampler aggregation FQuery wraps the aggregations in
+SAMPLE_AGGREGATION = "sample"
+# Prefix of the aggregations FQuery adds for its own needs, like ordering buckets
+HIDDEN_AGGREGATION_PREFIX = "fiqs_hidden__"
+
 RESERVED_KEYS = frozenset({
     "key",
     "key_as_string",
@@ -6,6 +13,7 @@ RESERVED_KEYS = frozenset({
     "from_as_string",
     "to",
     "to_as_string",
+    "doc_count_error_upper_bound",
 })
 
 
@@ -15,21 +23,59 @@ class ResultTree:
             self.es_result = es_result
         elif hasattr(es_result, "_d_"):
             self.es_result = es_result._d_
+        elif isinstance(es_result, bytes | bytearray | memoryview):
+            # Raw CBOR payload
+            self.es_result = cbor.loads(es_result)
         else:
             raise Exception(
-                "ResultTree expects a dict or " "an elasticsearch.dsl Response object"
+                "ResultTree expects a dict, an elasticsearch.dsl Response object "
+                "or a CBOR payload"
             )
 
+        self.nb_buckets = 0
+
     def flatten_result(self, **kwargs):
         if "aggregations" not in self.es_result:
             return []
 
         self.add_others_line = kwargs.get("add_others_line", False)
         self.remove_nested_aggregations = kwargs.get("remove_nested_aggregations", True)
+        self.doc_count_errors = kwargs.get("doc_count_errors", False)
 
-        aggregations = self.es_result["aggregations"]
+        aggregations = self._unwrap_sample(self.es_result["aggregations"])
+        if kwargs.get("remove_hidden_aggregations", False):
+            self._remove_hidden_aggregations(aggregations)
         return self._extract_lines(aggregations)
 
+    def _unwrap_sample(self, aggregations):
+        # We see through the sampling aggregation, as if it was not there
+        if set(aggregations) != {SAMPLE_AGGREGATION}:
+            return aggregations
+
+        node = aggregations[SAMPLE_AGGREGATION]
+        if "doc_count" not in node or "buckets" in node:
+            return aggregations
+
+        return {
+            key: value
+            for key, value in node.items()
+            if key not in ("doc_count", "seed", "probability")
+        }
+
+    def _remove_hidden_aggregations(self, node):
+        # They would be taken for aggregations or metrics of their own
+        hidden_keys = [key for key in node if key.startswith(HIDDEN_AGGREGATION_PREFIX)]
+        for key in hidden_keys:
+            del node[key]
+
+        for child_node in node.values():
+            if isinstance(child_node, dict):
+                self._remove_hidden_aggregations(child_node)
+            elif isinstance(child_node, list):
+                for gchild_node in child_node:
+                    if isinstance(gchild_node, dict):
+                        self._remove_hidden_aggregations(gchild_node)
+
     def _is_nested_node(self, node, parent_is_root=True, same_level_keys=None):
         # Not even a node, or a list of buckets
         if not isinstance(node, dict):
@@ -226,11 +272,22 @@ class ResultTree:
 
                 continue
 
+            if self.doc_count_errors and "doc_count_error_upper_bound" in node:
+                # Only on our first visit of the aggregation, as it is popped
+                base_line[f"{current_key}__max_doc_count_error"] = node.pop(
+                    "doc_count_error_upper_bound"
+                )
+                base_line[f"{current_key}__sum_other_doc_count"] = node.get(
+                    "sum_other_doc_count"
+                )
+
             if self.add_others_line and "sum_other_doc_count" in node:
                 others_doc_count = node.pop("sum_other_doc_count")
                 others_line = self._create_others_line(
                     base_line, current_key, others_doc_count
                 )
+                # The error bound of the previous bucket is meaningless here
+                others_line.pop(f"{current_key}__doc_count_error", None)
                 lines.append(others_line)
 
             buckets = node["buckets"]
@@ -294,6 +351,7 @@ class ResultTree:
                 continue
 
             # We need to go one level deeper
+            self.nb_buckets += 1
             if isinstance(buckets, list):
                 bucket = buckets[0]
                 base_line.update(
@@ -301,6 +359,10 @@ class ResultTree:
                         current_key: bucket["key"],
                     }
                 )
+                if self.doc_count_errors and "doc_count_error_upper_bound" in bucket:
+                    base_line[f"{current_key}__doc_count_error"] = bucket[
+                        "doc_count_error_upper_bound"
+                    ]
             elif isinstance(buckets, dict):
                 first_key = min(buckets)
                 bucket = buckets[first_key]
@@ -0,0 +1,218 @@
+import copy
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+
+def _seconds(value):
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return value
+
+
+def _params_key(params):
+    return json.dumps(params, sort_keys=True, default=str)
+
+
+class _WriteOnlyCache:
+    """Stores fresh responses in a cache, without reading it"""
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def get(self, key):
+        return None
+
+    def set(self, *args, **kwargs):
+        self.cache.set(*args, **kwargs)
+
+
+def _refreshing_template(template):
+    # A copy of the template (or of the FQuery of a PreparedFQuery) which
+    # sends its requests, and writes the responses to its cache
+    prepared = hasattr(template, "fquery")
+    fquery = template.fquery if prepared else template
+    if getattr(fquery, "cache", None) is None:
+        return template
+
+    fquery = copy.copy(fquery)
+    fquery.cache = _WriteOnlyCache(fquery.cache)
+    if not prepared:
+        return fquery
+    template = copy.copy(template)
+    template.fquery = fquery
+    return template
+
+
+class _Entry:
+    def __init__(self, template, params, max_age, stale_for, refresh_at, created_at):
+        self.template = template
+        self.refreshing_template = _refreshing_template(template)
+        self.params = params
+        self.max_age = max_age
+        self.stale_for = stale_for
+        self.refresh_at = refresh_at
+        self.created_at = created_at
+
+        self.result = None
+        self.refreshed_at = None
+        self.refreshing = None  # Future of the running refresh
+        self.error = None  # Error of the last refresh
+        self.hits = 0
+
+    def age(self, now):
+        if self.refreshed_at is None:
+            return None
+        return now - self.refreshed_at
+
+    def hit_rate(self, now):
+        return self.hits / max(now - self.created_at, 1)
+
+
+class CacheWarmer:
+    """Keeps the results of registered queries warm.
+
+    A result is fresh for `max_age` seconds, then stale for `stale_for` more
+    seconds: a stale result is still served, while it is refreshed in the
+    background. `run_pending`, called on a schedule by `start`, refreshes
+    the results before they get stale, the most requested ones first. At
+    most `max_concurrency` refreshes run at the same time.
+
+    With templates having a `cache`, refreshes write the responses to it,
+    and missing results are read from it: processes sharing the cache only
+    need one of them to run the schedule.
+
+    Results are shared between callers, and must not be modified."""
+
+    def __init__(self, max_concurrency=2, clock=time.monotonic):
+        self.max_concurrency = max_concurrency
+        self.clock = clock
+
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="fiqs-warmer"
+        )
+        self._in_flight = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def register(
+        self,
+        name,
+        template,
+        params=None,
+        max_age=300,
+        stale_for=None,
+        refresh_ahead=0.8,
+    ):
+        """Register a FQuery or a PreparedFQuery, evaluated with each set of
+        eval arguments in `params` (a list of dicts, once without arguments
+        by default). Results are refreshed once they are `refresh_ahead`
+        times `max_age` old"""
+        max_age = _seconds(max_age)
+        stale_for = max_age if stale_for is None else _seconds(stale_for)
+
+        now = self.clock()
+        with self._lock:
+            for eval_params in params or [{}]:
+                key = (name, _params_key(eval_params))
+                self._entries[key] = _Entry(
+                    template,
+                    eval_params,
+                    max_age,
+                    stale_for,
+                    max_age * refresh_ahead,
+                    now,
+                )
+
+    def get(self, name, **params):
+        """The result of a registered query. Stale results are returned at
+        once and refreshed in the background, missing or expired ones are
+        evaluated before returning"""
+        key = (name, _params_key(params))
+        now = self.clock()
+        with self._lock:
+            entry = self._entries[key]
+            entry.hits += 1
+            age = entry.age(now)
+
+            if age is not None and age < entry.max_age + entry.stale_for:
+                if age >= entry.max_age:
+                    self._submit(entry, entry.refreshing_template)
+                return entry.result
+
+            # Missing results may come from the cache, expired ones must not:
+            # the cached response may be as old as they are
+            template = entry.template if age is None else entry.refreshing_template
+            future = self._submit(entry, template)
+
+        future.result()
+        if entry.error is not None:
+            raise entry.error
+        return entry.result
+
+    def run_pending(self):
+        """Refresh the results which are due, by decreasing hit rate, without
+        exceeding `max_concurrency`. Returns the number of refreshes started"""
+        now = self.clock()
+        with self._lock:
+            due = [
+                entry
+                for entry in self._entries.values()
+                if entry.refreshing is None
+                and (entry.refreshed_at is None or entry.age(now) >= entry.refresh_at)
+            ]
+            due.sort(key=lambda entry: entry.hit_rate(now), reverse=True)
+
+            slots = max(self.max_concurrency - self._in_flight, 0)
+            for entry in due[:slots]:
+                self._submit(entry, entry.refreshing_template)
+            return min(len(due), slots)
+
+    def start(self, interval=1):
+        """Call run_pending every `interval` seconds, in a thread"""
+        interval = _seconds(interval)
+
+        def run():
+            while not self._stop.wait(interval):
+                self.run_pending()
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=run, name="fiqs-warmer", daemon=True)
+        self._thread.start()
+
+    def stop(self, wait=True):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._executor.shutdown(wait=wait)
+
+    def _submit(self, entry, template):
+        # Called with the lock held, a running refresh is shared
+        if entry.refreshing is None:
+            self._in_flight += 1
+            entry.refreshing = self._executor.submit(self._refresh, entry, template)
+        return entry.refreshing
+
+    def _refresh(self, entry, template):
+        started_at = self.clock()
+        try:
+            result = template.eval(**entry.params)
+        except Exception as e:
+            # The stale result, if any, is kept until it expires
+            with self._lock:
+                entry.error = e
+                entry.refreshing = None
+                self._in_flight -= 1
+            return
+
+        with self._lock:
+            entry.result = result
+            entry.refreshed_at = started_at
+            entry.error = None
+            entry.refreshing = None
+            self._in_flight -= 1